@@ -0,0 +1,640 @@
+from contextlib import contextmanager
+import itertools as it
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from redis import RedisError
+
+from .batch import Batch, BatchOperation
+from .events import EventReader
+from .scripts import registry
+from .utils import chunked
+
+
+logger = logging.getLogger(__name__)
+
+
+SNAPSHOT_VERSION = 2
+# seconds the temporary keys of an interrupted export or import are kept around
+SNAPSHOT_TEMP_TTL = 3600
+
+# serializes the resets of the connection pools after a fork, which may be
+# shared by several schedulers
+_fork_lock = threading.Lock()
+
+
+class SchedulerMixin(object):
+    """Functionality shared by all the scheduler classes."""
+
+    # whether next() records dispatch statistics in the stats hash
+    record_stats = False
+    # number of points per member on the consistent hash ring used for affinity
+    ring_replicas = 32
+    # maximum approximate length of the dispatch events stream (0 to disable)
+    events_maxlen = 0
+    # identifier of the worker recorded in the dispatch events (defaults to
+    # host:pid:thread)
+    worker_id = None
+
+    @property
+    def redis(self):
+        """Connection for the queries that modify the scheduler.
+
+        Its connection pool is reset after a fork, without closing the sockets
+        inherited from the parent process.
+        """
+        self._check_fork()
+        return self._redis
+
+    @redis.setter
+    def redis(self, connection):
+        self._redis = connection
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # pickle by configuration: the connections are recreated from their
+        # settings when unpickled
+        state = self.__dict__.copy()
+        del state['_pid'], state['pickler']
+        state.pop('_batches', None)
+        state['_redis'] = connection_settings(self._redis)
+        if self._read_connections is not None:
+            state['_read_connections'] = (
+                map(connection_settings, self._read_connections.connections),
+                self._read_connections.max_staleness,
+                self._read_connections.check_interval)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pickler = json
+        self.redis = connection_from_settings(self._redis)
+        if self._read_connections is not None:
+            settings, max_staleness, check_interval = self._read_connections
+            self._read_connections = ReadConnections(
+                map(connection_from_settings, settings), max_staleness, check_interval)
+
+    @contextmanager
+    def batch(self, chunk_size=1000):
+        """Context manager buffering the mutations of the current thread.
+
+        The mutation methods called in the context (e.g. ``add``, ``discard``,
+        ``pop``, ``__setitem__``) queue their commands and return a
+        :class:`~redrobin.batch.BatchOperation` instead of their result. The
+        commands are flushed in pipelines of up to ``chunk_size`` commands and
+        the last one on exit, unless the context raises an exception. Reads are
+        not buffered, so they don't see the buffered mutations. Methods that
+        must read before writing (e.g. ``popitem``) are executed immediately.
+
+        Yield the :class:`~redrobin.batch.Batch`, whose ``results`` hold the
+        per operation results after exit.
+        """
+        batches = self.__dict__.setdefault('_batches', threading.local())
+        if getattr(batches, 'current', None) is not None:
+            # nested batches are merged into the outer one
+            yield batches.current
+            return
+        batch = batches.current = Batch(self.redis, chunk_size)
+        try:
+            yield batch
+        except:
+            batch.discard()
+            raise
+        else:
+            batch.flush()
+        finally:
+            batches.current = None
+
+    @property
+    def _batch(self):
+        return getattr(self.__dict__.get('_batches'), 'current', None)
+
+    def _mutate(self, commands, result=None, transaction=True):
+        # run commands(pipe) in a pipeline and return result(responses), or
+        # buffer them if there is a batch in progress
+        batch = self._batch
+        if batch is not None:
+            return batch.add(commands, result)
+        with self.redis.pipeline(transaction) as pipe:
+            commands(pipe)
+            responses = pipe.execute() if transaction else registry.execute(pipe)
+        return result(responses) if result is not None else None
+
+    @staticmethod
+    def _then(value, func):
+        # apply func to a result that may be deferred by a batch
+        if isinstance(value, BatchOperation):
+            return value.then(func)
+        return func(value)
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            with _fork_lock:
+                # another thread may have reset the connections meanwhile
+                if self._pid != os.getpid():
+                    self._after_fork()
+                    # only now may the other threads use the connections
+                    self._pid = os.getpid()
+
+    def _after_fork(self):
+        reset_after_fork(self._redis)
+        if self._read_connections is not None:
+            for connection in self._read_connections.connections:
+                reset_after_fork(connection)
+
+    def _init_read_connections(self, read_connection, max_staleness):
+        if read_connection is None:
+            self._read_connections = None
+        else:
+            if not isinstance(read_connection, (list, tuple)):
+                read_connection = [read_connection]
+            self._read_connections = ReadConnections(read_connection, max_staleness)
+
+    def _init_clock(self, server_clock):
+        self._clock = ServerClock() if server_clock else None
+
+    def time(self):
+        """Return the current time of the scheduler clock.
+
+        This is the local time or, in server clock mode, an estimate of the time
+        of the Redis server. The timestamps of the scheduler (e.g. deadlines and
+        ``ready_at`` timestamps) are in this clock.
+        """
+        if self._clock is None:
+            return time.time()
+        return self._clock.time(self.redis)
+
+    def _script_time(self):
+        # the current time argument of the scripts; empty for the server time
+        if self._clock is None:
+            return repr(time.time())
+        return ''
+
+    def _event_args(self):
+        # the events maxlen and worker arguments of the dispatch scripts
+        if not self.events_maxlen:
+            return [0, '']
+        worker = self.worker_id
+        if worker is None:
+            worker = '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                                   threading.current_thread().name)
+        return [self.events_maxlen, worker]
+
+    def events(self, window=60, last_id='0'):
+        """Return an :class:`~redrobin.events.EventReader` of the dispatch
+        events stream, enabled by the ``events_maxlen`` constructor argument.
+        """
+        return EventReader(self, window=window, last_id=last_id)
+
+    @property
+    def read_redis(self):
+        """Connection for the read-only queries.
+
+        This is one of the read connections given to the constructor that is
+        not lagging behind by more than ``max_staleness`` seconds or the primary
+        connection if there is no such read connection.
+        """
+        if self._read_connections is not None:
+            self._check_fork()
+            connection = self._read_connections.get()
+            if connection is not None:
+                return connection
+        return self.redis
+
+    def load_scripts(self):
+        """Load the Lua scripts on the primary and the read servers.
+
+        Otherwise they are loaded by the first script call on each connection
+        pool.
+        """
+        registry.load(self.redis)
+        if self._read_connections is not None:
+            for connection in self._read_connections.connections:
+                registry.load(connection)
+
+    def stats(self):
+        """Return the dispatch statistics of each key as a ``{key: stats}`` dict.
+
+        The statistics of a key are a dict with the following items:
+        - ``count``: number of times the key was dispatched.
+        - ``wait``: total seconds the callers had to wait for the key.
+        - ``last``: timestamp of the last dispatch.
+        - ``misses``: number of times the key was not dispatched because it was
+          throttled for more than the caller was willing to wait.
+        - ``utilization``: fraction of the time since the statistics started
+          being recorded that the key was throttled, i.e. ``count * throttle /
+          elapsed``, or None for schedulers without throttles.
+
+        Statistics are recorded only by schedulers created with ``stats=True``.
+        """
+        fields = self.read_redis.hgetall(self.stats_key)
+        since = float(fields.pop('since', 0))
+        member_stats = {}
+        for field, value in fields.iteritems():
+            stat, _, member = field.partition(':')
+            if stat == 'total':
+                continue
+            stats = member_stats.get(member)
+            if stats is None:
+                stats = member_stats[member] = dict(count=0, wait=0.0, last=None,
+                                                    misses=0, utilization=None)
+            if stat == 'count':
+                stats['count'] = int(value)
+            elif stat == 'wait':
+                stats['wait'] = float(value)
+            elif stat == 'last':
+                stats['last'] = float(value)
+            elif stat == 'miss':
+                stats['misses'] = int(value)
+
+        members = list(member_stats)
+        throttles = self._stats_throttles(members)
+        if throttles is not None:
+            elapsed = self.time() - since
+            for member, throttle in zip(members, throttles):
+                if throttle is not None and elapsed > 0:
+                    stats = member_stats[member]
+                    stats['utilization'] = stats['count'] * throttle / elapsed
+
+        return {self._stats_member_loads(member): stats
+                for member, stats in member_stats.iteritems()}
+
+    def stats_summary(self):
+        """Return the dispatch statistics totals over all keys.
+
+        This is a dict with the total ``count``, ``wait`` and ``misses`` of all
+        keys and the timestamp the statistics started being recorded (``since``).
+        """
+        since, count, wait, misses = self.read_redis.hmget(
+            self.stats_key, 'since', 'total:count', 'total:wait', 'total:miss')
+        return dict(since=float(since) if since is not None else None,
+                    count=int(count or 0), wait=float(wait or 0),
+                    misses=int(misses or 0))
+
+    def reset_stats(self):
+        """Clear the dispatch statistics."""
+        self.redis.delete(self.stats_key)
+
+    def expire(self, item, seconds):
+        """Expire ``item`` after ``seconds`` (see :meth:`expireat`)."""
+        return self.expireat(item, self.time() + seconds)
+
+    def expireat(self, item, timestamp):
+        """Expire ``item`` at ``timestamp`` and return True, or return False if
+        ``item`` is not in the scheduler.
+
+        Expired items are never dispatched. They are purged when they reach the
+        front of the queue or by :meth:`sweep`, until then they are still
+        counted and iterated over. Adding an item clears its expiry.
+        """
+        member = self._member_dumps(item)
+        return self._mutate(lambda pipe: self._expireat(pipe, member, timestamp),
+                            lambda responses: bool(responses[0]), transaction=False)
+
+    def persist(self, item):
+        """Clear the expiry of ``item`` and return True if it had one."""
+        member = self._member_dumps(item)
+        return self._mutate(lambda pipe: pipe.zrem(self.expiry_key, member),
+                            lambda responses: bool(responses[0]), transaction=False)
+
+    def ttl(self, item):
+        """Return the seconds until ``item`` expires or None if it doesn't."""
+        expires_at = self.read_redis.zscore(self.expiry_key, self._member_dumps(item))
+        if expires_at is not None:
+            return max(expires_at - self.time(), 0)
+
+    def sweep(self, batch_size=100):
+        """Purge up to ``batch_size`` expired items and return how many were purged."""
+        return self._sweep(batch_size)
+
+    def start_sweeper(self, interval=1, batch_size=100):
+        """Start and return a :class:`Sweeper` thread for this scheduler."""
+        sweeper = Sweeper(self, interval, batch_size)
+        sweeper.start()
+        return sweeper
+
+    def sync(self, desired, chunk_size=1000):
+        """Atomically reconcile the scheduler with the ``desired`` items.
+
+        ``desired`` is uploaded in chunks of ``chunk_size`` to a temporary key
+        and the differences are computed and applied by a single script: new
+        items are added, missing items are removed and the rest are left
+        untouched, including their deadlines. Return the numbers of the changes
+        as a tuple (see the subclasses).
+        """
+        desired_key = self._temp_key(self.key, 'sync')
+        try:
+            for chunk in chunked(desired, chunk_size):
+                with self.redis.pipeline(transaction=False) as pipe:
+                    self._sync_chunk(pipe, desired_key, chunk)
+                    pipe.expire(desired_key, SNAPSHOT_TEMP_TTL)
+                    pipe.execute()
+            return self._sync(desired_key)
+        finally:
+            self.redis.delete(desired_key)
+
+    def export_snapshot(self, chunk_size=1000):
+        """Iterate over a snapshot of the items, throttles, deadlines and expiry
+        timestamps of the scheduler, read in chunks of ``chunk_size`` items.
+
+        The first element is a header dict and the rest are lists of records,
+        all of them JSON serializable (see also :meth:`save_snapshot`). The
+        queue is copied atomically before it is read, so the deadlines are
+        consistent with each other even if the scheduler is in use.
+        """
+        header = dict(type=type(self).__name__, version=SNAPSHOT_VERSION)
+        header.update(self._snapshot_header())
+        yield header
+        for chunk in self._export_chunks(chunk_size):
+            if chunk:
+                yield chunk
+
+    def import_snapshot(self, snapshot):
+        """Replace the state of the scheduler with an exported ``snapshot``,
+        preserving the deadlines.
+
+        The chunks are loaded in bulk into temporary keys that atomically replace
+        the current ones after the last chunk.
+        """
+        snapshot = iter(snapshot)
+        header = next(snapshot, None)
+        if not isinstance(header, dict) or header.get('type') != type(self).__name__:
+            raise ValueError("Not a {} snapshot".format(type(self).__name__))
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version: {!r}".format(
+                header.get('version')))
+
+        keys = self._snapshot_keys()
+        import_keys = {role: self._temp_key(key, 'import')
+                       for role, key in keys.iteritems()}
+        try:
+            with self.redis.pipeline(transaction=False) as pipe:
+                self._import_header(pipe, import_keys, header)
+                pipe.execute()
+            for chunk in snapshot:
+                with self.redis.pipeline(transaction=False) as pipe:
+                    self._import_chunk(pipe, import_keys, chunk)
+                    for import_key in import_keys.itervalues():
+                        pipe.expire(import_key, SNAPSHOT_TEMP_TTL)
+                    pipe.execute()
+
+            with self.redis.pipeline(transaction=False) as pipe:
+                for role in keys:
+                    pipe.exists(import_keys[role])
+                imported = pipe.execute()
+            with self.redis.pipeline() as pipe:
+                for (role, key), exists in zip(keys.iteritems(), imported):
+                    pipe.delete(key)
+                    if exists:
+                        pipe.rename(import_keys[role], key)
+                        pipe.persist(key)
+                self._invalidate(pipe)
+                pipe.execute()
+        finally:
+            self.redis.delete(*import_keys.values())
+
+    def save_snapshot(self, fp, chunk_size=1000):
+        """Write an exported snapshot to the file object ``fp``, one JSON line
+        per element.
+        """
+        for element in self.export_snapshot(chunk_size):
+            fp.write(json.dumps(element) + '\n')
+
+    def load_snapshot(self, fp):
+        """Import a snapshot written by :meth:`save_snapshot` from ``fp``."""
+        self.import_snapshot(json.loads(line) for line in fp)
+
+    def dump(self):
+        """Return a point-in-time binary snapshot of the scheduler as a dict of
+        Redis DUMP payloads.
+
+        This is faster than :meth:`export_snapshot` but it can be restored only
+        to Redis servers with a compatible RDB version.
+        """
+        keys = self._snapshot_keys()
+        with self.redis.pipeline() as pipe:
+            for key in keys.itervalues():
+                pipe.dump(key)
+            return dict(zip(keys, pipe.execute()))
+
+    def restore(self, payloads):
+        """Atomically replace the state of the scheduler with a :meth:`dump`."""
+        with self.redis.pipeline() as pipe:
+            for role, key in self._snapshot_keys().iteritems():
+                pipe.delete(key)
+                if payloads.get(role) is not None:
+                    pipe.restore(key, 0, payloads[role])
+            self._invalidate(pipe)
+            pipe.execute()
+
+    def _temp_key(self, key, purpose):
+        return '{}:{}:{}'.format(key, purpose, uuid.uuid4().hex)
+
+    def _snapshot_header(self):
+        return {}
+
+    def _import_header(self, pipe, keys, header):
+        pass
+
+    def _export_expiry(self, items):
+        # return the expiry timestamps of items, None for those without one
+        with self.redis.pipeline(transaction=False) as pipe:
+            for item in items:
+                pipe.zscore(self.expiry_key, self._member_dumps(item))
+            return pipe.execute()
+
+    def _import_expiry(self, pipe, keys, expiry):
+        # expiry is a list of (item, expires_at) pairs
+        if expiry:
+            pipe.zadd(keys['expiry'], *it.chain.from_iterable(
+                (expires_at, self._member_dumps(item)) for item, expires_at in expiry))
+
+    def _invalidate(self, pipe, keys=None):
+        self._invalidate_ring(pipe)
+
+    def _invalidate_ring(self, pipe):
+        # the ring is rebuilt on the next dispatch by affinity
+        pipe.delete(self.ring_key)
+
+    def _stats_member_loads(self, member):
+        return member
+
+    def _member_dumps(self, item):
+        return item
+
+    def _stats_throttles(self, members):
+        return None
+
+
+class Sweeper(threading.Thread):
+    """Daemon thread purging the expired items of a scheduler.
+
+    Every ``interval`` seconds expired items are purged in batches of
+    ``batch_size`` until there are no more left.
+    """
+
+    def __init__(self, scheduler, interval=1, batch_size=100):
+        super(Sweeper, self).__init__(name='redrobin-sweeper')
+        self.daemon = True
+        self.scheduler = scheduler
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                while (self.scheduler.sweep(self.batch_size) == self.batch_size
+                       and not self._stopped.is_set()):
+                    pass
+            except Exception:
+                logger.exception("Sweeping expired items failed")
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self.join(timeout)
+
+
+class ReadConnections(object):
+    """Round robin over read-only (typically replica) connections.
+
+    If ``max_staleness`` is not None, replicas that are disconnected from their
+    primary or haven't heard from it for more than ``max_staleness`` seconds are
+    skipped. The replication status is checked at most every ``check_interval``
+    seconds.
+    """
+
+    def __init__(self, connections, max_staleness=None, check_interval=1):
+        self.connections = list(connections)
+        self.max_staleness = max_staleness
+        self.check_interval = check_interval
+        self._fresh_connections = self.connections
+        self._checked_at = None
+        self._counter = it.count()
+
+    def get(self):
+        connections = self._get_fresh_connections()
+        if connections:
+            return connections[next(self._counter) % len(connections)]
+
+    def _get_fresh_connections(self):
+        if self.max_staleness is not None:
+            now = time.time()
+            if self._checked_at is None or now - self._checked_at >= self.check_interval:
+                self._fresh_connections = [
+                    connection for connection in self.connections
+                    if replication_lag(connection) <= self.max_staleness
+                ]
+                self._checked_at = now
+        return self._fresh_connections
+
+
+class ServerClock(object):
+    """Client side estimate of the clock of a Redis server.
+
+    The offset from the local clock is estimated from the TIME query with the
+    shortest round trip out of ``samples`` and it is estimated again every
+    ``sync_interval`` seconds.
+    """
+
+    def __init__(self, sync_interval=60, samples=3):
+        self.sync_interval = sync_interval
+        self.samples = samples
+        self.offset = None
+        self._synced_at = None
+
+    def __getstate__(self):
+        # the offset may not hold for the clock of another host
+        state = self.__dict__.copy()
+        state['offset'] = state['_synced_at'] = None
+        return state
+
+    def sync(self, connection):
+        """Estimate the offset of the server clock of ``connection``."""
+        best_rtt = None
+        for _ in xrange(self.samples):
+            start = time.time()
+            seconds, microseconds = connection.time()
+            end = time.time()
+            if best_rtt is None or end - start < best_rtt:
+                best_rtt = end - start
+                offset = seconds + microseconds / 1e6 - (start + end) / 2
+        self.offset = offset
+        self._synced_at = end
+        return offset
+
+    def time(self, connection):
+        """Return the estimated current time of the server of ``connection``."""
+        now = time.time()
+        if self._synced_at is None or now - self._synced_at >= self.sync_interval:
+            self.sync(connection)
+        return now + self.offset
+
+
+def reset_after_fork(connection):
+    """Reset the connection pool of ``connection`` if it was created by another
+    (i.e. the parent) process.
+
+    Unlike the pool's own reset, the inherited sockets are closed without being
+    shut down, since that would shut them down for the parent process too.
+    """
+    pool = connection.connection_pool
+    if pool.pid == os.getpid():
+        return
+    connections = getattr(pool, '_connections', None)
+    if connections is None:
+        connections = list(pool._available_connections)
+        connections.extend(pool._in_use_connections)
+    for inherited in connections:
+        if inherited is not None and inherited._sock is not None:
+            sock, inherited._sock = inherited._sock, None
+            inherited._parser.on_disconnect()
+            sock.close()
+    pool.reset()
+
+
+def connection_settings(connection):
+    """Return the picklable settings of a ``connection`` and its pool."""
+    pool = connection.connection_pool
+    return (type(connection), type(pool), pool.connection_class, pool.max_connections,
+            pool.connection_kwargs)
+
+
+# connection pools created from settings, shared by the connections of each process
+_pools = {}
+
+
+def connection_from_settings(settings):
+    """Return a connection with the given :func:`connection_settings`.
+
+    Connections with the same settings share the same connection pool.
+    """
+    connection_cls, pool_cls, connection_class, max_connections, kwargs = settings
+    pool_key = (os.getpid(), pool_cls, connection_class, max_connections,
+                repr(sorted(kwargs.iteritems())))
+    pool = _pools.get(pool_key)
+    if pool is None:
+        pool = _pools[pool_key] = pool_cls(connection_class=connection_class,
+                                           max_connections=max_connections, **kwargs)
+    return connection_cls(connection_pool=pool)
+
+
+def replication_lag(connection):
+    """Return the (approximate) number of seconds ``connection`` is lagging
+    behind its primary, 0 if it is a primary or infinity if it is unreachable
+    or disconnected from its primary.
+    """
+    try:
+        info = connection.info('replication')
+    except RedisError:
+        return float('inf')
+    if info.get('role') != 'slave':
+        return 0
+    if info.get('master_link_status') != 'up':
+        return float('inf')
+    return info.get('master_last_io_seconds_ago', float('inf'))
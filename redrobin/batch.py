@@ -0,0 +1,100 @@
+class Batch(object):
+    """Buffer of scheduler mutations, flushed as pipelines of up to
+    ``chunk_size`` commands.
+
+    Each chunk is executed as a transaction, so the commands of a single
+    mutation are applied atomically as without batching, but separate mutations
+    are not atomic with respect to each other. The mutation methods return a
+    :class:`BatchOperation` for their result.
+    """
+
+    def __init__(self, connection, chunk_size=1000):
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.operations = []
+        self._pipe = None
+        self._pending = []
+
+    @property
+    def results(self):
+        """The results of the flushed operations in order; failed operations
+        have their exception as result.
+        """
+        return [operation.error if operation.error is not None else operation.value
+                for operation in self.operations if operation.done]
+
+    def add(self, commands, result=None):
+        """Buffer the commands queued by ``commands(pipe)``.
+
+        Return a :class:`BatchOperation` whose value is ``result(responses)``
+        of the responses of the commands (or None).
+        """
+        if self._pipe is not None and len(self._pipe.command_stack) >= self.chunk_size:
+            self.flush()
+        if self._pipe is None:
+            self._pipe = self.connection.pipeline()
+        start = len(self._pipe.command_stack)
+        commands(self._pipe)
+        operation = BatchOperation(result, start, len(self._pipe.command_stack))
+        self._pending.append(operation)
+        self.operations.append(operation)
+        return operation
+
+    def flush(self):
+        """Execute the buffered commands."""
+        pipe, pending = self._pipe, self._pending
+        self._pipe, self._pending = None, []
+        if pipe is not None:
+            with pipe:
+                responses = pipe.execute(raise_on_error=False)
+            for operation in pending:
+                operation._resolve(responses)
+
+    def discard(self):
+        """Discard the buffered commands."""
+        if self._pipe is not None:
+            self._pipe.reset()
+        for operation in self._pending:
+            self.operations.remove(operation)
+        self._pipe, self._pending = None, []
+
+
+class BatchOperation(object):
+    """Deferred result of a batched mutation."""
+
+    def __init__(self, result, start, stop):
+        self.done = False
+        self.error = None
+        self._result = result
+        self._value = None
+        self._slice = slice(start, stop)
+
+    @property
+    def value(self):
+        """The result of the operation, available after the batch is flushed.
+
+        The exception of the operation is raised if it failed.
+        """
+        if not self.done:
+            raise RuntimeError("The batch has not been flushed yet")
+        if self.error is not None:
+            raise self.error
+        return self._value
+
+    def then(self, func):
+        """Transform the result of the operation with ``func`` and return self."""
+        result = self._result
+        self._result = lambda responses: func(result(responses) if result else None)
+        return self
+
+    def _resolve(self, responses):
+        responses = responses[self._slice]
+        errors = [response for response in responses if isinstance(response, Exception)]
+        if errors:
+            self.error = errors[0]
+        elif self._result is not None:
+            try:
+                self._value = self._result(responses)
+            except Exception as ex:
+                self.error = ex
+        self.done = True
@@ -0,0 +1,114 @@
+import collections
+import json
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidatingCache(object):
+    """Bounded local cache of a Redis hash, invalidated through pub/sub.
+
+    Every writer of the hash is expected to publish the modified fields on
+    ``channel`` (see :func:`publish_invalidation`). Since pub/sub delivery is not
+    guaranteed, entries also expire after ``max_age`` seconds, the whole cache is
+    cleared whenever the subscriber connection is re-established and the cache
+    is bypassed altogether if the subscriber thread dies.
+    """
+
+    def __init__(self, connection, channel, maxsize=1024, max_age=60):
+        self.channel = channel
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._all = None
+        self._generation = 0
+        self._pubsub = connection.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{channel: self._on_message})
+        # wait for the subscription to be confirmed so that no invalidation
+        # published after this point is missed
+        self._pubsub.parse_response(block=True)
+        self._pubsub.connection.register_connect_callback(self._on_connect)
+        self._listener = threading.Thread(target=self._listen)
+        self._listener.daemon = True
+        self._listener.start()
+
+    @property
+    def enabled(self):
+        return self._listener.is_alive()
+
+    def get(self, field, load):
+        """Return the cached value of ``field`` or load it by calling ``load(field)``."""
+        if not self.enabled:
+            return load(field)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(field, None)
+            if entry is not None and now - entry[1] < self.max_age:
+                # re-insert it as the most recently used entry
+                self._entries[field] = entry
+                return entry[0]
+            generation = self._generation
+        value = load(field)
+        if value is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[field] = (value, now)
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+        return value
+
+    def get_all(self, load):
+        """Return the cached items of the whole hash or load them by calling ``load()``."""
+        if not self.enabled:
+            return load()
+        now = time.time()
+        with self._lock:
+            if self._all is not None and now - self._all[1] < self.max_age:
+                return list(self._all[0])
+            generation = self._generation
+        items = load()
+        if len(items) <= self.maxsize:
+            with self._lock:
+                if generation == self._generation:
+                    self._all = (list(items), now)
+        return items
+
+    def invalidate(self, fields=None):
+        """Invalidate the given ``fields`` or the whole cache if ``fields`` is None."""
+        with self._lock:
+            self._generation += 1
+            self._all = None
+            if fields is None:
+                self._entries.clear()
+            else:
+                for field in fields:
+                    self._entries.pop(field, None)
+
+    def close(self):
+        self._pubsub.unsubscribe()
+        self.invalidate()
+
+    def _on_message(self, message):
+        self.invalidate(json.loads(message['data']))
+
+    def _on_connect(self, connection):
+        # invalidations may have been lost while disconnected
+        self.invalidate()
+
+    def _listen(self):
+        try:
+            for _ in self._pubsub.listen():
+                pass
+        except Exception:
+            logger.exception("Cache invalidation listener stopped")
+        finally:
+            self.invalidate()
+
+
+def publish_invalidation(pipe, channel, fields=None):
+    """Publish the invalidation of ``fields`` (or everything if None) on ``channel``."""
+    pipe.publish(channel, json.dumps(fields))
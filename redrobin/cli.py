@@ -0,0 +1,192 @@
+"""Command line tools for inspecting redrobin schedulers.
+
+Run ``redrobin top --help`` for the options of the live monitoring view.
+"""
+
+import argparse
+import collections
+import itertools as it
+import json
+import sys
+import time
+
+import redis
+
+from .roundrobin import RoundRobinScheduler
+from .throttling import ThrottlingScheduler
+from .throttlingroundrobin import ThrottlingRoundRobinScheduler
+
+
+KEY_PREFIX = 'redrobin:'
+
+#: Scheduler types by the suffix of their queue key (after the name)
+SCHEDULER_TYPES = collections.OrderedDict(
+    (cls.redis_queue_format.format(name='')[len(KEY_PREFIX):], cls)
+    for cls in (ThrottlingScheduler, ThrottlingRoundRobinScheduler, RoundRobinScheduler)
+)
+
+PoolState = collections.namedtuple('PoolState', [
+    'name', 'type', 'size', 'available', 'throttled', 'deadlines',
+    'dispatch_rate', 'miss_rate',
+])
+
+
+def discover(connection, pattern=KEY_PREFIX + '*', count=1000):
+    """Yield ``(name, scheduler_type)`` for every scheduler queue key matching
+    ``pattern``, scanning the keyspace incrementally.
+    """
+    for key in connection.scan_iter(match=pattern, count=count):
+        for suffix, cls in SCHEDULER_TYPES.iteritems():
+            if key.startswith(KEY_PREFIX) and key.endswith(suffix):
+                name = key[len(KEY_PREFIX):-len(suffix)]
+                if name:
+                    yield name, cls
+                break
+
+
+class PoolMonitor(object):
+    """Read-only view of the state of a scheduler queue.
+
+    Only O(1) or O(log N) commands are issued, except for throttling roundrobin
+    queues which are scanned in chunks of ``chunk_size`` elements from the
+    earliest available end, up to the first throttled element.
+    """
+
+    def __init__(self, connection, name, scheduler_type, num_deadlines=3,
+                 chunk_size=1000):
+        self.connection = connection
+        self.name = name
+        self.scheduler_type = scheduler_type
+        self.num_deadlines = num_deadlines
+        self.chunk_size = chunk_size
+        self.queue_key = scheduler_type.redis_queue_format.format(name=name)
+        self.stats_key = scheduler_type.redis_stats_format.format(name=name)
+        self._last_totals = None
+
+    def state(self, now=None):
+        if now is None:
+            now = time.time()
+        if self.scheduler_type is ThrottlingScheduler:
+            size, available, deadlines = self._sorted_set_state(now)
+        elif self.scheduler_type is ThrottlingRoundRobinScheduler:
+            size, available, deadlines = self._throttled_list_state(now)
+        else:
+            size = self.connection.llen(self.queue_key)
+            available, deadlines = size, []
+        dispatch_rate, miss_rate = self._rates(now)
+        return PoolState(self.name, self.scheduler_type.__name__, size, available,
+                         size - available, deadlines, dispatch_rate, miss_rate)
+
+    def _sorted_set_state(self, now):
+        with self.connection.pipeline(transaction=False) as pipe:
+            pipe.zcard(self.queue_key)
+            pipe.zcount(self.queue_key, '-inf', now)
+            pipe.zrangebyscore(self.queue_key, '(%r' % now, '+inf', start=0,
+                               num=self.num_deadlines, withscores=True)
+            size, available, deadlines = pipe.execute()
+        return size, available, deadlines
+
+    def _throttled_list_state(self, now):
+        size = self.connection.llen(self.queue_key)
+        available, deadlines = 0, []
+        # the rightmost element is the earliest available
+        for start in xrange(0, size, self.chunk_size):
+            chunk = self.connection.lrange(self.queue_key, -start - self.chunk_size,
+                                           -start - 1)
+            for element in reversed(chunk):
+                item, throttled_until = json.loads(element)
+                if throttled_until <= now and not deadlines:
+                    available += 1
+                else:
+                    deadlines.append((json.dumps(item), throttled_until))
+                    if len(deadlines) >= self.num_deadlines:
+                        return size, available, deadlines
+        return size, available, deadlines
+
+    def _rates(self, now):
+        count, misses = self.connection.hmget(self.stats_key, 'total:count',
+                                              'total:miss')
+        totals = (now, int(count or 0), int(misses or 0))
+        last_totals, self._last_totals = self._last_totals, totals
+        if last_totals is None or now <= last_totals[0]:
+            return None, None
+        elapsed = now - last_totals[0]
+        return ((totals[1] - last_totals[1]) / elapsed,
+                (totals[2] - last_totals[2]) / elapsed)
+
+
+def render(states, now):
+    header = '%-24s %-30s %9s %9s %9s %9s %9s  %s' % (
+        'NAME', 'TYPE', 'SIZE', 'AVAIL', 'THROTTLED', 'DISP/S', 'MISS/S',
+        'NEXT DEADLINES')
+    lines = [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)), '', header]
+    format_rate = lambda rate: '%.2f' % rate if rate is not None else '-'
+    for state in states:
+        deadlines = ' '.join('%s(+%.2fs)' % (key, deadline - now)
+                             for key, deadline in state.deadlines)
+        lines.append('%-24s %-30s %9d %9d %9d %9s %9s  %s' % (
+            state.name, state.type, state.size, state.available, state.throttled,
+            format_rate(state.dispatch_rate), format_rate(state.miss_rate),
+            deadlines))
+    return '\n'.join(lines)
+
+
+def top(connection, names=None, pattern=KEY_PREFIX + '*', interval=2, iterations=None,
+        num_deadlines=3, rediscover_every=30, out=None):
+    """Print a refreshing view of the state of the matching schedulers.
+
+    Schedulers are rediscovered every ``rediscover_every`` refreshes unless
+    their ``(name, scheduler_type)`` pairs are given explicitly in ``names``.
+    """
+    out = out if out is not None else sys.stdout
+    monitors = {}
+    clear_screen = out.isatty() if hasattr(out, 'isatty') else False
+    for i in it.count():
+        if iterations is not None and i >= iterations:
+            break
+        if i > 0:
+            time.sleep(interval)
+        if names is not None:
+            current = names
+        elif i % rediscover_every == 0:
+            current = list(discover(connection, pattern))
+        for pool in current:
+            if pool not in monitors:
+                monitors[pool] = PoolMonitor(connection, pool[0], pool[1],
+                                             num_deadlines)
+        now = time.time()
+        states = [monitors[pool].state(now) for pool in sorted(set(current))]
+        if clear_screen:
+            out.write('\x1b[H\x1b[2J')
+        out.write(render(states, now) + '\n')
+        out.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='redrobin')
+    subparsers = parser.add_subparsers(dest='command')
+    top_parser = subparsers.add_parser(
+        'top', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help='Live view of the scheduler pools')
+    top_parser.add_argument('--url', default='redis://localhost:6379/0',
+                            help='Redis URL to read from (preferably a replica)')
+    top_parser.add_argument('--pattern', default=KEY_PREFIX + '*',
+                            help='Key pattern for discovering the schedulers')
+    top_parser.add_argument('-i', '--interval', type=float, default=2,
+                            help='Seconds between refreshes')
+    top_parser.add_argument('-n', '--iterations', type=int,
+                            help='Number of refreshes before exiting')
+    top_parser.add_argument('-d', '--deadlines', type=int, default=3,
+                            help='Number of soonest deadlines to show per pool')
+    args = parser.parse_args(argv)
+
+    connection = redis.StrictRedis.from_url(args.url)
+    try:
+        top(connection, pattern=args.pattern, interval=args.interval,
+            iterations=args.iterations, num_deadlines=args.deadlines)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
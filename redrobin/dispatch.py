@@ -0,0 +1,267 @@
+import json
+import logging
+import multiprocessing
+import threading
+import time
+
+from .roundrobin import RoundRobinScheduler, ROUNDROBIN_FUNCTIONS
+from .throttling import ThrottlingScheduler, THROTTLING_FUNCTIONS
+from .throttlingroundrobin import ThrottlingRoundRobinScheduler
+from .throttlingroundrobin import THROTTLING_ROUNDROBIN_FUNCTIONS
+from .scripts import register_script
+
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+    """Work queue whose jobs are dispatched together with a scheduler key.
+
+    Each dispatch pops the next job and reserves the earliest available key of
+    ``scheduler`` atomically, so there is never a job without a key or a key
+    reserved without a job. The job queue lives in the same Redis database as
+    the scheduler.
+    """
+
+    # queue of JSON encoded jobs. Jobs are pushed to the left and popped from
+    # the right
+    redis_jobs_format = 'redrobin:{name}:jobs'
+    # hash of {job: number of failed attempts}
+    redis_attempts_format = 'redrobin:{name}:jobs:attempts'
+    # queue of the jobs that failed max_attempts times
+    redis_failed_format = 'redrobin:{name}:jobs:failed'
+
+    def __init__(self, scheduler, name='default', max_attempts=None):
+        self.scheduler = scheduler
+        self.max_attempts = max_attempts
+        self.jobs_key = self.redis_jobs_format.format(name=name)
+        self.attempts_key = self.redis_attempts_format.format(name=name)
+        self.failed_key = self.redis_failed_format.format(name=name)
+        if isinstance(scheduler, ThrottlingScheduler):
+            self._script = DISPATCH_THROTTLING
+        elif isinstance(scheduler, ThrottlingRoundRobinScheduler):
+            self._script = DISPATCH_THROTTLING_ROUNDROBIN
+        elif isinstance(scheduler, RoundRobinScheduler):
+            self._script = DISPATCH_ROUNDROBIN
+        else:
+            raise TypeError("Unsupported scheduler: {!r}".format(scheduler))
+        self._keys = [self.jobs_key] + scheduler._script_keys()
+
+    @property
+    def redis(self):
+        return self.scheduler.redis
+
+    def __len__(self):
+        return self.redis.llen(self.jobs_key)
+
+    def put(self, *jobs):
+        """Append ``jobs`` to the queue."""
+        self.redis.lpush(self.jobs_key, *map(json.dumps, jobs))
+
+    def failed(self):
+        """Return the jobs that failed ``max_attempts`` times."""
+        return [json.loads(job) for job in reversed(
+            self.redis.lrange(self.failed_key, 0, -1))]
+
+    def clear(self):
+        self.redis.delete(self.jobs_key, self.attempts_key, self.failed_key)
+
+    def next(self, wait=True):
+        """Return the next ``(job, key)`` pair, waiting for the key if it's
+        throttled and ``wait`` is True.
+
+        Return None if there are no jobs or if the key is throttled and ``wait``
+        is False; in both cases nothing is dispatched. Raise StopIteration if
+        the scheduler has no keys.
+        """
+        result = self._dispatch(None if wait else 0)
+        if result is None:
+            return None
+        job, key, wait_time, ready_at = result
+        if ready_at is None:
+            logger.debug("Not waiting %s for %.2fs", key, wait_time)
+            return None
+        if wait_time > 0:
+            logger.debug("Waiting %s for %.2fs", key, wait_time)
+            time.sleep(wait_time)
+        return job, key
+
+    def reserve(self, max_wait=None):
+        """Dispatch the next job without waiting for its key.
+
+        Return a ``(job, key, ready_at)`` tuple, where ``ready_at`` is the
+        timestamp after which the key may be used, or None if there are no jobs
+        or the key is throttled for more than ``max_wait`` seconds.
+        """
+        result = self._dispatch(max_wait)
+        if result is not None and result[3] is not None:
+            return result[0], result[1], result[3]
+
+    def retry(self, job):
+        """Put a failed ``job`` back on the queue, or on the failed jobs queue
+        if it has failed ``max_attempts`` times.
+
+        Return True if the job was put back on the queue.
+        """
+        return bool(RETRY(keys=[self.jobs_key, self.attempts_key, self.failed_key],
+                          args=[json.dumps(job), self.max_attempts or ''],
+                          client=self.redis))
+
+    def done(self, job):
+        """Mark a dispatched ``job`` as successfully completed."""
+        if self.max_attempts:
+            self.redis.hdel(self.attempts_key, json.dumps(job))
+
+    def work(self, handler):
+        """Call ``handler(job, key)`` for each dispatched job until there are no
+        more jobs. Jobs for which ``handler`` raises an exception are retried.
+
+        Return the number of successfully completed jobs.
+        """
+        count = 0
+        while True:
+            dispatched = self.next()
+            if dispatched is None:
+                return count
+            job, key = dispatched
+            try:
+                handler(job, key)
+            except Exception:
+                logger.exception("Job %r failed with %r", job, key)
+                self.retry(job)
+            else:
+                self.done(job)
+                count += 1
+
+    def _dispatch(self, max_wait):
+        result = self._script(keys=self._keys,
+                              args=[self.scheduler._script_time(),
+                                    repr(max_wait) if max_wait is not None else '',
+                                    int(self.scheduler.record_stats),
+                                    getattr(self.scheduler, '_default_throttle', ''),
+                                    getattr(self.scheduler, 'invalidations_channel', '')]
+                                   + self.scheduler._event_args()
+                                   + [getattr(self.scheduler, 'warmup_factor', 1),
+                                      getattr(self.scheduler, 'warmup_period', 0)],
+                              client=self.redis)
+        if result is None:
+            raise StopIteration
+        if not result:
+            return None
+        key, wait_time = self.scheduler._stats_member_loads(result[0]), float(result[1])
+        if len(result) == 2:
+            return None, key, wait_time, None
+        return json.loads(result[3]), key, wait_time, float(result[2])
+
+
+def run_workers(dispatcher, handler, num_processes=0, num_threads=1):
+    """Drain the jobs of ``dispatcher`` with ``num_threads`` threads in each of
+    ``num_processes`` worker processes (or in the current process if
+    ``num_processes`` is 0), calling ``handler(job, key)`` for each job.
+    """
+    if num_processes == 0:
+        _run_threads(dispatcher, handler, num_threads)
+        return
+
+    processes = []
+    for i in range(1, num_processes + 1):
+        process = multiprocessing.Process(name='process{}'.format(i),
+                                          target=_run_threads,
+                                          args=(dispatcher, handler, num_threads))
+        processes.append(process)
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def _run_threads(dispatcher, handler, num_threads):
+    if num_threads <= 1:
+        dispatcher.work(handler)
+        return
+
+    threads = []
+    for i in range(1, num_threads + 1):
+        thread = threading.Thread(name='thread{}'.format(i), target=dispatcher.work,
+                                  args=(handler,))
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# Common arguments of the dispatch scripts:
+# KEYS: the jobs queue followed by the scheduler keys
+# ARGV: now (or '' for the server time), max_wait (or ''), record_stats,
+#       default throttle (or ''), invalidations channel (or ''), events maxlen,
+#       worker, warmup factor, warmup period
+# Return false if the scheduler is empty, an empty table if there are no jobs,
+# {key, wait_time} if the key is throttled for more than max_wait or
+# {key, wait_time, ready_at, job} if the job was dispatched.
+
+DISPATCH_THROTTLING = register_script(THROTTLING_FUNCTIONS + """
+if redis.call("LLEN", KEYS[1]) == 0 then
+    return {}
+end
+local keys = throttling_keys(2, ARGV[5])
+local now = current_time(ARGV[1])
+enable_events(keys, ARGV[6], ARGV[7])
+enable_warmup(keys, ARGV[8], ARGV[9])
+local key, throttled_until = next_key(keys, now)
+if not key then
+    return false
+end
+local result = reserve_key(keys, key, throttled_until, now, ARGV[2], ARGV[3])
+if #result == 3 then
+    table.insert(result, redis.call("RPOP", KEYS[1]))
+end
+return result
+""")
+
+DISPATCH_THROTTLING_ROUNDROBIN = register_script(THROTTLING_ROUNDROBIN_FUNCTIONS + """
+if redis.call("LLEN", KEYS[1]) == 0 then
+    return {}
+end
+local keys = throttling_roundrobin_keys(2)
+enable_events(keys, ARGV[6], ARGV[7])
+local result = reserve_item(keys, current_time(ARGV[1]), ARGV[2], ARGV[3], ARGV[4])
+if not result then
+    return false
+end
+if #result == 3 then
+    table.insert(result, redis.call("RPOP", KEYS[1]))
+end
+return result
+""")
+
+DISPATCH_ROUNDROBIN = register_script(ROUNDROBIN_FUNCTIONS + """
+if redis.call("LLEN", KEYS[1]) == 0 then
+    return {}
+end
+local keys = roundrobin_keys(2)
+local now = current_time(ARGV[1])
+enable_events(keys, ARGV[6], ARGV[7])
+if not last_element(keys, now, false) then
+    return false
+end
+local item = redis.call("RPOPLPUSH", keys.queue, keys.queue)
+if ARGV[3] == "1" then
+    record_dispatch(keys.stats, item, now, 0)
+end
+record_event(keys, item, now, 0)
+return {item, "0", string.format("%.17g", now), redis.call("RPOP", KEYS[1])}
+""")
+
+# Put a failed job back on the jobs queue (KEYS[1]) or on the failed jobs queue
+# (KEYS[3]) if it has failed max_attempts (ARGV[2]) times
+RETRY = register_script("""
+if ARGV[2] ~= "" then
+    local attempts = redis.call("HINCRBY", KEYS[2], ARGV[1], 1)
+    if attempts >= tonumber(ARGV[2]) then
+        redis.call("HDEL", KEYS[2], ARGV[1])
+        redis.call("LPUSH", KEYS[3], ARGV[1])
+        return 0
+    end
+end
+redis.call("LPUSH", KEYS[1], ARGV[1])
+return 1
+""")
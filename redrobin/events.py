@@ -0,0 +1,72 @@
+from collections import defaultdict, deque, namedtuple
+
+
+DispatchEvent = namedtuple('DispatchEvent', 'id member worker ready_at wait')
+
+
+class EventReader(object):
+    """Consumer of the dispatch events stream of a scheduler.
+
+    The events read by :meth:`poll` are aggregated incrementally into the
+    number of dispatches of each member and worker over the last ``window``
+    seconds, so the rates are not recomputed from the whole stream.
+    """
+
+    def __init__(self, scheduler, window=60, last_id='0'):
+        self.scheduler = scheduler
+        self.window = window
+        self.last_id = last_id
+        # events in the window, in dispatch order
+        self._events = deque()
+        self.counts = defaultdict(int)
+        self.worker_counts = defaultdict(int)
+
+    def poll(self, count=1000, block=None):
+        """Read up to ``count`` new events, waiting up to ``block`` seconds for
+        one if there is none, and return them.
+        """
+        args = ['XREAD', 'COUNT', count]
+        if block is not None:
+            args += ['BLOCK', int(block * 1000)]
+        args += ['STREAMS', self.scheduler.events_key, self.last_id]
+        response = self.scheduler.read_redis.execute_command(*args)
+        events = []
+        for _, entries in response or []:
+            for event_id, fields in entries:
+                fields = dict(zip(fields[::2], fields[1::2]))
+                event = DispatchEvent(event_id,
+                                      self.scheduler._stats_member_loads(fields['member']),
+                                      fields['worker'] or None,
+                                      float(fields['ready_at']), float(fields['wait']))
+                self._add(event)
+                events.append(event)
+                self.last_id = event_id
+        return events
+
+    def rates(self, now=None):
+        """Return the dispatches per second of each member over the window."""
+        self._expire(now)
+        return {member: float(count) / self.window
+                for member, count in self.counts.iteritems()}
+
+    def worker_rates(self, now=None):
+        """Return the dispatches per second of each worker over the window."""
+        self._expire(now)
+        return {worker: float(count) / self.window
+                for worker, count in self.worker_counts.iteritems()}
+
+    def _add(self, event):
+        self._events.append(event)
+        self.counts[event.member] += 1
+        self.worker_counts[event.worker] += 1
+
+    def _expire(self, now):
+        if now is None:
+            now = self.scheduler.time()
+        while self._events and self._events[0].ready_at <= now - self.window:
+            event = self._events.popleft()
+            for counts, key in ((self.counts, event.member),
+                                (self.worker_counts, event.worker)):
+                counts[key] -= 1
+                if not counts[key]:
+                    del counts[key]
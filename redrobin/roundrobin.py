@@ -1,55 +1,234 @@
+import collections
 import json
 import itertools as it
+
 import redis_collections
 
+from .base import SchedulerMixin, SNAPSHOT_TEMP_TTL
+from .scripts import register_script
+from .utils import chunked, lismember, ring_add
+from .utils import CLOCK_FUNCTIONS, STATS_FUNCTIONS, EXPIRY_FUNCTIONS, RING_FUNCTIONS
+
 
-class RoundRobinScheduler(redis_collections.RedisCollection):
+class RoundRobinScheduler(SchedulerMixin, redis_collections.RedisCollection):
+
+    # whether the queue elements are (item, throttled_until) pairs
+    _throttled_elements = False
 
     # queue is stored in reverse element order, i.e. items are added with lpush
     # and removed with rpop
     redis_queue_format = 'redrobin:{name}:items'
+    # hash of dispatch statistics
+    redis_stats_format = 'redrobin:{name}:items:stats'
+    # consistent hash ring of the items
+    redis_ring_format = 'redrobin:{name}:items:ring'
+    # set of items sorted by expiry time
+    redis_expiry_format = 'redrobin:{name}:items:expiry'
+    # stream of dispatch events
+    redis_events_format = 'redrobin:{name}:items:events'
 
-    def __init__(self, keys=None, connection=None, name='default'):
+    def __init__(self, keys=None, connection=None, name='default',
+                 read_connection=None, max_staleness=None, stats=False,
+                 server_clock=False, events_maxlen=0):
+        self._init_read_connections(read_connection, max_staleness)
+        self._init_clock(server_clock)
+        self.events_key = self.redis_events_format.format(name=name)
+        self.events_maxlen = events_maxlen
+        self.stats_key = self.redis_stats_format.format(name=name)
+        self.ring_key = self.redis_ring_format.format(name=name)
+        self.expiry_key = self.redis_expiry_format.format(name=name)
+        self.record_stats = stats
         queue_key = self.redis_queue_format.format(name=name)
         super(RoundRobinScheduler, self).__init__(data=keys, redis=connection,
                                                   key=queue_key, pickler=json)
 
     def __len__(self):
-        return self.redis.llen(self.key)
+        return self.read_redis.llen(self.key)
 
     def __iter__(self):
         return self._data()
 
     def __contains__(self, elem):
-        return self.redis.lismember(self.key, self._pickle(elem))
+        return lismember(self.read_redis, self.key, self._pickle(elem))
 
     def add(self, *items):
-        self.redis.lpush(self.key, *map(self._pickle, items))
+        return self._push(items, map(self._pickle, items))
 
     def remove(self, item, count=0):
-        removed_count = self.discard(item, count)
-        if not removed_count:
-            raise KeyError(item)
-        return removed_count
+        def check(removed_count):
+            if not removed_count:
+                raise KeyError(item)
+            return removed_count
+        return self._then(self.discard(item, count), check)
 
     def discard(self, item, count=0):
-        # negate count because list is stored in reverse
-        return self.redis.lrem(self.key, -count, self._pickle(item))
+        def commands(pipe):
+            # negate count because list is stored in reverse
+            pipe.lrem(self.key, -count, self._pickle(item))
+            self._forget(pipe, [item])
+        return self._mutate(commands, lambda responses: responses[0])
 
     def pop(self):
-        value = self.redis.rpop(self.key)
-        if value is None:
-            raise KeyError
-        return self._unpickle(value)
+        def commands(pipe):
+            POP(keys=self._script_keys(), args=[int(self._throttled_elements)],
+                client=pipe)
+
+        def result(responses):
+            if responses[0] is None:
+                raise KeyError
+            return self._unpickle(responses[0])
+        return self._mutate(commands, result)
+
+    def sync(self, desired, chunk_size=1000):
+        """Atomically reconcile the queue with the ``desired`` iterable of items.
+
+        Items may be repeated, so the occurrences of each item are added or
+        removed to match ``desired``. New occurrences are appended to the queue
+        in ``desired`` order. Return the ``(added, removed)`` numbers of
+        occurrences.
+        """
+        return super(RoundRobinScheduler, self).sync(desired, chunk_size)
+
+    def next(self, affinity=None):
+        """Return the next item in the roundrobin order.
 
-    def next(self):
-        item = self.redis.rpoplpush(self.key, self.key)
+        If ``affinity`` is given, the queue is not rotated and the item returned
+        is the one ``affinity`` maps to on a consistent hash ring of the items,
+        so the same ``affinity`` keeps getting the same item for as long as it
+        exists. Adding or removing items remaps only the affinities of the
+        changed items.
+        """
+        item = NEXT(keys=self._script_keys(),
+                    args=[self._script_time(), int(self.record_stats),
+                          affinity if affinity is not None else '',
+                          self.ring_replicas] + self._event_args(),
+                    client=self.redis)
         if item is None:
             raise StopIteration
         return self._unpickle(item)
 
+    def _push(self, items, elements):
+        def commands(pipe):
+            pipe.lpush(self.key, *elements)
+            pipe.zrem(self.expiry_key, *map(self._member_dumps, items))
+            self._ring_add(pipe, elements)
+        return self._mutate(commands)
+
+    def _stats_member_loads(self, member):
+        return self._unpickle(member)
+
+    def _member_dumps(self, item):
+        return json.dumps(item)
+
+    def _expireat(self, pipe, member, timestamp):
+        EXPIREAT(keys=self._script_keys(),
+                 args=[member, timestamp, int(self._throttled_elements)], client=pipe)
+
+    def _sweep(self, batch_size):
+        return SWEEP(keys=self._script_keys(),
+                     args=[self._script_time(), batch_size, int(self._throttled_elements)],
+                     client=self.redis)
+
+    def _script_keys(self):
+        # the keys of the scheduler in the order expected by roundrobin_keys()
+        return [self.key, self.stats_key, self.ring_key, self.expiry_key,
+                self.events_key]
+
+    def _sync_chunk(self, pipe, desired_key, items):
+        pipe.rpush(desired_key, *map(self._member_dumps, items))
+
+    def _sync(self, desired_key):
+        return tuple(SYNC(keys=self._script_keys() + [desired_key],
+                          args=[self._script_time(), int(self._throttled_elements),
+                                self.ring_replicas],
+                          client=self.redis))
+
+    def _snapshot_keys(self):
+        return collections.OrderedDict([('queue', self.key),
+                                        ('expiry', self.expiry_key)])
+
+    def _export_chunks(self, chunk_size):
+        elements = self._iter_queue_copy(chunk_size, 'export')
+        for chunk in chunked(elements, chunk_size):
+            records = [self._export_record(self._unpickle(element)) for element in chunk]
+            expiry = self._export_expiry([record[0] for record in records])
+            yield [record + [expires_at] if expires_at is not None else record
+                   for record, expires_at in zip(records, expiry)]
+
+    def _export_record(self, item):
+        return [item]
+
+    def _import_chunk(self, pipe, keys, records):
+        # the records are [item(, expires_at)] lists in roundrobin order
+        pipe.lpush(keys['queue'], *[self._pickle(record[0]) for record in records])
+        self._import_expiry(pipe, keys, [(record[0], record[1]) for record in records
+                                         if len(record) > 1])
+
+    def _iter_queue(self, chunk_size, key=None, connection=None):
+        # iterate over the queue elements starting from the rightmost
+        # (i.e. next in roundrobin order)
+        key = key if key is not None else self.key
+        connection = connection if connection is not None else self.read_redis
+        for start in it.count(0, chunk_size):
+            chunk = connection.lrange(key, -start - chunk_size, -start - 1)
+            for element in reversed(chunk):
+                yield element
+            if len(chunk) < chunk_size:
+                break
+
+    def _iter_queue_live(self, chunk_size):
+        # iterate over the queue elements like _iter_queue, but resume each
+        # chunk from the element that followed the previous one rather than by
+        # offset: next() rotates the rightmost elements to the left end, which
+        # moves the unread elements towards the right end. The elements are
+        # read at most once each, as many as the queue length when starting
+        remaining = self.read_redis.llen(self.key)
+        start, anchor = 0, None
+        while remaining > 0:
+            if anchor is not None:
+                start = self._find_element(anchor, start, chunk_size)
+            # read an extra element, which anchors the next chunk
+            chunk = self.read_redis.lrange(self.key, -start - chunk_size - 1, -start - 1)
+            chunk.reverse()
+            for element in chunk[:min(chunk_size, remaining)]:
+                yield element
+            remaining -= chunk_size
+            if len(chunk) <= chunk_size:
+                break
+            start, anchor = start + chunk_size, chunk[chunk_size]
+
+    def _find_element(self, element, start, chunk_size):
+        # return the current offset from the right end of the element that was
+        # at offset ``start``, looking in windows of growing size towards the
+        # right end; 0 if it was rotated away too
+        if self.read_redis.lindex(self.key, -start - 1) == element:
+            return start
+        window = chunk_size
+        while True:
+            low = max(0, start - window)
+            # elements from offset start down to offset low
+            elements = self.read_redis.lrange(self.key, -start - 1, -low - 1)
+            for i, candidate in enumerate(elements):
+                if candidate == element:
+                    return start - i
+            if low == 0:
+                return 0
+            window *= 2
+
+    def _iter_queue_copy(self, chunk_size, purpose):
+        # iterate over a copy of the queue, since paging through the queue
+        # itself would skip or repeat elements rotated by next() meanwhile
+        copy_key = self._temp_key(self.key, purpose)
+        COPY_LIST(keys=[self.key, copy_key], args=[SNAPSHOT_TEMP_TTL],
+                  client=self.redis)
+        try:
+            for element in self._iter_queue(chunk_size, copy_key, self.redis):
+                yield element
+        finally:
+            self.redis.delete(copy_key)
+
     def _data(self, pipe=None):
-        pipe = pipe if pipe is not None else self.redis
+        pipe = pipe if pipe is not None else self.read_redis
         # reverse and unpickle list items
         return it.imap(self._unpickle, reversed(pipe.lrange(self.key, 0, -1)))
 
@@ -57,3 +236,265 @@ class RoundRobinScheduler(redis_collections.RedisCollection):
         super(RoundRobinScheduler, self)._update(data, pipe)
         pipe = pipe if pipe is not None else self.redis
         pipe.lpush(self.key, *map(self._pickle, data))
+        pipe.zrem(self.expiry_key, *map(self._member_dumps, data))
+        self._ring_add(pipe, map(self._pickle, data))
+
+    def _ring_add(self, pipe, elements):
+        # the ring is used only by the affinity of unthrottled queues, whose
+        # elements are the ring members
+        if not self._throttled_elements:
+            ring_add(pipe, self.ring_key, self.ring_replicas, elements)
+
+    def _forget(self, pipe, items):
+        # clear the expiry and ring points of the items no longer in the queue
+        FORGET(keys=self._script_keys(),
+               args=[int(self._throttled_elements)] + map(self._member_dumps, items),
+               client=pipe)
+
+    def _clear(self, pipe=None):
+        pipe = pipe if pipe is not None else self.redis
+        pipe.delete(self.key, self.ring_key, self.expiry_key)
+
+
+# Lua functions for the queues of RoundRobinScheduler and its subclasses. They
+# operate on a table of the scheduler keys (see roundrobin_keys). The elements
+# of throttled queues are JSON encoded (item, timestamp) pairs; the item is
+# extracted without decoding it.
+ROUNDROBIN_FUNCTIONS = (CLOCK_FUNCTIONS + STATS_FUNCTIONS + EXPIRY_FUNCTIONS +
+                        RING_FUNCTIONS + """
+local function roundrobin_keys(first)
+    return {queue=KEYS[first], stats=KEYS[first + 1], ring=KEYS[first + 2],
+            expiry=KEYS[first + 3], events=KEYS[first + 4]}
+end
+
+local function element_item(element, throttled)
+    if throttled then
+        local item, throttled_until = string.match(element, "^%[(.*), ([^,]+)%]$")
+        return item, tonumber(throttled_until)
+    end
+    return element
+end
+
+-- Remove all the elements of the purged items from the queue
+local function purge_items(keys, purged, throttled)
+    if #purged > 0 then
+        local is_purged, removed = {}, {}
+        for _, item in ipairs(purged) do
+            is_purged[item] = true
+        end
+        for _, element in ipairs(redis.call("LRANGE", keys.queue, 0, -1)) do
+            if not removed[element] and is_purged[element_item(element, throttled)] then
+                removed[element] = true
+                redis.call("LREM", keys.queue, 0, element)
+            end
+        end
+        redis.call("ZREM", keys.expiry, unpack(purged))
+        ring_remove(keys.ring, purged)
+    end
+end
+
+-- Clear the expiry and remove the ring points of the items that no longer have
+-- elements in the queue. The queue is scanned only for items with an expiry or
+-- if the ring exists.
+local function forget_items(keys, items, throttled)
+    local ring_exists = not throttled and redis.call("EXISTS", keys.ring) == 1
+    local candidates = {}
+    for _, item in ipairs(items) do
+        if ring_exists or redis.call("ZSCORE", keys.expiry, item) then
+            table.insert(candidates, item)
+        end
+    end
+    if #candidates == 0 then
+        return
+    end
+    local remaining = {}
+    for _, element in ipairs(redis.call("LRANGE", keys.queue, 0, -1)) do
+        remaining[element_item(element, throttled)] = true
+    end
+    local forgotten = {}
+    for _, item in ipairs(candidates) do
+        if not remaining[item] then
+            table.insert(forgotten, item)
+        end
+    end
+    if #forgotten > 0 then
+        redis.call("ZREM", keys.expiry, unpack(forgotten))
+        if ring_exists then
+            ring_remove(keys.ring, forgotten)
+        end
+    end
+end
+
+-- Return the last (i.e. next) element of the queue with its item (and throttled
+-- until timestamp), popping any elements of expired items before it
+local function last_element(keys, now, throttled)
+    while true do
+        local element = redis.call("LINDEX", keys.queue, -1)
+        if not element then
+            return nil
+        end
+        local item, throttled_until = element_item(element, throttled)
+        if not is_expired(keys.expiry, item, now) then
+            return element, item, throttled_until
+        end
+        -- the rest of the elements of the item are popped when they get last
+        redis.call("RPOP", keys.queue)
+        ring_remove(keys.ring, {item})
+    end
+end
+""")
+
+
+# Rotate the queue and return the rotated item or, if an affinity is given,
+# return the item it maps to on the consistent hash ring
+NEXT = register_script(ROUNDROBIN_FUNCTIONS + """
+local keys = roundrobin_keys(1)
+local now = current_time(ARGV[1])
+enable_events(keys, ARGV[5], ARGV[6])
+local item
+if ARGV[3] ~= "" then
+    -- the ring is (re)built only from the items that have not expired
+    local get_items = function()
+        local items = {}
+        for _, element in ipairs(redis.call("LRANGE", keys.queue, 0, -1)) do
+            if not is_expired(keys.expiry, element, now) then
+                table.insert(items, element)
+            end
+        end
+        return items
+    end
+    while true do
+        item = ring_lookup(keys.ring, get_items, tonumber(ARGV[4]), ARGV[3])
+        if not item or not is_expired(keys.expiry, item, now) then
+            break
+        end
+        -- like last_element(), only the ring point is removed: the elements of
+        -- the item are popped when they get last or purged by sweep()
+        ring_remove(keys.ring, {item})
+    end
+elseif last_element(keys, now, false) then
+    item = redis.call("RPOPLPUSH", keys.queue, keys.queue)
+end
+if item then
+    if ARGV[2] == "1" then
+        record_dispatch(keys.stats, item, now, 0)
+    end
+    record_event(keys, item, now, 0)
+end
+return item
+""")
+
+
+# Purge up to ARGV[2] expired items; ARGV[3] is 1 for throttled queues
+SWEEP = register_script(ROUNDROBIN_FUNCTIONS + """
+local keys = roundrobin_keys(1)
+local purged = expired_members(keys.expiry, current_time(ARGV[1]), tonumber(ARGV[2]))
+purge_items(keys, purged, ARGV[3] == "1")
+return #purged
+""")
+
+
+# Set the expiry of item ARGV[1] to ARGV[2] if it's in the queue; ARGV[3] is 1
+# for throttled queues. Return 1 if it was set or 0 if not.
+EXPIREAT = register_script(ROUNDROBIN_FUNCTIONS + """
+local keys = roundrobin_keys(1)
+for _, element in ipairs(redis.call("LRANGE", keys.queue, 0, -1)) do
+    if element_item(element, ARGV[3] == "1") == ARGV[1] then
+        redis.call("ZADD", keys.expiry, ARGV[2], ARGV[1])
+        return 1
+    end
+end
+return 0
+""")
+
+
+# Add and remove queue elements so that the queue items are the items of the
+# list of the last key, with the same number of occurrences; ARGV[2] is 1 for
+# throttled queues and ARGV[3] the number of ring replicas. Return the numbers
+# of the added and removed elements.
+SYNC = register_script(ROUNDROBIN_FUNCTIONS + """
+local keys = roundrobin_keys(1)
+local now = current_time(ARGV[1])
+local throttled = ARGV[2] == "1"
+local desired = redis.call("LRANGE", KEYS[#KEYS], 0, -1)
+local wanted, counts = {}, {}
+for _, item in ipairs(desired) do
+    wanted[item] = (wanted[item] or 0) + 1
+end
+local elements = redis.call("LRANGE", keys.queue, 0, -1)
+for _, element in ipairs(elements) do
+    local item = element_item(element, throttled)
+    counts[item] = (counts[item] or 0) + 1
+end
+
+local removed, removed_items, added_items = 0, {}, {}
+for _, element in ipairs(elements) do
+    local item = element_item(element, throttled)
+    if counts[item] > (wanted[item] or 0) then
+        redis.call("LREM", keys.queue, 1, element)
+        counts[item] = counts[item] - 1
+        removed = removed + 1
+        if counts[item] == 0 then
+            redis.call("ZREM", keys.expiry, item)
+            table.insert(removed_items, item)
+        end
+    end
+end
+
+local added = 0
+for _, item in ipairs(desired) do
+    if (counts[item] or 0) < wanted[item] then
+        if throttled then
+            redis.call("LPUSH", keys.queue, string.format("[%s, %.17g]", item, now))
+        else
+            redis.call("LPUSH", keys.queue, item)
+        end
+        redis.call("ZREM", keys.expiry, item)
+        if not counts[item] or counts[item] == 0 then
+            table.insert(added_items, item)
+        end
+        counts[item] = (counts[item] or 0) + 1
+        added = added + 1
+    end
+end
+if not throttled then
+    ring_remove(keys.ring, removed_items)
+    ring_add(keys.ring, tonumber(ARGV[3]), added_items)
+end
+return {added, removed}
+""")
+
+
+# Pop the last (i.e. next) element of the queue and clear the expiry and ring
+# points of its item if that was its last occurrence; ARGV[1] is 1 for throttled
+# queues, whose elements are not ring members
+POP = register_script(ROUNDROBIN_FUNCTIONS + """
+local keys = roundrobin_keys(1)
+local throttled = ARGV[1] == "1"
+local element = redis.call("RPOP", keys.queue)
+if element then
+    forget_items(keys, {element_item(element, throttled)}, throttled)
+end
+return element
+""")
+
+
+# Clear the expiry and remove the ring points of the items ARGV[2], ARGV[3], ...
+# if they are no longer in the queue; ARGV[1] is 1 for throttled queues
+FORGET = register_script(ROUNDROBIN_FUNCTIONS + """
+local keys = roundrobin_keys(1)
+forget_items(keys, {unpack(ARGV, 2)}, ARGV[1] == "1")
+""")
+
+
+
+# Copy the list KEYS[1] to KEYS[2], expiring in ARGV[1] seconds
+COPY_LIST = register_script("""
+local size = redis.call("LLEN", KEYS[1])
+for start = 0, size - 1, 1000 do
+    local elements = redis.call("LRANGE", KEYS[1], start, start + 999)
+    redis.call("RPUSH", KEYS[2], unpack(elements))
+end
+redis.call("EXPIRE", KEYS[2], ARGV[1])
+return size
+""")
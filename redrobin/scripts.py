@@ -0,0 +1,128 @@
+import hashlib
+import threading
+import weakref
+
+import redis
+from redis.client import BasePipeline
+from redis.exceptions import NoScriptError
+
+
+class ScriptRegistry(object):
+    """Registry of Lua scripts that are loaded together, once per connection pool.
+
+    The scripts are run with EVALSHA and the registry reloads all of them when
+    the server doesn't know one (e.g. after a failover or a SCRIPT FLUSH).
+    """
+
+    def __init__(self):
+        self._scripts = []
+        # {connection pool: number of scripts loaded on its server}
+        self._loaded = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scripts)
+
+    def register(self, script):
+        """Register a Lua ``script`` and return a :class:`RegisteredScript`."""
+        registered = RegisteredScript(self, script)
+        with self._lock:
+            self._scripts.append(registered)
+        return registered
+
+    def get(self, script):
+        """Return the :class:`RegisteredScript` of ``script``, registering it if
+        it's not registered yet.
+        """
+        sha = hashlib.sha1(script).hexdigest()
+        with self._lock:
+            for registered in self._scripts:
+                if registered.sha == sha:
+                    return registered
+        return self.register(script)
+
+    def load(self, connection):
+        """Load all the registered scripts on the server of ``connection``."""
+        connection = _loader(connection)
+        with self._lock:
+            scripts = list(self._scripts)
+        with connection.pipeline(transaction=False) as pipe:
+            for script in scripts:
+                pipe.script_load(script.script)
+            pipe.execute()
+        self._loaded[connection.connection_pool] = len(scripts)
+
+    def ensure_loaded(self, connection):
+        """Load the registered scripts unless they are already loaded on the
+        connection pool of ``connection``.
+        """
+        if self._loaded.get(connection.connection_pool) != len(self._scripts):
+            self.load(connection)
+
+    def execute(self, pipe, raise_on_error=True):
+        """Execute the non-transactional pipeline ``pipe``, loading the scripts
+        first if the server doesn't know one of the scripts it runs.
+
+        Like ``redis.client.Pipeline.load_scripts``, the scripts are checked
+        before executing, since re-running the commands that failed with a
+        NOSCRIPT error would run them out of order.
+        """
+        shas = list(set(args[1] for args, _ in pipe.command_stack
+                        if args[0] == 'EVALSHA'))
+        if shas:
+            connection = _loader(pipe)
+            if not all(connection.script_exists(*shas)):
+                self.load(connection)
+        return pipe.execute(raise_on_error=raise_on_error)
+
+
+class RegisteredScript(object):
+    """Lua script of a :class:`ScriptRegistry`.
+
+    Like ``redis.client.Script``, but its SHA is computed locally and the script
+    is loaded by its registry. In a transaction the script is sent with EVAL,
+    since a NOSCRIPT error would not abort the rest of the transaction.
+    """
+
+    def __init__(self, registry, script):
+        self.registry = registry
+        self.script = script
+        self.sha = hashlib.sha1(script).hexdigest()
+
+    def __reduce__(self):
+        # pickle by source, since the registry holds a lock; the script is
+        # looked up in (or registered to) the registry of the unpickling process
+        return _registered_script, (self.script,)
+
+    def __call__(self, keys=[], args=[], client=None):
+        args = tuple(keys) + tuple(args)
+        if isinstance(client, BasePipeline):
+            if client.transaction or client.explicit_transaction:
+                return client.eval(self.script, len(keys), *args)
+            # NOSCRIPT errors are handled by ScriptRegistry.execute
+            self.registry.ensure_loaded(client)
+            return client.evalsha(self.sha, len(keys), *args)
+
+        self.registry.ensure_loaded(client)
+        try:
+            return client.evalsha(self.sha, len(keys), *args)
+        except NoScriptError:
+            self.registry.load(client)
+            return client.evalsha(self.sha, len(keys), *args)
+
+
+def _registered_script(script):
+    return registry.get(script)
+
+
+def _loader(connection):
+    # return a connection for loading scripts immediately, even if the given
+    # one is a pipeline
+    if isinstance(connection, BasePipeline):
+        return redis.StrictRedis(connection_pool=connection.connection_pool)
+    return connection
+
+
+# the registry of all the redrobin scripts
+registry = ScriptRegistry()
+register_script = registry.register
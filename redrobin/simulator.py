@@ -0,0 +1,166 @@
+"""Offline discrete-event simulator of the throttling schedulers.
+
+The simulator models a pool of workers that repeatedly call ``next()`` on a
+scheduler, wait for the returned key to become available and then run a job.
+It follows the dispatch rules of the Redis implementation exactly:
+
+- A :class:`~redrobin.ThrottlingScheduler` dispatches the key with the earliest
+  deadline (ties are broken by key order, which corresponds to the sorted key
+  names). A key reserved at time ``now`` is ready at
+  ``max(throttled_until, now)`` and throttled until that plus its throttle.
+- A :class:`~redrobin.ThrottlingRoundRobinScheduler` dispatches its items in
+  queue order with the same rule and a throttle shared by all items.
+
+Time is virtual, as in the ``MockTime`` model of the test suite: waiting takes
+exactly the wait time and each ``next()`` call takes ``call_overhead`` seconds.
+Many configurations are simulated at once, vectorized with NumPy, so sweeping
+thousands of them takes seconds. NumPy is an optional dependency required only
+by this module.
+"""
+
+import itertools as it
+
+import numpy as np
+
+
+class SimulationResult(object):
+    """Results of simulating ``C`` configurations for ``N`` dispatches each.
+
+    :ivar ready_at: ``(C, N)`` array of the times each dispatched key was ready.
+    :ivar waits: ``(C, N)`` array of the times the workers waited for each key.
+    :ivar keys: ``(C, N)`` array of the indexes of the dispatched keys.
+    :ivar makespan: ``(C,)`` array of the times the last job finished.
+    :ivar utilization: ``(C, K)`` array of the fraction of the makespan each key
+        was throttled, i.e. ``dispatches * throttle / makespan``.
+    """
+
+    def __init__(self, ready_at, waits, keys, makespan, utilization):
+        self.ready_at = ready_at
+        self.waits = waits
+        self.keys = keys
+        self.makespan = makespan
+        self.utilization = utilization
+
+    @property
+    def throughput(self):
+        """``(C,)`` array of the dispatches per second of each configuration."""
+        with np.errstate(divide='ignore'):
+            return self.waits.shape[1] / self.makespan
+
+    def wait_percentiles(self, q=(50, 90, 99)):
+        """Return a ``(C, len(q))`` array of the wait time percentiles."""
+        return np.percentile(self.waits, q, axis=1).T
+
+
+def simulate_throttling(throttles, num_workers, job_time=0, num_dispatches=1000,
+                        call_overhead=0, seed=None):
+    """Simulate workers using :class:`~redrobin.ThrottlingScheduler` instances.
+
+    :param throttles: ``(C, K)`` array of the key throttles of each configuration.
+        Configurations with fewer than ``K`` keys are padded with NaN.
+    :param num_workers: Number of workers of each configuration (scalar or
+        ``(C,)`` array).
+    :param job_time: Duration of each job: a scalar, a ``(C,)`` array or a
+        callable ``job_time(random_state, shape)`` returning an array of samples.
+    :param num_dispatches: Number of dispatches to simulate per configuration.
+    :param call_overhead: Duration of each ``next()`` call.
+    :param seed: Seed of the random state passed to ``job_time``.
+    """
+    throttles = np.atleast_2d(np.asarray(throttles, dtype=float))
+    deadlines = np.where(np.isnan(throttles), np.inf, 0.0)
+    throttles = np.where(np.isnan(throttles), 0.0, throttles)
+
+    def select_keys(step, deadlines):
+        return deadlines.argmin(axis=1)
+
+    return _simulate(throttles, deadlines, select_keys, num_workers, job_time,
+                     num_dispatches, call_overhead, seed)
+
+
+def simulate_throttling_roundrobin(throttle, num_keys, num_workers, job_time=0,
+                                   num_dispatches=1000, call_overhead=0, seed=None):
+    """Simulate workers using :class:`~redrobin.ThrottlingRoundRobinScheduler`
+    instances.
+
+    :param throttle: Throttle of each configuration (scalar or ``(C,)`` array).
+    :param num_keys: Number of queue items of each configuration (scalar or
+        ``(C,)`` array).
+
+    The rest of the parameters are the same as in :func:`simulate_throttling`.
+    """
+    throttle, num_keys = np.broadcast_arrays(np.asarray(throttle, dtype=float),
+                                             np.asarray(num_keys, dtype=int))
+    throttle, num_keys = np.atleast_1d(throttle), np.atleast_1d(num_keys)
+    in_queue = np.arange(num_keys.max()) < num_keys[:, np.newaxis]
+    throttles = np.where(in_queue, throttle[:, np.newaxis], 0.0)
+    deadlines = np.where(in_queue, 0.0, np.inf)
+
+    def select_keys(step, deadlines):
+        # every dispatch rotates the queue by one item
+        return step % num_keys
+
+    return _simulate(throttles, deadlines, select_keys, num_workers, job_time,
+                     num_dispatches, call_overhead, seed)
+
+
+def sweep(throttles, num_keys, num_workers, round_robin=False, **kwargs):
+    """Simulate all the combinations of ``throttles``, ``num_keys`` and
+    ``num_workers``, with the same throttle for all the keys of a configuration.
+
+    Return a ``(configs, result)`` tuple, where ``configs`` is the list of the
+    ``(throttle, num_keys, num_workers)`` combinations and ``result`` is the
+    :class:`SimulationResult` of all of them. Extra keyword arguments are passed
+    to :func:`simulate_throttling` (or :func:`simulate_throttling_roundrobin` if
+    ``round_robin`` is True).
+    """
+    configs = list(it.product(throttles, num_keys, num_workers))
+    throttle, keys, workers = (np.array(column) for column in zip(*configs))
+    if round_robin:
+        result = simulate_throttling_roundrobin(throttle, keys, workers, **kwargs)
+    else:
+        in_config = np.arange(keys.max()) < keys[:, np.newaxis]
+        key_throttles = np.where(in_config, throttle[:, np.newaxis], np.nan)
+        result = simulate_throttling(key_throttles, workers, **kwargs)
+    return configs, result
+
+
+def _simulate(throttles, deadlines, select_keys, num_workers, job_time,
+              num_dispatches, call_overhead, seed):
+    num_configs, num_keys = throttles.shape
+    num_workers = np.broadcast_to(np.asarray(num_workers, dtype=int), (num_configs,))
+    # time each worker calls next(); missing workers never do
+    call_times = np.where(np.arange(num_workers.max()) < num_workers[:, np.newaxis],
+                          0.0, np.inf)
+    job_times = _job_times(job_time, (num_configs, num_dispatches), seed)
+
+    rows = np.arange(num_configs)
+    ready_at = np.empty((num_configs, num_dispatches))
+    waits = np.empty((num_configs, num_dispatches))
+    keys = np.empty((num_configs, num_dispatches), dtype=int)
+    for step in xrange(num_dispatches):
+        # the worker calling next() first gets the next key
+        workers = call_times.argmin(axis=1)
+        now = call_times[rows, workers] + call_overhead
+        step_keys = select_keys(step, deadlines)
+        ready = np.maximum(deadlines[rows, step_keys], now)
+        deadlines[rows, step_keys] = ready + throttles[rows, step_keys]
+        call_times[rows, workers] = ready + job_times[:, step]
+        ready_at[:, step] = ready
+        waits[:, step] = ready - now
+        keys[:, step] = step_keys
+
+    makespan = (ready_at + job_times).max(axis=1)
+    counts = np.zeros((num_configs, num_keys))
+    np.add.at(counts, (rows[:, np.newaxis], keys), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        utilization = counts * throttles / makespan[:, np.newaxis]
+    return SimulationResult(ready_at, waits, keys, makespan, utilization)
+
+
+def _job_times(job_time, shape, seed):
+    if callable(job_time):
+        return np.asarray(job_time(np.random.RandomState(seed), shape), dtype=float)
+    job_time = np.asarray(job_time, dtype=float)
+    if job_time.ndim == 1:
+        job_time = job_time[:, np.newaxis]
+    return np.broadcast_to(job_time, shape)
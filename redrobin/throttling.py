@@ -1,23 +1,64 @@
 import collections
+import itertools as it
 import logging
 import json
 import time
 
 import redis_collections
-from .utils import validate_throttle, transactional
+
+from .base import SchedulerMixin, SNAPSHOT_TEMP_TTL
+from .cache import InvalidatingCache, publish_invalidation
+from .scripts import register_script
+from .utils import validate_throttle, validate_priority, transactional, max_dispatches
+from .utils import validate_stagger, stagger_offsets, validate_warmup
+from .utils import ring_add, ring_remove
+from .utils import CLOCK_FUNCTIONS, STATS_FUNCTIONS, EXPIRY_FUNCTIONS, RING_FUNCTIONS
 
 
 logger = logging.getLogger(__name__)
 
 
-class ThrottlingScheduler(redis_collections.Dict):
+class ThrottlingScheduler(SchedulerMixin, redis_collections.Dict):
+
+    # multiple of the throttle that the interval of newly admitted keys starts
+    # at, decaying linearly to the throttle over warmup_period seconds
+    warmup_factor = 1
+    warmup_period = 0
 
     # set of keys sorted by availability time
     redis_queue_format = 'redrobin:{name}:throttled_keys'
     # hash of {key: throttle}
     redis_throttles_format = 'redrobin:{name}:throttles'
+    # hash of dispatch statistics
+    redis_stats_format = 'redrobin:{name}:throttled_keys:stats'
+    # consistent hash ring of the keys
+    redis_ring_format = 'redrobin:{name}:throttled_keys:ring'
+    # set of keys sorted by expiry time
+    redis_expiry_format = 'redrobin:{name}:throttled_keys:expiry'
+    # hash of {key: priority} of the keys with non-zero priority
+    redis_priorities_format = 'redrobin:{name}:priorities'
+    # set of the priority levels in use, sorted by priority. The keys of each
+    # level are sorted by availability time in '{queue_key}:priority:{level}'
+    redis_priority_levels_format = 'redrobin:{name}:throttled_keys:priority_levels'
+    # stream of dispatch events
+    redis_events_format = 'redrobin:{name}:throttled_keys:events'
+    # hash of {key: admission timestamp}
+    redis_admitted_format = 'redrobin:{name}:throttled_keys:admitted'
+    # pub/sub channel of modified throttle keys
+    redis_invalidations_format = 'redrobin:{name}:throttles:invalidations'
 
-    def __init__(self, throttled_keys=None, connection=None, name='default'):
+    def __init__(self, throttled_keys=None, connection=None, name='default',
+                 read_connection=None, max_staleness=None, cache_size=0,
+                 cache_max_age=60, stats=False, server_clock=False, events_maxlen=0,
+                 warmup_factor=1, warmup_period=0):
+        validate_warmup(warmup_factor, warmup_period)
+        self._init_read_connections(read_connection, max_staleness)
+        self._init_clock(server_clock)
+        self.warmup_factor = warmup_factor
+        self.warmup_period = warmup_period
+        self.admitted_key = self.redis_admitted_format.format(name=name)
+        self.events_key = self.redis_events_format.format(name=name)
+        self.events_maxlen = events_maxlen
         if throttled_keys is not None:
             if not isinstance(throttled_keys, collections.Mapping):
                 throttled_keys = dict(throttled_keys)
@@ -25,57 +66,151 @@ class ThrottlingScheduler(redis_collections.Dict):
                 validate_throttle(throttle)
         throttles_key = self.redis_throttles_format.format(name=name)
         self.queue_key = self.redis_queue_format.format(name=name)
+        self.invalidations_channel = self.redis_invalidations_format.format(name=name)
+        self.stats_key = self.redis_stats_format.format(name=name)
+        self.ring_key = self.redis_ring_format.format(name=name)
+        self.expiry_key = self.redis_expiry_format.format(name=name)
+        self.priorities_key = self.redis_priorities_format.format(name=name)
+        self.priority_levels_key = self.redis_priority_levels_format.format(name=name)
+        self.record_stats = stats
+        self._cache = None
         super(ThrottlingScheduler, self).__init__(data=throttled_keys,
                                                   redis=connection,
                                                   key=throttles_key,
                                                   pickler=json)
+        if cache_size > 0:
+            self._cache = InvalidatingCache(self.redis, self.invalidations_channel,
+                                            cache_size, cache_max_age)
+
+    def __len__(self):
+        return self.read_redis.hlen(self.key)
+
+    def __iter__(self):
+        return iter(self.read_redis.hkeys(self.key))
+
+    def __contains__(self, key):
+        return self.read_redis.hexists(self.key, key)
+
+    def __getitem__(self, key):
+        throttle = self._get_throttle(key)
+        if throttle is None:
+            raise KeyError(key)
+        return throttle
+
+    def get(self, key, default=None):
+        throttle = self._get_throttle(key)
+        return throttle if throttle is not None else default
+
+    def getmany(self, *keys):
+        if self._cache is not None:
+            return map(self._get_throttle, keys)
+        return map(self._unpickle, self.read_redis.hmget(self.key, *keys))
+
+    def iteritems(self):
+        return iter(self._data())
+
+    def keys(self):
+        return self.read_redis.hkeys(self.key)
+
+    def values(self):
+        return [throttle for _, throttle in self._data()]
+
+    def itervalues(self):
+        return iter(self.values())
 
     def __setitem__(self, key, throttle):
         validate_throttle(throttle)
-        with self.redis.pipeline() as pipe:
+
+        def commands(pipe):
             pipe.hset(self.key, key, self._pickle(throttle))
-            # don't update the deadline if the key exists
-            pipe.zaddnx(self.queue_key, time.time(), key)
-            pipe.execute()
+            self._add_keys(pipe, [key])
+            pipe.zrem(self.expiry_key, key)
+            ring_add(pipe, self.ring_key, self.ring_replicas, [key])
+            self._invalidate(pipe, [key])
+        self._mutate(commands)
 
     def setdefault(self, key, throttle=None):
         validate_throttle(throttle)
-        with self.redis.pipeline() as pipe:
+
+        def commands(pipe):
             pipe.hsetnx(self.key, key, self._pickle(throttle))
-            pipe.zaddnx(self.queue_key, time.time(), key)
+            self._add_keys(pipe, [key])
             pipe.hget(self.key, key)
-            _, _, value = pipe.execute()
-            return self._unpickle(value)
+            pipe.zrem(self.expiry_key, key)
+            ring_add(pipe, self.ring_key, self.ring_replicas, [key])
+            self._invalidate(pipe, [key])
+        return self._mutate(commands, lambda responses: self._unpickle(responses[2]))
 
     def update(self, *args, **kwargs):
         throttled_keys = dict(*args, **kwargs)
         if throttled_keys:
             for throttle in throttled_keys.itervalues():
                 validate_throttle(throttle)
-            with self.redis.pipeline() as pipe:
-                self._update(throttled_keys, pipe)
-                pipe.execute()
+            return self._mutate(lambda pipe: self._update(throttled_keys, pipe))
+
+    def admit(self, throttled_keys, available_at=None, stagger=0):
+        """Add or update the keys and throttles of ``throttled_keys`` (a mapping
+        or an iterable of ``(key, throttle)`` pairs), atomically.
+
+        The keys become available at ``available_at`` (now by default) or, if
+        ``stagger`` is given, at evenly spaced times over the ``stagger`` seconds
+        after it, in iteration order. Unlike :meth:`update`, the deadlines of
+        existing keys are postponed to their admission time if that is later,
+        but they are never brought forward.
+        """
+        validate_stagger(stagger)
+        if isinstance(throttled_keys, collections.Mapping):
+            throttled_keys = throttled_keys.iteritems()
+        throttled_keys = list(throttled_keys)
+        if not throttled_keys:
+            return
+        args = [self.invalidations_channel,
+                repr(available_at) if available_at is not None else self._script_time(),
+                self.ring_replicas]
+        offsets = stagger_offsets(len(throttled_keys), stagger)
+        for (key, throttle), offset in zip(throttled_keys, offsets):
+            validate_throttle(throttle)
+            args.extend((key, self._pickle(throttle), repr(offset)))
+        self._invalidate_cache([key for key, _ in throttled_keys])
+        return self._mutate(lambda pipe: ADMIT(keys=self._script_keys(), args=args,
+                                               client=pipe),
+                            transaction=False)
+
+    def sync(self, desired, chunk_size=1000):
+        """Atomically reconcile the scheduler with the ``desired`` mapping (or
+        iterable of pairs) of keys to throttles.
+
+        New keys are added, missing keys are removed and the throttles of the
+        rest are updated, without changing their deadlines. Return the
+        ``(added, removed, updated)`` numbers of keys.
+        """
+        if isinstance(desired, collections.Mapping):
+            desired = desired.iteritems()
+        return super(ThrottlingScheduler, self).sync(desired, chunk_size)
 
     def __delitem__(self, key):
-        with self.redis.pipeline() as pipe:
+        def commands(pipe):
             pipe.hexists(self.key, key)
-            pipe.hdel(self.key, key)
-            pipe.zrem(self.queue_key, key)
-            exists, _, _ = pipe.execute()
-            if not exists:
+            self._delete_commands(pipe, key)
+
+        def result(responses):
+            if not responses[0]:
                 raise KeyError(key)
+        self._mutate(commands, result)
 
     def pop(self, key, default=redis_collections.Dict._Dict__marker):
-        with self.redis.pipeline() as pipe:
+        def commands(pipe):
             pipe.hget(self.key, key)
-            pipe.hdel(self.key, key)
-            pipe.zrem(self.queue_key, key)
-            value, existed, _ = pipe.execute()
+            self._delete_commands(pipe, key)
+
+        def result(responses):
+            value, existed = responses[:2]
             if not existed:
                 if default is redis_collections.Dict._Dict__marker:
                     raise KeyError(key)
                 return default
             return self._unpickle(value)
+        return self._mutate(commands, result)
 
     def popitem(self):
         @transactional(self.key, value_from_callable=True)
@@ -86,48 +221,93 @@ class ThrottlingScheduler(redis_collections.Dict):
                 raise KeyError
             value = pipe.hget(self.key, key)
             pipe.multi()
-            pipe.hdel(self.key, key)
-            pipe.zrem(self.queue_key, key)
+            self._delete_commands(pipe, key)
             return key, self._unpickle(value)
 
         return popitem_trans(self.redis)
 
     def discard(self, *keys):
-        with self.redis.pipeline() as pipe:
-            pipe.hdel(self.key, *keys)
-            pipe.zrem(self.queue_key, *keys)
-            return pipe.execute()[0]
+        return self._mutate(lambda pipe: self._delete_commands(pipe, *keys),
+                            lambda responses: responses[0])
+
+    def get_priority(self, key):
+        """Return the priority of ``key`` (0 by default)."""
+        priority = self.read_redis.hget(self.priorities_key, key)
+        return int(priority) if priority is not None else 0
+
+    def set_priority(self, key, priority):
+        """Set the priority of ``key``.
+
+        :meth:`next` returns the available key with the highest priority or, if
+        no key is available, the earliest available key. Keys of equal priority
+        are returned in order of availability.
+        """
+        validate_priority(priority)
+
+        def result(responses):
+            if not responses[0]:
+                raise KeyError(key)
+        return self._mutate(lambda pipe: SET_PRIORITY(keys=self._script_keys(),
+                                                      args=[key, priority],
+                                                      client=pipe),
+                            result, transaction=False)
+
+    def priorities(self):
+        """Return a ``{key: priority}`` dict of the keys with non-zero priority."""
+        return {key: int(priority) for key, priority in
+                self.read_redis.hgetall(self.priorities_key).iteritems()}
 
     def throttled_until(self):
         # get the first (i.e. earliest available) key
-        throttled_keys = self.redis.zrange(self.queue_key, 0, 0, withscores=True)
+        throttled_keys = self.read_redis.zrange(self.queue_key, 0, 0, withscores=True)
         if throttled_keys:
             throttled_until = throttled_keys[0][1]
-            if time.time() < throttled_until:
+            if self.time() < throttled_until:
                 return throttled_until
 
-    def next(self, wait=True):
-        @transactional(self.queue_key, value_from_callable=True)
-        def next_trans(pipe, wait):
-            # get the first (i.e. earliest available) key
-            throttled_keys = pipe.zrange(self.queue_key, 0, 0, withscores=True)
-            if not throttled_keys:
-                raise StopIteration
-            key, throttled_until = throttled_keys[0]
-
-            # if it's not throttled or we're waiting, update the queue with the
-            # throttled until timestamp
-            wait_time = throttled_until - time.time()
-            if wait_time <= 0 or wait:
-                throttle = self._unpickle(pipe.hget(self.key, key))
-                throttled_until = max(throttled_until, time.time()) + throttle
-                pipe.multi()
-                pipe.zadd(self.queue_key, throttled_until, key)
-            return key, wait_time
-
-        item, wait_time = next_trans(self.redis, wait)
+    def peek(self, n=1):
+        """Return the ``(key, throttled_until)`` pairs of the ``n`` earliest
+        available keys, without reserving them.
+        """
+        if n < 1:
+            return []
+        return self.read_redis.zrange(self.queue_key, 0, n - 1, withscores=True)
+
+    def schedule(self, horizon, chunk_size=1000):
+        """Iterate over the ``(key, throttled_until)`` pairs of the keys that are
+        or become available in the next ``horizon`` seconds, in availability order.
+
+        Keys are read from ``read_redis`` in chunks of ``chunk_size``, so the
+        schedule is a live view rather than a snapshot: a key reserved meanwhile
+        is listed once, with the first of its deadlines that is read.
+        """
+        chunks = self._schedule_chunks(self.time() + horizon, chunk_size)
+        return it.chain.from_iterable(chunks)
+
+    def capacity(self, period, chunk_size=1000):
+        """Return the maximum number of dispatches in the next ``period`` seconds."""
+        now = self.time()
+        schedule = (
+            (throttled_until, throttle)
+            for chunk in self._schedule_chunks(now + period, chunk_size)
+            for (_, throttled_until), throttle in zip(chunk, self.getmany(
+                *[key for key, _ in chunk]))
+            if throttle is not None
+        )
+        return max_dispatches(schedule, now, now + period)
+
+    def next(self, wait=True, affinity=None):
+        """Return the earliest available key, waiting for it if it's throttled
+        and ``wait`` is True or returning None otherwise.
+
+        If ``affinity`` is given, the key it maps to on a consistent hash ring of
+        the keys is preferred if it's available; otherwise the earliest available
+        key is returned instead. Adding or removing keys remaps only the
+        affinities of the changed keys.
+        """
+        item, wait_time, ready_at = self._reserve(None if wait else 0, affinity)
         if wait_time > 0:
-            if wait:
+            if ready_at is not None:
                 logger.debug("Waiting %s for %.2fs", item, wait_time)
                 time.sleep(wait_time)
             else:
@@ -136,15 +316,633 @@ class ThrottlingScheduler(redis_collections.Dict):
 
         return item
 
+    def next_distinct(self, k, wait=True):
+        """Return a list of ``k`` distinct keys, reserved together atomically.
+
+        The keys with the ``k`` earliest deadlines are reserved and all of them
+        become available when the latest of them does. If there are fewer than
+        ``k`` keys, StopIteration is raised. If ``wait`` is False and the keys
+        are throttled, nothing is reserved and None is returned.
+        """
+        if k < 1:
+            raise ValueError("k must be a positive integer ({!r} given)".format(k))
+        result = RESERVE_DISTINCT(keys=self._script_keys(),
+                                  args=[self._script_time(), '' if wait else 0,
+                                        int(self.record_stats), k,
+                                        self.invalidations_channel] + self._event_args()
+                                       + [self.warmup_factor, self.warmup_period],
+                                  client=self.redis)
+        if result is None:
+            raise StopIteration
+        wait_time, reserved, keys = float(result[0]), result[1], result[2:]
+        if wait_time > 0:
+            if reserved:
+                logger.debug("Waiting %s for %.2fs", keys, wait_time)
+                time.sleep(wait_time)
+            else:
+                logger.debug("Not waiting %s for %.2fs", keys, wait_time)
+                keys = None
+        return keys
+
+    def reserve(self, max_wait=None, affinity=None):
+        """Reserve the earliest available key without waiting for it.
+
+        Return a ``(key, ready_at)`` tuple, where ``ready_at`` is the timestamp
+        after which the reserved key may be used. If the key is throttled for
+        more than ``max_wait`` seconds nothing is reserved and None is returned.
+        ``affinity`` has the same meaning as in :meth:`next`.
+        """
+        key, _, ready_at = self._reserve(max_wait, affinity)
+        if ready_at is not None:
+            return key, ready_at
+
+    def _reserve(self, max_wait, affinity=None):
+        result = RESERVE(keys=self._script_keys(),
+                         args=[self._script_time(),
+                               repr(max_wait) if max_wait is not None else '',
+                               int(self.record_stats),
+                               affinity if affinity is not None else '',
+                               self.ring_replicas,
+                               self.invalidations_channel] + self._event_args()
+                              + [self.warmup_factor, self.warmup_period],
+                         client=self.redis)
+        if result is None:
+            raise StopIteration
+        key, wait_time, ready_at = result[0], float(result[1]), None
+        if len(result) > 2:
+            ready_at = float(result[2])
+        return key, wait_time, ready_at
+
+    def _add_keys(self, pipe, keys):
+        # queue the new keys as available now; the deadlines and admission
+        # times of the existing keys are not updated
+        ADD_KEYS(keys=[self.queue_key, self.admitted_key], args=[repr(self.time())] + keys,
+                 client=pipe)
+
+    def _expireat(self, pipe, key, timestamp):
+        EXPIREAT(keys=[self.key, self.expiry_key], args=[key, timestamp], client=pipe)
+
+    def _sweep(self, batch_size):
+        return SWEEP(keys=self._script_keys(),
+                     args=[self._script_time(), batch_size, self.invalidations_channel],
+                     client=self.redis)
+
+    def _script_keys(self):
+        # the keys of the scheduler in the order expected by throttling_keys()
+        return [self.queue_key, self.key, self.stats_key, self.ring_key,
+                self.expiry_key, self.priorities_key, self.priority_levels_key,
+                self.events_key, self.admitted_key]
+
+    def _schedule_chunks(self, until, chunk_size):
+        # page from the last score read rather than by offset, since next()
+        # moves the reserved keys further in the queue: the keys read again
+        # after they were moved are skipped, and the keys read with the last
+        # score are read again (and skipped) instead of being counted by an
+        # offset that their moves would invalidate
+        seen = set()
+        min_score, ties = '-inf', 0
+        while True:
+            chunk = self.read_redis.zrangebyscore(self.queue_key, min_score, until,
+                                                  start=0, num=chunk_size + ties,
+                                                  withscores=True)
+            new = [(key, score) for key, score in chunk if key not in seen]
+            if new:
+                seen.update(key for key, _ in new)
+                yield new
+            if len(chunk) < chunk_size + ties:
+                break
+            min_score = chunk[-1][1]
+            ties = sum(1 for _, score in chunk if score == min_score)
+
+    def _copy_queue(self, purpose):
+        copy_key = self._temp_key(self.queue_key, purpose)
+        with self.redis.pipeline() as pipe:
+            pipe.zunionstore(copy_key, [self.queue_key])
+            pipe.expire(copy_key, SNAPSHOT_TEMP_TTL)
+            pipe.execute()
+        return copy_key
+
+    def __getstate__(self):
+        state = super(ThrottlingScheduler, self).__getstate__()
+        if self._cache is not None:
+            state['_cache'] = (self._cache.maxsize, self._cache.max_age)
+        return state
+
+    def __setstate__(self, state):
+        super(ThrottlingScheduler, self).__setstate__(state)
+        if self._cache is not None:
+            self._cache = InvalidatingCache(self.redis, self.invalidations_channel,
+                                            *self._cache)
+
+    def _after_fork(self):
+        super(ThrottlingScheduler, self)._after_fork()
+        if self._cache is not None:
+            # the listener thread of the cache was not forked
+            self._cache = InvalidatingCache(self._redis, self.invalidations_channel,
+                                            self._cache.maxsize, self._cache.max_age)
+
+    def _get_throttle(self, key):
+        if self._cache is not None:
+            # cache misses are loaded from the primary: a lagging read replica
+            # could serve a value older than an invalidation just received
+            return self._cache.get(key, lambda key: self._unpickle(
+                self.redis.hget(self.key, key)))
+        return self._unpickle(self.read_redis.hget(self.key, key))
+
+    def _stats_throttles(self, keys):
+        return self.getmany(*keys) if keys else []
+
+    def _delete_commands(self, pipe, *keys):
+        # queue the commands deleting keys; the first one returns the number of
+        # deleted keys
+        pipe.hdel(self.key, *keys)
+        pipe.zrem(self.queue_key, *keys)
+        pipe.hdel(self.priorities_key, *keys)
+        pipe.hdel(self.admitted_key, *keys)
+        pipe.zrem(self.expiry_key, *keys)
+        ring_remove(pipe, self.ring_key, keys)
+        self._invalidate(pipe, keys)
+
+    def _invalidate(self, pipe, keys=None):
+        # invalidate the local throttle caches
+        keys = list(keys) if keys is not None else None
+        publish_invalidation(pipe, self.invalidations_channel, keys)
+        self._invalidate_cache(keys)
+        if keys is None:
+            # the keys or priorities were replaced altogether
+            self._invalidate_ring(pipe)
+            REBUILD_PRIORITY_LEVELS(keys=self._script_keys(), client=pipe)
+
+    def _sync_chunk(self, pipe, desired_key, throttled_keys):
+        for _, throttle in throttled_keys:
+            validate_throttle(throttle)
+        pipe.hmset(desired_key, {key: self._pickle(throttle)
+                                 for key, throttle in throttled_keys})
+
+    def _sync(self, desired_key):
+        result = SYNC(keys=self._script_keys() + [desired_key],
+                      args=[self._script_time(), self.invalidations_channel,
+                            self.ring_replicas],
+                      client=self.redis)
+        self._invalidate_cache()
+        return tuple(result)
+
+    def _invalidate_cache(self, keys=None):
+        # the own cache is invalidated directly, without waiting for the
+        # published invalidation to be delivered
+        if self._cache is not None:
+            self._cache.invalidate(keys)
+
+    def _snapshot_keys(self):
+        return collections.OrderedDict([('queue', self.queue_key),
+                                        ('throttles', self.key),
+                                        ('expiry', self.expiry_key),
+                                        ('priorities', self.priorities_key),
+                                        ('admitted', self.admitted_key)])
+
+    def _export_chunks(self, chunk_size):
+        # export a copy of the queue since next() updates the deadlines
+        export_key = self._copy_queue('export')
+        try:
+            for start in it.count(0, chunk_size):
+                chunk = self.redis.zrange(export_key, start, start + chunk_size - 1,
+                                          withscores=True)
+                if chunk:
+                    keys = [key for key, _ in chunk]
+                    with self.redis.pipeline(transaction=False) as pipe:
+                        pipe.hmget(self.key, *keys)
+                        pipe.hmget(self.priorities_key, *keys)
+                        pipe.hmget(self.admitted_key, *keys)
+                        throttles, priorities, admitted = pipe.execute()
+                    expiry = self._export_expiry(keys)
+                    # skip the keys deleted since the queue was copied
+                    yield [self._export_record(key, self._unpickle(throttle),
+                                               throttled_until, priority, expires_at,
+                                               admitted_at)
+                           for (key, throttled_until), throttle, priority, expires_at,
+                           admitted_at in zip(chunk, throttles, priorities, expiry,
+                                              admitted)
+                           if throttle is not None]
+                if len(chunk) < chunk_size:
+                    break
+        finally:
+            self.redis.delete(export_key)
+
+    def _export_record(self, key, throttle, throttled_until, priority, expires_at,
+                       admitted_at):
+        record = [key, throttle, throttled_until,
+                  int(priority) if priority is not None else None, expires_at,
+                  float(admitted_at) if admitted_at is not None else None]
+        # omit the trailing missing fields
+        while record[-1] is None:
+            record.pop()
+        return record
+
+    def _import_chunk(self, pipe, keys, records):
+        # the records are (key, throttle, throttled_until[, priority[, expires_at
+        # [, admitted_at]]]) tuples, with None for the missing optional fields
+        priorities, admitted = {}, {}
+        for record in records:
+            validate_throttle(record[1])
+            if len(record) > 3 and record[3] is not None:
+                validate_priority(record[3])
+                priorities[record[0]] = record[3]
+            if len(record) > 5:
+                admitted[record[0]] = repr(record[5])
+        pipe.hmset(keys['throttles'], {record[0]: self._pickle(record[1])
+                                       for record in records})
+        pipe.zadd(keys['queue'], *it.chain.from_iterable(
+            (record[2], record[0]) for record in records))
+        if priorities:
+            pipe.hmset(keys['priorities'], priorities)
+        if admitted:
+            pipe.hmset(keys['admitted'], admitted)
+        self._import_expiry(pipe, keys, [(record[0], record[4]) for record in records
+                                         if len(record) > 4 and record[4] is not None])
+
+    def _data(self, pipe=None):
+        if pipe is not None:
+            return super(ThrottlingScheduler, self)._data(pipe)
+        if self._cache is not None:
+            return self._cache.get_all(
+                lambda: super(ThrottlingScheduler, self)._data(self.redis))
+        return super(ThrottlingScheduler, self)._data(self.read_redis)
 
     def _clear(self, pipe=None):
         pipe = pipe if pipe is not None else self.redis
-        pipe.delete(self.key, self.queue_key)
+        pipe.delete(self.key, self.queue_key, self.expiry_key, self.priorities_key,
+                    self.admitted_key)
+        self._invalidate(pipe)
 
     def _update(self, throttled_keys, pipe=None):
         pipe = pipe if pipe is not None else self.redis
         super(ThrottlingScheduler, self)._update(throttled_keys, pipe)
-        now = time.time()
-        items = {key: now for key in throttled_keys.iterkeys()}
-        # don't update the deadlines of existing keys
-        pipe.zaddnx(self.queue_key, **items)
+        self._add_keys(pipe, list(throttled_keys))
+        pipe.zrem(self.expiry_key, *throttled_keys.iterkeys())
+        ring_add(pipe, self.ring_key, self.ring_replicas, list(throttled_keys))
+        self._invalidate(pipe, throttled_keys.iterkeys())
+
+
+# Lua functions for reserving the keys of a ThrottlingScheduler. They operate on
+# a table of the scheduler keys and invalidations channel (see throttling_keys).
+THROTTLING_FUNCTIONS = (CLOCK_FUNCTIONS + STATS_FUNCTIONS + EXPIRY_FUNCTIONS +
+                        RING_FUNCTIONS + """
+local function throttling_keys(first, channel)
+    return {queue=KEYS[first], throttles=KEYS[first + 1], stats=KEYS[first + 2],
+            ring=KEYS[first + 3], expiry=KEYS[first + 4], priorities=KEYS[first + 5],
+            levels=KEYS[first + 6], events=KEYS[first + 7], admitted=KEYS[first + 8],
+            channel=channel}
+end
+
+-- Enable the warm-up of newly admitted keys: their interval starts at factor
+-- times their throttle and decays linearly to it over period seconds
+local function enable_warmup(keys, factor, period)
+    keys.warmup_factor = tonumber(factor)
+    keys.warmup_period = tonumber(period)
+end
+
+-- Return the interval of the key dispatched at the given time
+local function key_interval(keys, key, at)
+    local throttle = tonumber(redis.call("HGET", keys.throttles, key))
+    if keys.warmup_period and keys.warmup_period > 0 and keys.warmup_factor > 1 then
+        local admitted = redis.call("HGET", keys.admitted, key)
+        if admitted then
+            local remaining = 1 - (at - tonumber(admitted)) / keys.warmup_period
+            if remaining > 0 then
+                return throttle * (1 + (keys.warmup_factor - 1) * math.min(remaining, 1))
+            end
+        end
+    end
+    return throttle
+end
+
+local function level_key(keys, level)
+    return keys.queue .. ":priority:" .. level
+end
+
+-- Update the score of the key in the queue and in its priority level (if any)
+local function set_deadline(keys, key, deadline)
+    redis.call("ZADD", keys.queue, deadline, key)
+    local level = redis.call("HGET", keys.priorities, key)
+    if level then
+        redis.call("ZADD", level_key(keys, level), deadline, key)
+    end
+end
+
+local function purge_keys(keys, purged)
+    if #purged > 0 then
+        redis.call("ZREM", keys.queue, unpack(purged))
+        redis.call("HDEL", keys.throttles, unpack(purged))
+        redis.call("ZREM", keys.expiry, unpack(purged))
+        redis.call("HDEL", keys.priorities, unpack(purged))
+        redis.call("HDEL", keys.admitted, unpack(purged))
+        ring_remove(keys.ring, purged)
+        redis.call("PUBLISH", keys.channel, cjson.encode(purged))
+    end
+end
+
+-- Return the k first (i.e. earliest available) keys of the queue with their
+-- scores, purging any expired keys before them
+local function first_keys(keys, now, k)
+    while true do
+        local first = redis.call("ZRANGE", keys.queue, 0, k - 1, "WITHSCORES")
+        local purged = {}
+        for i = 1, #first, 2 do
+            if is_expired(keys.expiry, first[i], now) then
+                table.insert(purged, first[i])
+            end
+        end
+        if #purged == 0 then
+            return first
+        end
+        purge_keys(keys, purged)
+    end
+end
+
+-- Return the available key with the highest priority and its score or nil if
+-- there is none. Entries of removed, reprioritized or expired keys are dropped
+-- from the priority levels lazily.
+local function first_priority_key(keys, now)
+    for _, level in ipairs(redis.call("ZREVRANGE", keys.levels, 0, -1)) do
+        local level_queue = level_key(keys, level)
+        while true do
+            local first = redis.call("ZRANGEBYSCORE", level_queue, "-inf", now,
+                                     "WITHSCORES", "LIMIT", 0, 1)
+            if #first == 0 then
+                break
+            end
+            local key = first[1]
+            if is_expired(keys.expiry, key, now) then
+                purge_keys(keys, {key})
+            elseif redis.call("HGET", keys.priorities, key) == level then
+                return key, tonumber(first[2])
+            end
+            redis.call("ZREM", level_queue, key)
+        end
+        if redis.call("EXISTS", level_queue) == 0 then
+            redis.call("ZREM", keys.levels, level)
+        end
+    end
+end
+
+-- Return the available key with the highest priority or the first (i.e.
+-- earliest available) key of the queue and its score, or nil if it's empty
+local function next_key(keys, now)
+    local key, throttled_until = first_priority_key(keys, now)
+    if not key then
+        local first = first_keys(keys, now, 1)
+        key, throttled_until = first[1], tonumber(first[2])
+    end
+    return key, throttled_until
+end
+
+-- Reserve the key if it's not throttled for more than max_wait (if not empty)
+-- and update its score with the next throttled until timestamp. Return
+-- {key, wait_time, ready_at} if it was reserved or {key, wait_time} otherwise.
+local function reserve_key(keys, key, throttled_until, now, max_wait, record_stats)
+    local wait_time = throttled_until - now
+    if max_wait ~= "" and wait_time > tonumber(max_wait) then
+        if record_stats == "1" then
+            record_miss(keys.stats, key, now)
+        end
+        return {key, string.format("%.17g", wait_time)}
+    end
+
+    local ready_at = math.max(throttled_until, now)
+    set_deadline(keys, key, ready_at + key_interval(keys, key, ready_at))
+    if record_stats == "1" then
+        record_dispatch(keys.stats, key, ready_at, wait_time)
+    end
+    record_event(keys, key, ready_at, wait_time)
+    return {key, string.format("%.17g", wait_time), string.format("%.17g", ready_at)}
+end
+""")
+
+
+# Reserve the key the affinity maps to on the consistent hash ring if that is
+# available or else the next key (see next_key).
+RESERVE = register_script(THROTTLING_FUNCTIONS + """
+local keys = throttling_keys(1, ARGV[6])
+local now = current_time(ARGV[1])
+enable_events(keys, ARGV[7], ARGV[8])
+enable_warmup(keys, ARGV[9], ARGV[10])
+local key, throttled_until
+if ARGV[4] ~= "" then
+    local get_keys = function() return redis.call("ZRANGE", keys.queue, 0, -1) end
+    local candidate = ring_lookup(keys.ring, get_keys, tonumber(ARGV[5]), ARGV[4])
+    if candidate then
+        if is_expired(keys.expiry, candidate, now) then
+            purge_keys(keys, {candidate})
+        else
+            local score = tonumber(redis.call("ZSCORE", keys.queue, candidate))
+            if score and score <= now then
+                key, throttled_until = candidate, score
+            end
+        end
+    end
+end
+if not key then
+    key, throttled_until = next_key(keys, now)
+    if not key then
+        return false
+    end
+end
+return reserve_key(keys, key, throttled_until, now, ARGV[2], ARGV[3])
+""")
+
+
+# Reserve the k first (i.e. earliest available) keys of the queue if the latest
+# of them is not throttled for more than max_wait (if given) and update their
+# scores with their next throttled until timestamps.
+RESERVE_DISTINCT = register_script(THROTTLING_FUNCTIONS + """
+local keys = throttling_keys(1, ARGV[5])
+local k = tonumber(ARGV[4])
+local now = current_time(ARGV[1])
+enable_events(keys, ARGV[6], ARGV[7])
+enable_warmup(keys, ARGV[8], ARGV[9])
+local first = first_keys(keys, now, k)
+if #first < 2 * k then
+    return false
+end
+local reserved_keys = {}
+for i = 1, #first, 2 do
+    table.insert(reserved_keys, first[i])
+end
+local throttled_until = tonumber(first[#first])
+local wait_time = throttled_until - now
+if ARGV[2] ~= "" and wait_time > tonumber(ARGV[2]) then
+    if ARGV[3] == "1" then
+        for _, key in ipairs(reserved_keys) do
+            record_miss(keys.stats, key, now)
+        end
+    end
+    return {string.format("%.17g", wait_time), 0, unpack(reserved_keys)}
+end
+
+local ready_at = math.max(throttled_until, now)
+for _, key in ipairs(reserved_keys) do
+    set_deadline(keys, key, ready_at + key_interval(keys, key, ready_at))
+    if ARGV[3] == "1" then
+        record_dispatch(keys.stats, key, ready_at, wait_time)
+    end
+    record_event(keys, key, ready_at, wait_time)
+end
+return {string.format("%.17g", wait_time), 1, unpack(reserved_keys)}
+""")
+
+
+# Add or update keys ARGV[4], ARGV[7], ... with throttles ARGV[5], ARGV[8], ...
+# available at the time ARGV[2] plus offsets ARGV[6], ARGV[9], ... The deadlines
+# of existing keys are only postponed. ARGV[3] is the number of ring replicas.
+ADMIT = register_script(THROTTLING_FUNCTIONS + """
+local keys = throttling_keys(1, ARGV[1])
+local available_at = current_time(ARGV[2])
+local admitted, added = {}, {}
+for i = 4, #ARGV, 3 do
+    local key, deadline = ARGV[i], available_at + tonumber(ARGV[i + 2])
+    if redis.call("HSET", keys.throttles, key, ARGV[i + 1]) == 1 then
+        redis.call("HSET", keys.admitted, key, string.format("%.17g", deadline))
+        table.insert(added, key)
+    end
+    local score = redis.call("ZSCORE", keys.queue, key)
+    if not score or tonumber(score) < deadline then
+        set_deadline(keys, key, deadline)
+    end
+    redis.call("ZREM", keys.expiry, key)
+    table.insert(admitted, key)
+end
+ring_add(keys.ring, tonumber(ARGV[3]), added)
+redis.call("PUBLISH", keys.channel, cjson.encode(admitted))
+return #admitted
+""")
+
+
+# Add, remove and update the keys so that the throttles hash equals the hash
+# of the last key; ARGV[3] is the number of ring replicas. Return the numbers of
+# the added, removed and updated keys.
+SYNC = register_script(THROTTLING_FUNCTIONS + """
+local keys = throttling_keys(1, ARGV[2])
+local now = current_time(ARGV[1])
+local desired = redis.call("HGETALL", KEYS[#KEYS])
+local wanted = {}
+for i = 1, #desired, 2 do
+    wanted[desired[i]] = desired[i + 1]
+end
+
+local changed, removed_keys, added_keys = {}, {}, {}
+for _, key in ipairs(redis.call("HKEYS", keys.throttles)) do
+    if not wanted[key] then
+        redis.call("HDEL", keys.throttles, key)
+        redis.call("ZREM", keys.queue, key)
+        redis.call("ZREM", keys.expiry, key)
+        redis.call("HDEL", keys.priorities, key)
+        redis.call("HDEL", keys.admitted, key)
+        table.insert(changed, key)
+        table.insert(removed_keys, key)
+    end
+end
+
+local updated = 0
+for i = 1, #desired, 2 do
+    local key, throttle = desired[i], desired[i + 1]
+    local current = redis.call("HGET", keys.throttles, key)
+    if tonumber(current) ~= tonumber(throttle) then
+        redis.call("HSET", keys.throttles, key, throttle)
+        if current then
+            updated = updated + 1
+        else
+            redis.call("ZADD", keys.queue, now, key)
+            redis.call("ZREM", keys.expiry, key)
+            redis.call("HSET", keys.admitted, key, string.format("%.17g", now))
+            table.insert(added_keys, key)
+        end
+        table.insert(changed, key)
+    end
+end
+ring_remove(keys.ring, removed_keys)
+ring_add(keys.ring, tonumber(ARGV[3]), added_keys)
+if #changed > 0 then
+    redis.call("PUBLISH", keys.channel, cjson.encode(changed))
+end
+return {#added_keys, #removed_keys, updated}
+""")
+
+
+# Purge up to ARGV[2] expired keys
+SWEEP = register_script(THROTTLING_FUNCTIONS + """
+local keys = throttling_keys(1, ARGV[3])
+local purged = expired_members(keys.expiry, current_time(ARGV[1]), tonumber(ARGV[2]))
+purge_keys(keys, purged)
+return #purged
+""")
+
+
+# Add the keys ARGV[2:] that are not in the queue (KEYS[1]) with the deadline
+# ARGV[1], which is also recorded as their admission time (in KEYS[2]). Return
+# the number of added keys.
+ADD_KEYS = register_script("""
+local added = 0
+for i = 2, #ARGV do
+    if not redis.call("ZSCORE", KEYS[1], ARGV[i]) then
+        redis.call("ZADD", KEYS[1], ARGV[1], ARGV[i])
+        redis.call("HSET", KEYS[2], ARGV[i], ARGV[1])
+        added = added + 1
+    end
+end
+return added
+""")
+
+
+# Set the expiry of key ARGV[1] to ARGV[2] if it's in the throttles hash
+# (KEYS[1]). Return 1 if it was set or 0 if not.
+EXPIREAT = register_script("""
+if redis.call("HEXISTS", KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call("ZADD", KEYS[2], ARGV[2], ARGV[1])
+return 1
+""")
+
+
+# Set the priority of key ARGV[1] to ARGV[2], moving it to the respective level
+SET_PRIORITY = register_script(THROTTLING_FUNCTIONS + """
+local keys = throttling_keys(1, "")
+local key, level = ARGV[1], ARGV[2]
+local score = redis.call("ZSCORE", keys.queue, key)
+if not score then
+    return 0
+end
+local old_level = redis.call("HGET", keys.priorities, key)
+if old_level then
+    redis.call("ZREM", level_key(keys, old_level), key)
+end
+if level == "0" then
+    redis.call("HDEL", keys.priorities, key)
+else
+    redis.call("HSET", keys.priorities, key, level)
+    redis.call("ZADD", level_key(keys, level), score, key)
+    redis.call("ZADD", keys.levels, level, level)
+end
+return 1
+""")
+
+
+# Rebuild the priority levels from the priorities hash and the queue
+REBUILD_PRIORITY_LEVELS = register_script(THROTTLING_FUNCTIONS + """
+local keys = throttling_keys(1, "")
+for _, level in ipairs(redis.call("ZRANGE", keys.levels, 0, -1)) do
+    redis.call("DEL", level_key(keys, level))
+end
+redis.call("DEL", keys.levels)
+local priorities = redis.call("HGETALL", keys.priorities)
+for i = 1, #priorities, 2 do
+    local key, level = priorities[i], priorities[i + 1]
+    local score = redis.call("ZSCORE", keys.queue, key)
+    if score then
+        redis.call("ZADD", level_key(keys, level), score, key)
+        redis.call("ZADD", keys.levels, level, level)
+    else
+        redis.call("HDEL", keys.priorities, key)
+    end
+end
+""")
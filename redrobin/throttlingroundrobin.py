@@ -1,8 +1,12 @@
+import itertools as it
+import json
 import logging
 import time
 
-from . import RoundRobinScheduler
-from .utils import validate_throttle, transactional
+from .roundrobin import RoundRobinScheduler, ROUNDROBIN_FUNCTIONS
+from .scripts import register_script
+from .utils import validate_throttle, transactional, max_dispatches
+from .utils import validate_stagger, stagger_offsets
 
 
 logger = logging.getLogger(__name__)
@@ -13,33 +17,79 @@ class ThrottlingRoundRobinScheduler(RoundRobinScheduler):
     # queue of (item, throttled_until) pairs. Elements are pushed to the left
     # and popped from the right so the rightmost element is the earliest available
     redis_queue_format = 'redrobin:{name}:throttled_items'
+    # throttle shared by all the schedulers with the same name
+    redis_throttle_format = 'redrobin:{name}:throttle'
+    # hash of dispatch statistics
+    redis_stats_format = 'redrobin:{name}:throttled_items:stats'
+    # consistent hash ring of the items (not used for dispatching)
+    redis_ring_format = 'redrobin:{name}:throttled_items:ring'
+    # set of items sorted by expiry time
+    redis_expiry_format = 'redrobin:{name}:throttled_items:expiry'
+    # stream of dispatch events
+    redis_events_format = 'redrobin:{name}:throttled_items:events'
 
-    def __init__(self, throttle, keys=None, connection=None, name='default'):
-        self._throttle = None
-        self.throttle = throttle
-        super(ThrottlingRoundRobinScheduler, self).__init__(keys=keys, name=name,
-                                                            connection=connection)
+    _throttled_elements = True
+
+    def __init__(self, throttle, keys=None, connection=None, name='default',
+                 read_connection=None, max_staleness=None, stats=False,
+                 server_clock=False, events_maxlen=0):
+        validate_throttle(throttle)
+        # used only if the shared throttle is missing
+        self._default_throttle = throttle
+        self.throttle_key = self.redis_throttle_format.format(name=name)
+        super(ThrottlingRoundRobinScheduler, self).__init__(
+            keys=keys, name=name, connection=connection,
+            read_connection=read_connection, max_staleness=max_staleness,
+            stats=stats, server_clock=server_clock, events_maxlen=events_maxlen)
+        # (re)initializing the items resets the shared throttle too, otherwise
+        # an existing one (e.g. retuned by another scheduler) is kept
+        if keys is not None:
+            self.redis.set(self.throttle_key, throttle)
+        else:
+            self.redis.setnx(self.throttle_key, throttle)
 
     @property
     def throttle(self):
-        return self._throttle
+        throttle = self.read_redis.get(self.throttle_key)
+        return json.loads(throttle) if throttle is not None else self._default_throttle
 
     @throttle.setter
     def throttle(self, value):
         validate_throttle(value)
-        self._throttle = value
+        self._default_throttle = value
+        self.redis.set(self.throttle_key, value)
 
     def __contains__(self, item):
         return any(it == item for it in self._data())
 
+    def add(self, *items, **kwargs):
+        """Append ``items`` to the queue.
+
+        The items become available at the ``available_at`` timestamp (now by
+        default) or, if ``stagger`` is given, at evenly spaced times over the
+        ``stagger`` seconds after it, in queue order.
+        """
+        available_at = kwargs.pop('available_at', None)
+        stagger = kwargs.pop('stagger', 0)
+        if kwargs:
+            raise TypeError("add() got an unexpected keyword argument {!r}"
+                            .format(next(iter(kwargs))))
+        validate_stagger(stagger)
+        if available_at is None:
+            available_at = self.time()
+        offsets = stagger_offsets(len(items), stagger)
+        return self._push(items, [self._pickle(item, available_at + offset)
+                                  for item, offset in zip(items, offsets)])
+
     def discard(self, item, count=0):
-        @transactional(self.key)
+        @transactional(self.key, value_from_callable=True)
         def discard_trans(pipe, item, count):
             pickled_throttled_items = pipe.lrange(self.key, 0, -1)
             indexes = [i for i, pickled in enumerate(pickled_throttled_items)
                        if self._unpickle(pickled)[0] == item]
             if not indexes:
-                return
+                return 0
+            occurrences = len(indexes)
 
             if count > 0:
                 del indexes[count:]
@@ -49,43 +99,63 @@ class ThrottlingRoundRobinScheduler(RoundRobinScheduler):
             pipe.multi()
             for i in indexes:
                 pipe.lrem(self.key, 1, pickled_throttled_items[i])
+            if len(indexes) == occurrences:
+                # the last occurrence is removed
+                pipe.zrem(self.expiry_key, self._member_dumps(item))
+            return len(indexes)
 
         # negate count because list is stored in reverse
-        return sum(discard_trans(self.redis, item, -count))
+        return discard_trans(self.redis, item, -count)
 
     def pop(self):
-        return super(ThrottlingRoundRobinScheduler, self).pop()[0]
+        return self._then(super(ThrottlingRoundRobinScheduler, self).pop(),
+                          lambda element: element[0])
 
     def throttled_until(self):
         # get the last (i.e. earliest available) item
-        throttled_items = self.redis.lrange(self.key, -1, -1)
+        throttled_items = self.read_redis.lrange(self.key, -1, -1)
         if throttled_items:
             throttled_until = self._unpickle(throttled_items[0])[1]
-            if time.time() < throttled_until:
+            if self.time() < throttled_until:
                 return throttled_until
 
+    def peek(self, n=1):
+        """Return the ``(item, available_at)`` pairs of the next ``n`` items in
+        the queue, without reserving them.
+
+        Since items are dispatched in queue order, an item becomes available no
+        earlier than its predecessor, even if it's throttled until earlier.
+        """
+        if n < 1:
+            return []
+        elements = self.read_redis.lrange(self.key, -n, -1)
+        return list(self._available_pairs(reversed(elements)))
+
+    def schedule(self, horizon, chunk_size=1000):
+        """Iterate over the ``(item, available_at)`` pairs of the items that are
+        or become available in the next ``horizon`` seconds, in queue order.
+
+        Items are read from ``read_redis`` in chunks of ``chunk_size``, so the
+        schedule is a live view rather than a snapshot: an item reserved
+        meanwhile is listed with the first of its deadlines that is read.
+        """
+        until = self.time() + horizon
+        elements = self._iter_queue_live(chunk_size)
+        return it.takewhile(lambda pair: pair[1] <= until,
+                            self._available_pairs(elements))
+
+    def capacity(self, period, chunk_size=1000):
+        """Return the maximum number of dispatches in the next ``period`` seconds."""
+        now = self.time()
+        throttle = self.throttle
+        schedule = ((available_at, throttle)
+                    for _, available_at in self.schedule(period, chunk_size))
+        return max_dispatches(schedule, now, now + period)
+
     def next(self, wait=True):
-        @transactional(self.key, value_from_callable=True)
-        def next_trans(pipe, wait):
-            # check the last (i.e. earliest available) item
-            throttled_items = pipe.lrange(self.key, -1, -1)
-            if not throttled_items:
-                raise StopIteration
-            item, throttled_until = self._unpickle(throttled_items[0])
-
-            # if it's not throttled or we're waiting, update the throttled until
-            # timestamp and push it back
-            wait_time = throttled_until - time.time()
-            if wait_time <= 0 or wait:
-                throttled_until = max(throttled_until, time.time()) + self.throttle
-                pipe.multi()
-                pipe.rpop(self.key)
-                pipe.lpush(self.key, self._pickle(item, throttled_until))
-            return item, wait_time
-
-        item, wait_time = next_trans(self.redis, wait)
+        item, wait_time, ready_at = self._reserve(None if wait else 0)
         if wait_time > 0:
-            if wait:
+            if ready_at is not None:
                 logger.debug("Waiting %s for %.2fs", item, wait_time)
                 time.sleep(wait_time)
             else:
@@ -94,10 +164,120 @@ class ThrottlingRoundRobinScheduler(RoundRobinScheduler):
 
         return item
 
+    def reserve(self, max_wait=None):
+        """Reserve the earliest available item without waiting for it.
+
+        Return an ``(item, ready_at)`` tuple, where ``ready_at`` is the timestamp
+        after which the reserved item may be used. If the item is throttled for
+        more than ``max_wait`` seconds nothing is reserved and None is returned.
+        """
+        item, _, ready_at = self._reserve(max_wait)
+        if ready_at is not None:
+            return item, ready_at
+
+    def _reserve(self, max_wait):
+        result = RESERVE(keys=self._script_keys(),
+                         args=[self._script_time(),
+                               repr(max_wait) if max_wait is not None else '',
+                               int(self.record_stats),
+                               self._default_throttle] + self._event_args(),
+                         client=self.redis)
+        if result is None:
+            raise StopIteration
+        item, wait_time, ready_at = result[0], float(result[1]), None
+        if len(result) > 2:
+            ready_at = float(result[2])
+        return self._unpickle(item), wait_time, ready_at
+
+    def _available_pairs(self, elements):
+        available_at = 0
+        for element in elements:
+            item, throttled_until = self._unpickle(element)
+            available_at = max(available_at, throttled_until)
+            yield item, available_at
+
+    def _stats_throttles(self, items):
+        return [self.throttle] * len(items)
+
+    def _script_keys(self):
+        # the keys of the scheduler in the order expected by
+        # throttling_roundrobin_keys()
+        return super(ThrottlingRoundRobinScheduler, self)._script_keys() + [
+            self.throttle_key]
+
+    def _snapshot_keys(self):
+        keys = super(ThrottlingRoundRobinScheduler, self)._snapshot_keys()
+        keys['throttle'] = self.throttle_key
+        return keys
+
+    def _snapshot_header(self):
+        return dict(throttle=self.throttle)
+
+    def _import_header(self, pipe, keys, header):
+        validate_throttle(header['throttle'])
+        pipe.set(keys['throttle'], header['throttle'])
+        self._default_throttle = header['throttle']
+
+    def _export_record(self, throttled_item):
+        return list(throttled_item)
+
+    def _import_chunk(self, pipe, keys, records):
+        # the records are [item, throttled_until(, expires_at)] lists in queue order
+        pipe.lpush(keys['queue'], *[self._pickle(record[0], record[1])
+                                    for record in records])
+        self._import_expiry(pipe, keys, [(record[0], record[2]) for record in records
+                                         if len(record) > 2])
+
     def _data(self, pipe=None):
         return (it[0] for it in super(ThrottlingRoundRobinScheduler, self)._data(pipe))
 
     def _pickle(self, data, throttled_until=None):
         if throttled_until is None:
-            throttled_until = time.time()
+            throttled_until = self.time()
         return super(ThrottlingRoundRobinScheduler, self)._pickle((data, throttled_until))
+
+
+# Lua functions for reserving the items of a ThrottlingRoundRobinScheduler. They
+# operate on a table of the scheduler keys (see throttling_roundrobin_keys).
+THROTTLING_ROUNDROBIN_FUNCTIONS = ROUNDROBIN_FUNCTIONS + """
+local function throttling_roundrobin_keys(first)
+    local keys = roundrobin_keys(first)
+    keys.throttle = KEYS[first + 5]
+    return keys
+end
+
+-- Reserve the last (i.e. earliest available) item of the queue if it's not
+-- throttled for more than max_wait (if not empty) and push it back with the
+-- next throttled until timestamp. Return {item, wait_time, ready_at} if it was
+-- reserved, {item, wait_time} if not or nil if the queue is empty.
+local function reserve_item(keys, now, max_wait, record_stats, default_throttle)
+    local element, item, throttled_until = last_element(keys, now, true)
+    if not element then
+        return nil
+    end
+    local wait_time = throttled_until - now
+    if max_wait ~= "" and wait_time > tonumber(max_wait) then
+        if record_stats == "1" then
+            record_miss(keys.stats, item, now)
+        end
+        return {item, string.format("%.17g", wait_time)}
+    end
+
+    local throttle = tonumber(redis.call("GET", keys.throttle) or default_throttle)
+    local ready_at = math.max(throttled_until, now)
+    redis.call("RPOP", keys.queue)
+    redis.call("LPUSH", keys.queue, string.format("[%s, %.17g]", item, ready_at + throttle))
+    if record_stats == "1" then
+        record_dispatch(keys.stats, item, ready_at, wait_time)
+    end
+    record_event(keys, item, ready_at, wait_time)
+    return {item, string.format("%.17g", wait_time), string.format("%.17g", ready_at)}
+end
+"""
+
+
+RESERVE = register_script(THROTTLING_ROUNDROBIN_FUNCTIONS + """
+local keys = throttling_roundrobin_keys(1)
+enable_events(keys, ARGV[5], ARGV[6])
+return reserve_item(keys, current_time(ARGV[1]), ARGV[2], ARGV[3], ARGV[4]) or false
+""")
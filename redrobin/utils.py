@@ -1,9 +1,10 @@
 import functools
+import itertools as it
 import numbers
 
-from redis import RedisError, WatchError
-from redis.client import Script
-from redis._compat import iteritems
+from redis import WatchError
+
+from .scripts import register_script
 
 
 def transactional(*watches, **trans_kwargs):
@@ -26,68 +27,246 @@ def transactional(*watches, **trans_kwargs):
     return decorator
 
 
-class RedisMixin:
+def lismember(redis, name, value):
+    """Return a boolean indicating if ``value`` is a member of list ``name``"""
+    return bool(LISMEMBER(keys=[name], args=[value], client=redis))
 
-    def zaddnx(self, name, *args, **kwargs):
-        """Like zadd but don't update the score of existing elements,
 
-        Set any number of score, element-name pairs to the key ``name``. Pairs
-        can be specified in two ways:
+LISMEMBER = register_script("""
+local value = ARGV[1]
+local items = redis.call("LRANGE", KEYS[1], 0, -1)
+for i,item in ipairs(items) do
+    if item == value then
+        return i
+    end
+end
+return 0
+""")
 
-        As *args, in the form of: score1, name1, score2, name2, ...
-        or as **kwargs, in the form of: name1=score1, name2=score2, ...
+# Lua function returning the current time: the ``now`` script argument if it's
+# not empty (client clock) or the TIME of the server otherwise (server clock).
+# It must be called before any write command since it switches the script to
+# effects replication, which is required after calling TIME on Redis < 5.
+CLOCK_FUNCTIONS = """
+local function current_time(now)
+    if now ~= "" then
+        return tonumber(now)
+    end
+    if redis.replicate_commands then
+        redis.replicate_commands()
+    end
+    local time = redis.call("TIME")
+    return tonumber(time[1]) + tonumber(time[2]) / 1000000
+end
+"""
 
-        The following example would add four values to the 'my-key' key:
-        redis.zaddnx('my-key', 1.1, 'name1', 2.2, 'name2', name3=3.3, name4=4.4)
-        """
-        pieces = []
-        if args:
-            if len(args) % 2 != 0:
-                raise RedisError("ZADDNX requires an equal number of "
-                                 "values and scores")
-            pieces.extend(args)
-        for pair in iteritems(kwargs):
-            pieces.append(pair[1])
-            pieces.append(pair[0])
+# Lua functions for updating the dispatch statistics hash of a scheduler
+STATS_FUNCTIONS = """
+local function record_dispatch(stats_key, member, dispatched_at, wait_time)
+    wait_time = math.max(wait_time, 0)
+    redis.call("HSETNX", stats_key, "since", dispatched_at)
+    redis.call("HINCRBY", stats_key, "count:" .. member, 1)
+    redis.call("HINCRBYFLOAT", stats_key, "wait:" .. member, wait_time)
+    redis.call("HSET", stats_key, "last:" .. member, dispatched_at)
+    redis.call("HINCRBY", stats_key, "total:count", 1)
+    redis.call("HINCRBYFLOAT", stats_key, "total:wait", wait_time)
+end
 
-        return ZADDNX(keys=[name], args=pieces, client=self)
+local function record_miss(stats_key, member, now)
+    redis.call("HSETNX", stats_key, "since", now)
+    redis.call("HINCRBY", stats_key, "miss:" .. member, 1)
+    redis.call("HINCRBY", stats_key, "total:miss", 1)
+end
 
-    def lismember(self, name, value):
-        """Return a boolean indicating if ``value`` is a member of list ``name``"""
-        return bool(LISMEMBER(keys=[name], args=[value], client=self))
+-- Enable appending the dispatches to the events stream of a scheduler keys
+-- table, capped to about maxlen events (disabled if maxlen is 0)
+local function enable_events(keys, maxlen, worker)
+    keys.events_maxlen = tonumber(maxlen)
+    keys.worker = worker
+end
 
+local function record_event(keys, member, ready_at, wait_time)
+    if keys.events_maxlen and keys.events_maxlen > 0 then
+        redis.call("XADD", keys.events, "MAXLEN", "~", keys.events_maxlen, "*",
+                   "member", member, "worker", keys.worker,
+                   "ready_at", string.format("%.17g", ready_at),
+                   "wait", string.format("%.17g", math.max(wait_time, 0)))
+    end
+end
+"""
+
+# Lua functions for the expiry timestamps of the scheduler members, stored in a
+# sorted set of members scored by their expiry timestamp
+EXPIRY_FUNCTIONS = """
+local function is_expired(expiry_key, member, now)
+    local expires_at = redis.call("ZSCORE", expiry_key, member)
+    return expires_at and tonumber(expires_at) <= now
+end
+
+local function expired_members(expiry_key, now, count)
+    return redis.call("ZRANGEBYSCORE", expiry_key, "-inf", now, "LIMIT", 0, count)
+end
+"""
+
+# Lua functions for dispatching by affinity through a consistent hash ring. The
+# ring is a sorted set of "{replica}:{member}" points scored by their hash and it
+# is (re)built from scratch whenever it is missing, so any modification of the
+# scheduler members can simply delete it.
+RING_FUNCTIONS = """
+local function ring_hash(value)
+    return tonumber(string.sub(redis.sha1hex(value), 1, 8), 16)
+end
 
-ZADDNX = Script(None, """
-local missing = {}
-for i = 1, #ARGV, 2 do
-    local item = ARGV[i+1]
-    if redis.call("ZSCORE", KEYS[1], item) == false then
-        local score = ARGV[i]
-        table.insert(missing, score)
-        table.insert(missing, item)
+local function zadd_ring_points(ring_key, replicas, members)
+    local points = {}
+    for _, member in ipairs(members) do
+        for replica = 1, replicas do
+            local point = replica .. ":" .. member
+            table.insert(points, ring_hash(point))
+            table.insert(points, point)
+            if #points >= 1000 then
+                redis.call("ZADD", ring_key, unpack(points))
+                points = {}
+            end
+        end
+    end
+    if #points > 0 then
+        redis.call("ZADD", ring_key, unpack(points))
     end
 end
 
-if #missing == 0 then
-    return 0
+-- Add the points of the members that are not on the ring. The ring is built
+-- in full by the first lookup, so it is maintained only once it exists.
+local function ring_add(ring_key, replicas, members)
+    if redis.call("EXISTS", ring_key) == 1 then
+        local missing = {}
+        for _, member in ipairs(members) do
+            if not redis.call("ZSCORE", ring_key, "1:" .. member) then
+                table.insert(missing, member)
+            end
+        end
+        zadd_ring_points(ring_key, replicas, missing)
+    end
 end
 
-return redis.call("ZADD", KEYS[1], unpack(missing))
-""")
+-- Remove the points (1:member, 2:member, ...) of the members from the ring
+local function ring_remove(ring_key, members)
+    if redis.call("EXISTS", ring_key) == 1 then
+        for _, member in ipairs(members) do
+            local replica = 1
+            while redis.call("ZREM", ring_key, replica .. ":" .. member) == 1 do
+                replica = replica + 1
+            end
+        end
+    end
+end
 
-LISMEMBER = Script(None, """
-local value = ARGV[1]
-local items = redis.call("LRANGE", KEYS[1], 0, -1)
-for i,item in ipairs(items) do
-    if item == value then
-        return i
+local function ring_lookup(ring_key, get_members, replicas, affinity)
+    if redis.call("EXISTS", ring_key) == 0 then
+        local seen, members = {}, {}
+        for _, member in ipairs(get_members()) do
+            if not seen[member] then
+                seen[member] = true
+                table.insert(members, member)
+            end
+        end
+        zadd_ring_points(ring_key, replicas, members)
+    end
+
+    local hash = ring_hash(affinity)
+    local point = redis.call("ZRANGEBYSCORE", ring_key, hash, "+inf", "LIMIT", 0, 1)[1]
+    if not point then
+        -- wrap around the ring
+        point = redis.call("ZRANGE", ring_key, 0, 0)[1]
+    end
+    if point then
+        return string.sub(point, string.find(point, ":", 1, true) + 1)
     end
 end
-return 0
+"""
+
+
+# Add the points of members ARGV[2], ARGV[3], ... with ARGV[1] replicas to the
+# ring KEYS[1]
+RING_ADD = register_script(RING_FUNCTIONS + """
+local members = {}
+for i = 2, #ARGV do
+    table.insert(members, ARGV[i])
+end
+ring_add(KEYS[1], tonumber(ARGV[1]), members)
 """)
 
 
+# Remove the points of members ARGV[1], ARGV[2], ... from the ring KEYS[1]
+RING_REMOVE = register_script(RING_FUNCTIONS + """
+ring_remove(KEYS[1], ARGV)
+""")
+
+
+def ring_add(redis, ring_key, replicas, members):
+    """Add ``members`` to the consistent hash ring ``ring_key`` if it exists."""
+    if members:
+        RING_ADD(keys=[ring_key], args=[replicas] + list(members), client=redis)
+
+
+def ring_remove(redis, ring_key, members):
+    """Remove ``members`` from the consistent hash ring ``ring_key``."""
+    if members:
+        RING_REMOVE(keys=[ring_key], args=list(members), client=redis)
+
+
+def max_dispatches(schedule, start, end):
+    """Return the maximum number of dispatches in the ``[start, end]`` interval.
+
+    ``schedule`` is an iterable of ``(available_at, throttle)`` pairs: each of
+    them can be dispatched at ``max(available_at, start)`` and then every
+    ``throttle`` seconds.
+    """
+    count = 0
+    for available_at, throttle in schedule:
+        available_at = max(available_at, start)
+        if available_at <= end:
+            count += int((end - available_at) // throttle) + 1
+    return count
+
+
+def chunked(iterable, size):
+    """Split ``iterable`` into lists of (at most) ``size`` elements."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(it.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
 def validate_throttle(throttle):
     if not (isinstance(throttle, numbers.Number) and throttle > 0):
         raise ValueError("throttle must be a positive number ({!r} given)"
                          .format(throttle))
+
+
+def validate_stagger(stagger):
+    if not (isinstance(stagger, numbers.Number) and stagger >= 0):
+        raise ValueError("stagger must be a non-negative number ({!r} given)"
+                         .format(stagger))
+
+
+def validate_warmup(factor, period):
+    if not (isinstance(factor, numbers.Number) and factor >= 1):
+        raise ValueError("warmup factor must be a number >= 1 ({!r} given)"
+                         .format(factor))
+    if not (isinstance(period, numbers.Number) and period >= 0):
+        raise ValueError("warmup period must be a non-negative number ({!r} given)"
+                         .format(period))
+
+
+def stagger_offsets(count, stagger):
+    """Return the offsets of ``count`` admissions spread evenly over ``stagger`` seconds."""
+    return [i * float(stagger) / count for i in xrange(count)]
+
+
+def validate_priority(priority):
+    if not (isinstance(priority, numbers.Integral) and priority >= 0):
+        raise ValueError("priority must be a non-negative integer ({!r} given)"
+                         .format(priority))
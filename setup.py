@@ -24,8 +24,10 @@ setup(
     author_email="george.sakkis@gmail.com",
     packages=find_packages(),
     install_requires=["redis", "redis-collections"],
+    extras_require={"simulator": ["numpy"]},
     tests_require=["pytest-cache", "pytest-cov", "pytest", "mock"],
     cmdclass={"test": PyTest},
+    entry_points={"console_scripts": ["redrobin = redrobin.cli:main"]},
     keywords="roundrobin throttling redis",
     classifiers=[
         "Development Status :: 3 - Alpha",
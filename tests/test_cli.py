@@ -0,0 +1,88 @@
+from StringIO import StringIO
+import time
+
+import mock
+import redrobin
+from redrobin import cli
+
+from . import BaseTestCase
+
+
+class TopTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(TopTestCase, self).setUp()
+        self.throttling = redrobin.ThrottlingScheduler(
+            {'foo': 1, 'bar': 2, 'baz': 3}, name='a:b', stats=True,
+            connection=self.test_conn)
+        self.throttling_rr = redrobin.ThrottlingRoundRobinScheduler(
+            1, ['foo', 'bar', 'foo'], name='a:b', stats=True,
+            connection=self.test_conn)
+        self.rr = redrobin.RoundRobinScheduler(['x', 'y'], name='c',
+                                               connection=self.test_conn)
+
+    def test_discover(self):
+        self.assertItemsEqual(cli.discover(self.test_conn, count=1), [
+            ('a:b', redrobin.ThrottlingScheduler),
+            ('a:b', redrobin.ThrottlingRoundRobinScheduler),
+            ('c', redrobin.RoundRobinScheduler),
+        ])
+        self.assertEqual(list(cli.discover(self.test_conn, 'redrobin:c:*')),
+                         [('c', redrobin.RoundRobinScheduler)])
+
+    def test_throttling_state(self):
+        monitor = cli.PoolMonitor(self.test_conn, 'a:b', redrobin.ThrottlingScheduler,
+                                  num_deadlines=2)
+        now = time.time()
+        state = monitor.state(now)
+        self.assertEqual((state.size, state.available, state.throttled), (3, 3, 0))
+        self.assertEqual(state.deadlines, [])
+        self.assertIsNone(state.dispatch_rate)
+
+        self.throttling.next()
+        self.throttling.next()
+        state = monitor.state(now + 0.5)
+        self.assertEqual((state.size, state.available, state.throttled), (3, 1, 2))
+        self.assertEqual([key for key, _ in state.deadlines], ['bar', 'baz'])
+        self.assertAlmostEqual(state.dispatch_rate, 4, delta=0.1)
+        self.assertEqual(state.miss_rate, 0)
+
+        self.throttling.next()
+        self.assertIsNone(self.throttling.next(wait=False))
+        state = monitor.state(now + 1)
+        self.assertEqual((state.size, state.available, state.throttled), (3, 0, 3))
+        self.assertAlmostEqual(state.dispatch_rate, 2, delta=0.1)
+        self.assertAlmostEqual(state.miss_rate, 2, delta=0.1)
+
+    def test_throttling_roundrobin_state(self):
+        monitor = cli.PoolMonitor(self.test_conn, 'a:b',
+                                  redrobin.ThrottlingRoundRobinScheduler,
+                                  chunk_size=2)
+        state = monitor.state(time.time())
+        self.assertEqual((state.size, state.available, state.throttled), (3, 3, 0))
+
+        self.throttling_rr.next()
+        self.throttling_rr.next()
+        state = monitor.state(time.time())
+        self.assertEqual((state.size, state.available, state.throttled), (3, 1, 2))
+        self.assertEqual([key for key, _ in state.deadlines], ['"foo"', '"bar"'])
+
+    def test_roundrobin_state(self):
+        monitor = cli.PoolMonitor(self.test_conn, 'c', redrobin.RoundRobinScheduler)
+        state = monitor.state()
+        self.assertEqual((state.size, state.available, state.throttled), (2, 2, 0))
+
+    def test_top(self):
+        out = StringIO()
+        cli.top(self.test_conn, interval=0, iterations=2, out=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 12)
+        for name, cls in ('a:b', redrobin.ThrottlingScheduler), ('c', redrobin.RoundRobinScheduler):
+            self.assertTrue(any(line.split()[:2] == [name, cls.__name__]
+                                for line in lines))
+
+    def test_main(self):
+        db = self.test_conn.connection_pool.connection_kwargs['db']
+        with mock.patch('sys.stdout', new_callable=StringIO) as out:
+            cli.main(['top', '--url', 'redis://localhost:6379/%d' % db, '-n', '1'])
+        self.assertIn('ThrottlingRoundRobinScheduler', out.getvalue())
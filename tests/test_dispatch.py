@@ -0,0 +1,184 @@
+import pickle
+import threading
+import time
+
+import mock
+import redrobin
+from redrobin.dispatch import run_workers
+
+from . import BaseTestCase, MockTime
+
+
+class DispatcherTestCase(BaseTestCase):
+
+    def get_dispatcher(self, scheduler, **kwargs):
+        return redrobin.Dispatcher(scheduler, name='test', **kwargs)
+
+    def test_init(self):
+        self.assertRaises(TypeError, redrobin.Dispatcher, object())
+
+    def test_put(self):
+        scheduler = redrobin.RoundRobinScheduler(['foo'], name='test',
+                                                 connection=self.test_conn)
+        dispatcher = self.get_dispatcher(scheduler)
+        self.assertEqual(len(dispatcher), 0)
+        dispatcher.put('job1', {'id': 2})
+        self.assertEqual(len(dispatcher), 2)
+        dispatcher.clear()
+        self.assertEqual(len(dispatcher), 0)
+
+    def test_next_roundrobin(self):
+        scheduler = redrobin.RoundRobinScheduler(['foo', 'bar'], name='test',
+                                                 connection=self.test_conn)
+        dispatcher = self.get_dispatcher(scheduler)
+        # no jobs: nothing is dispatched
+        self.assertIsNone(dispatcher.next())
+        self.assertEqual(scheduler.next(), 'foo')
+
+        dispatcher.put('job1', 'job2', {'id': 3})
+        self.assertEqual([dispatcher.next() for _ in xrange(4)],
+                         [('job1', 'bar'), ('job2', 'foo'), ({'id': 3}, 'bar'), None])
+
+        scheduler.clear()
+        dispatcher.put('job4')
+        self.assertRaises(StopIteration, dispatcher.next)
+        self.assertEqual(len(dispatcher), 1)
+
+    @MockTime.patch()
+    def test_next_throttling(self):
+        scheduler = redrobin.ThrottlingScheduler({'foo': 1, 'bar': 2}, name='test',
+                                                 connection=self.test_conn,
+                                                 stats=True)
+        dispatcher = self.get_dispatcher(scheduler)
+        dispatcher.put(*['job{}'.format(i) for i in xrange(5)])
+        start = time.time()
+        with self.assertAlmostInstant():
+            self.assertEqual(dispatcher.next(), ('job0', 'bar'))
+        self.assertEqual(dispatcher.next(), ('job1', 'foo'))
+
+        # throttled: nothing is dispatched
+        self.assertIsNone(dispatcher.next(wait=False))
+        self.assertIsNone(dispatcher.reserve(max_wait=0.5))
+        self.assertEqual(len(dispatcher), 3)
+
+        job, key, ready_at = dispatcher.reserve()
+        self.assertEqual((job, key), ('job2', 'foo'))
+        self.assertAlmostEqual(ready_at, start + 1, delta=0.01)
+        with self.assertTimeRange(start + 2, start + 2.01):
+            self.assertEqual(dispatcher.next(), ('job3', 'bar'))
+        self.assertEqual(scheduler.stats_summary()['count'], 4)
+        self.assertEqual(scheduler.stats_summary()['misses'], 2)
+
+    @MockTime.patch()
+    def test_next_throttling_roundrobin(self):
+        scheduler = redrobin.ThrottlingRoundRobinScheduler(
+            1, ['foo', 'bar'], name='test', connection=self.test_conn)
+        dispatcher = self.get_dispatcher(scheduler)
+        dispatcher.put('job1', 'job2', 'job3')
+        start = time.time()
+        self.assertEqual(dispatcher.next(), ('job1', 'foo'))
+        self.assertEqual(dispatcher.next(), ('job2', 'bar'))
+        self.assertIsNone(dispatcher.next(wait=False))
+        with self.assertTimeRange(start + 1, start + 1.01):
+            self.assertEqual(dispatcher.next(), ('job3', 'foo'))
+        self.assertEqual(scheduler.next(), 'bar')
+
+    def test_retry(self):
+        scheduler = redrobin.RoundRobinScheduler(['foo'], name='test',
+                                                 connection=self.test_conn)
+        dispatcher = self.get_dispatcher(scheduler, max_attempts=2)
+        dispatcher.put('job1', 'job2')
+        job, _ = dispatcher.next()
+        self.assertTrue(dispatcher.retry(job))
+        self.assertEqual([dispatcher.next()[0] for _ in xrange(2)], ['job2', 'job1'])
+        self.assertFalse(dispatcher.retry(job))
+        self.assertEqual(dispatcher.failed(), ['job1'])
+        self.assertIsNone(dispatcher.next())
+
+    def test_work(self):
+        scheduler = redrobin.RoundRobinScheduler(['foo', 'bar'], name='test',
+                                                 connection=self.test_conn)
+        dispatcher = self.get_dispatcher(scheduler, max_attempts=3)
+        dispatcher.put(*range(6))
+        handler = mock.Mock(side_effect=[None, ValueError, None, None, None, ValueError,
+                                         None, ValueError, None, None])
+        self.assertEqual(dispatcher.work(handler), 6)
+        self.assertEqual(handler.call_count, 9)
+        self.assertEqual(dispatcher.failed(), [])
+        self.assertFalse(self.test_conn.exists(dispatcher.attempts_key))
+
+    def test_run_workers(self):
+        scheduler = redrobin.ThrottlingScheduler.fromkeys(
+            ['key{}'.format(i) for i in xrange(4)], 0.05, name='test',
+            connection=self.test_conn, events_maxlen=100)
+        dispatcher = self.get_dispatcher(scheduler)
+        dispatcher.put(*range(20))
+        lock = threading.Lock()
+        dispatched = []
+
+        def handler(job, key):
+            with lock:
+                dispatched.append(job)
+
+        reader = scheduler.events()
+        run_workers(dispatcher, handler, num_threads=3)
+        self.assertItemsEqual(dispatched, range(20))
+        self.assertEqual(len(dispatcher), 0)
+        # the keys are reserved at most once per throttle period
+        events = reader.poll()
+        self.assertEqual(len(events), 20)
+        for key in scheduler:
+            ready_at = sorted(event.ready_at for event in events if event.member == key)
+            self.assertEqual(len(ready_at), 5)
+            for t1, t2 in zip(ready_at, ready_at[1:]):
+                self.assertGreaterEqual(t2 - t1, 0.05 - 1e-6)
+
+    def test_run_worker_processes(self):
+        scheduler = redrobin.RoundRobinScheduler(['foo', 'bar'], name='test',
+                                                 connection=self.test_conn)
+        dispatcher = self.get_dispatcher(scheduler)
+        dispatcher.put(*range(10))
+        done_key = 'redrobin:test:done'
+        handler = lambda job, key: self.test_conn.rpush(done_key, job)
+        run_workers(dispatcher, handler, num_processes=2, num_threads=2)
+        self.assertItemsEqual(map(int, self.test_conn.lrange(done_key, 0, -1)),
+                              range(10))
+
+    def test_pickle(self):
+        scheduler = redrobin.ThrottlingScheduler({'foo': 1}, name='test',
+                                                 connection=self.test_conn)
+        dispatcher = self.get_dispatcher(scheduler, max_attempts=2)
+        dispatcher.put('job1')
+        other = pickle.loads(pickle.dumps(dispatcher, pickle.HIGHEST_PROTOCOL))
+        # the unpickled dispatcher uses the registered script
+        self.assertIs(other._script, dispatcher._script)
+        self.assertEqual(other.max_attempts, 2)
+        self.assertEqual(other.next(), ('job1', 'foo'))
+        self.assertEqual(len(dispatcher), 0)
+
+    def test_expiry(self):
+        scheduler = redrobin.ThrottlingScheduler({'foo': 1, 'bar': 1}, name='test',
+                                                 connection=self.test_conn)
+        dispatcher = self.get_dispatcher(scheduler)
+        dispatcher.put('job1')
+        scheduler.expire('bar', 0)
+        self.assertEqual(dispatcher.next(), ('job1', 'foo'))
+        self.assertEqual(scheduler.keys(), ['foo'])
+
+    @MockTime.patch()
+    def test_server_clock(self):
+        seconds, microseconds = self.test_conn.time()
+        server_now = seconds + microseconds / 1e6
+        for scheduler in (
+                redrobin.RoundRobinScheduler(['foo'], name='test', server_clock=True,
+                                             connection=self.test_conn),
+                redrobin.ThrottlingScheduler({'foo': 1}, name='test', server_clock=True,
+                                             connection=self.test_conn),
+                redrobin.ThrottlingRoundRobinScheduler(1, ['foo'], name='test',
+                                                       server_clock=True,
+                                                       connection=self.test_conn)):
+            dispatcher = self.get_dispatcher(scheduler)
+            dispatcher.put('job1')
+            job, key, ready_at = dispatcher.reserve()
+            self.assertEqual((job, key), ('job1', 'foo'))
+            self.assertAlmostEqual(ready_at, server_now, delta=1)
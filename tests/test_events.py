@@ -0,0 +1,91 @@
+import time
+import redrobin
+
+from . import BaseTestCase, MockTime
+
+
+class EventsTestCase(BaseTestCase):
+
+    def test_disabled(self):
+        rr = redrobin.RoundRobinScheduler(['foo'], name='test', connection=self.test_conn)
+        self.assertEqual(rr.next(), 'foo')
+        self.assertFalse(self.test_conn.exists(rr.events_key))
+        self.assertEqual(rr.events().poll(), [])
+
+    @MockTime.patch()
+    def test_schedulers(self):
+        for scheduler in (
+                redrobin.RoundRobinScheduler(['foo', 'bar'], name='test',
+                                             connection=self.test_conn,
+                                             events_maxlen=100),
+                redrobin.ThrottlingScheduler({'foo': 1, 'bar': 1}, name='test',
+                                             connection=self.test_conn,
+                                             events_maxlen=100),
+                redrobin.ThrottlingRoundRobinScheduler(1, ['foo', 'bar'], name='test',
+                                                       connection=self.test_conn,
+                                                       events_maxlen=100)):
+            scheduler.worker_id = 'w1'
+            reader = scheduler.events()
+            keys = [scheduler.next(), scheduler.next()]
+            self.assertItemsEqual(keys, ['foo', 'bar'])
+            events = reader.poll()
+            self.assertEqual([event.member for event in events], keys)
+            self.assertEqual(set(event.worker for event in events), {'w1'})
+            self.assertEqual([event.wait for event in events], [0, 0])
+            self.assertEqual(reader.poll(), [])
+
+            # the next dispatch is throttled
+            if not isinstance(scheduler, redrobin.RoundRobinScheduler):
+                self.assertEqual(scheduler.next(), keys[0])
+                event, = reader.poll()
+                self.assertEqual(event.member, keys[0])
+                self.assertAlmostEqual(event.wait, 1, delta=0.01)
+                self.assertAlmostEqual(event.ready_at, time.time(), delta=0.01)
+
+    def test_default_worker(self):
+        ts = redrobin.ThrottlingScheduler({'foo': 1}, name='test',
+                                          connection=self.test_conn, events_maxlen=100)
+        self.assertEqual(ts.next(), 'foo')
+        event, = ts.events().poll()
+        host, pid, thread = event.worker.split(':')
+        self.assertEqual(thread, 'MainThread')
+
+    def test_maxlen(self):
+        rr = redrobin.RoundRobinScheduler(['foo'], name='test', connection=self.test_conn,
+                                          events_maxlen=10)
+        for _ in xrange(1000):
+            rr.next()
+        self.assertLess(self.test_conn.execute_command('XLEN', rr.events_key), 200)
+
+    @MockTime.patch()
+    def test_rates(self):
+        rr = redrobin.RoundRobinScheduler(['foo', 'bar', 'foo'], name='test',
+                                          connection=self.test_conn, events_maxlen=1000)
+        reader = rr.events(window=10)
+        for _ in xrange(30):
+            rr.next()
+        self.assertEqual(len(reader.poll(count=20)), 20)
+        self.assertEqual(len(reader.poll()), 10)
+        self.assertEqual(reader.rates(), {'foo': 2, 'bar': 1})
+        self.assertEqual(reader.worker_rates().values(), [3])
+
+        # the events leave the window
+        time.sleep(9.5)
+        rr.next()
+        reader.poll()
+        self.assertEqual(reader.rates(), {'foo': 2.1, 'bar': 1})
+        self.assertEqual(reader.rates(now=time.time() + 1), {'foo': 0.1})
+        self.assertEqual(reader.rates(now=time.time() + 10), {})
+
+    @MockTime.patch()
+    def test_dispatcher(self):
+        ts = redrobin.ThrottlingScheduler({'foo': 1}, name='test',
+                                          connection=self.test_conn, events_maxlen=100)
+        dispatcher = redrobin.Dispatcher(ts, name='test')
+        dispatcher.put('job1', 'job2')
+        reader = ts.events()
+        self.assertEqual(dispatcher.next(), ('job1', 'foo'))
+        self.assertEqual(dispatcher.next(), ('job2', 'foo'))
+        events = reader.poll()
+        self.assertEqual([event.member for event in events], ['foo', 'foo'])
+        self.assertAlmostEqual(events[1].wait, 1, delta=0.01)
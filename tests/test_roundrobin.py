@@ -1,14 +1,19 @@
 from itertools import cycle, islice
+import os
+import pickle
+import threading
+import time
+import mock
 import redrobin
 
-from . import BaseTestCase
+from . import BaseTestCase, MockTime
 
 
 class RoundRobinSchedulerTestCase(BaseTestCase):
 
-    def get_scheduler(self, keys=None, name='test'):
+    def get_scheduler(self, keys=None, name='test', **kwargs):
         return redrobin.RoundRobinScheduler(keys=keys, name=name,
-                                            connection=self.test_conn)
+                                            connection=self.test_conn, **kwargs)
 
     def assertQueue(self, round_robin, expected_queues):
         queue = map(round_robin._unpickle,
@@ -118,3 +123,351 @@ class RoundRobinSchedulerTestCase(BaseTestCase):
         rr = self.get_scheduler(keys)
         for key in islice(cycle(keys), 100):
             self.assertEqual(rr.next(), key)
+
+    def test_read_connection(self):
+        keys = ['foo', 'bar', 'foo', 'baz']
+        read_conn = mock.Mock(wraps=self.test_conn)
+        rr = self.get_scheduler(keys, read_connection=read_conn)
+        self.assertEqual(len(rr), 4)
+        self.assertEqual(list(rr), keys)
+        self.assertIn('bar', rr)
+        self.assertNotIn('xyz', rr)
+        self.assertTrue(read_conn.llen.called)
+        self.assertTrue(read_conn.lrange.called)
+        self.assertEqual(read_conn.evalsha.call_count, 2)
+
+        # writes and next() go to the primary
+        rr.add('xyz')
+        self.assertEqual(rr.next(), 'foo')
+        self.assertFalse(read_conn.lpush.called)
+        self.assertFalse(read_conn.rpoplpush.called)
+
+    def test_read_connection_stale(self):
+        read_conns = [mock.Mock(wraps=self.test_conn) for _ in xrange(3)]
+        replication_infos = [
+            {'role': 'slave', 'master_link_status': 'up', 'master_last_io_seconds_ago': 1},
+            {'role': 'slave', 'master_link_status': 'up', 'master_last_io_seconds_ago': 20},
+            {'role': 'slave', 'master_link_status': 'down'},
+        ]
+        for read_conn, info in zip(read_conns, replication_infos):
+            read_conn.info.return_value = info
+
+        rr = self.get_scheduler(['foo', 'bar'], read_connection=read_conns,
+                                max_staleness=5)
+        for _ in xrange(4):
+            self.assertEqual(len(rr), 2)
+        self.assertEqual([c.llen.call_count for c in read_conns], [4, 0, 0])
+
+        # fall back to the primary if all read connections are stale
+        rr = self.get_scheduler(read_connection=read_conns[1:], max_staleness=5)
+        self.assertEqual(len(rr), 2)
+        self.assertEqual([c.llen.call_count for c in read_conns], [4, 0, 0])
+
+    def test_stats(self):
+        keys = ['foo', 'bar', 'foo', None]
+        rr = self.get_scheduler(keys, stats=True)
+        for key in islice(cycle(keys), 10):
+            self.assertEqual(rr.next(), key)
+        stats = rr.stats()
+        self.assertItemsEqual(stats.keys(), ['foo', 'bar', None])
+        self.assertEqual([stats[key]['count'] for key in 'foo', 'bar', None],
+                         [5, 3, 2])
+        self.assertEqual(stats['foo']['wait'], 0)
+        self.assertIsNone(stats['foo']['utilization'])
+        self.assertEqual(rr.stats_summary()['count'], 10)
+
+    def test_next_affinity(self):
+        keys = ['key{}'.format(i) for i in xrange(10)]
+        rr = self.get_scheduler(keys)
+        affinities = ['job{}'.format(i) for i in xrange(100)]
+        get_mapping = lambda: {affinity: rr.next(affinity=affinity)
+                               for affinity in affinities}
+
+        mapping = get_mapping()
+        self.assertEqual(get_mapping(), mapping)
+        self.assertGreater(len(set(mapping.itervalues())), 5)
+        # the roundrobin order is not affected
+        self.assertEqual(rr.next(), keys[0])
+
+        # removing an item remaps only its affinities
+        removed = mapping['job0']
+        rr.discard(removed)
+        new_mapping = get_mapping()
+        for affinity, key in mapping.iteritems():
+            if key != removed:
+                self.assertEqual(new_mapping[affinity], key)
+            else:
+                self.assertNotEqual(new_mapping[affinity], key)
+
+        # adding an item remaps only the affinities that now map to it
+        rr.add('new_key')
+        newer_mapping = get_mapping()
+        self.assertIn('new_key', newer_mapping.values())
+        for affinity, key in newer_mapping.iteritems():
+            if key != 'new_key':
+                self.assertEqual(new_mapping[affinity], key)
+
+        rr.clear()
+        self.assertRaises(StopIteration, rr.next, affinity='job0')
+
+    def assertRingRebuilt(self, rr):
+        # the incrementally maintained ring equals a ring rebuilt in full
+        ring = self.test_conn.zrange(rr.ring_key, 0, -1, withscores=True)
+        self.test_conn.delete(rr.ring_key)
+        if ring:
+            rr.next(affinity='job')
+        self.assertEqual(self.test_conn.zrange(rr.ring_key, 0, -1, withscores=True), ring)
+
+    @MockTime.patch()
+    def test_ring_incremental(self):
+        rr = self.get_scheduler(['foo', 'bar', 'foo'])
+        rr.next(affinity='job')
+        self.assertEqual(self.test_conn.zcard(rr.ring_key), 2 * rr.ring_replicas)
+        rr.add('baz', 'foo')
+        self.assertRingRebuilt(rr)
+        rr.discard('foo', count=1)
+        self.assertEqual(self.test_conn.zcard(rr.ring_key), 3 * rr.ring_replicas)
+        rr.discard('foo')
+        self.assertRingRebuilt(rr)
+        self.assertEqual(self.test_conn.zcard(rr.ring_key), 2 * rr.ring_replicas)
+        rr.add('foo')
+        self.assertEqual(rr.pop(), 'bar')
+        self.assertRingRebuilt(rr)
+        rr.sync(['foo', 'xyz', 'xyz'])
+        self.assertRingRebuilt(rr)
+        rr.expire('xyz', 1)
+        time.sleep(2)
+        self.assertEqual(rr.next(), 'foo')
+        rr.next()
+        self.assertRingRebuilt(rr)
+        self.assertEqual(self.test_conn.zcard(rr.ring_key), rr.ring_replicas)
+        rr.pop()
+        self.assertFalse(self.test_conn.exists(rr.ring_key))
+
+    def test_snapshot(self):
+        keys = ['foo', 'bar', 'foo', 'baz', 1, [2, 3]]
+        rr = self.get_scheduler(keys)
+        self.assertEqual(rr.next(), 'foo')
+        snapshot = list(rr.export_snapshot(chunk_size=4))
+        self.assertEqual(snapshot, [
+            {'type': 'RoundRobinScheduler', 'version': 2},
+            [['bar'], ['foo'], ['baz'], [1]],
+            [[[2, 3]], ['foo']],
+        ])
+
+        other = self.get_scheduler(['xyz'], name='other')
+        other.import_snapshot(snapshot)
+        self.assertQueue(other, ['bar', 'foo', 'baz', 1, [2, 3], 'foo'])
+        other.import_snapshot(list(self.get_scheduler(name='empty').export_snapshot()))
+        self.assertQueue(other, [])
+        # no temporary keys are left behind
+        self.assertItemsEqual(self.test_conn.keys(), [rr.key])
+
+        self.assertRaises(ValueError, other.import_snapshot, [])
+        self.assertRaises(ValueError, other.import_snapshot,
+                          [{'type': 'ThrottlingScheduler', 'version': 2}])
+        self.assertRaises(ValueError, other.import_snapshot,
+                          [{'type': 'RoundRobinScheduler', 'version': 1}])
+
+    def test_dump_restore(self):
+        rr = self.get_scheduler(['foo', 'bar', 'baz'])
+        rr.next()
+        payloads = rr.dump()
+        rr.next()
+        rr.add('xyz')
+        rr.restore(payloads)
+        self.assertQueue(rr, ['bar', 'baz', 'foo'])
+        rr.clear()
+        rr.restore(payloads)
+        self.assertQueue(rr, ['bar', 'baz', 'foo'])
+        rr.restore(self.get_scheduler(name='empty').dump())
+        self.assertQueue(rr, [])
+
+    @MockTime.patch()
+    def test_snapshot_expiry(self):
+        rr = self.get_scheduler(['foo', 'bar', 'foo', [1]])
+        expires_at = time.time() + 10
+        rr.expireat('foo', expires_at)
+        rr.expireat([1], expires_at + 10)
+        snapshot = list(rr.export_snapshot())
+        self.assertEqual(snapshot[1], [['foo', expires_at], ['bar'],
+                                       ['foo', expires_at], [[1], expires_at + 10]])
+        payloads = rr.dump()
+
+        other = self.get_scheduler(['bar'], name='other')
+        other.expire('bar', 5)
+        for restore in (lambda: other.import_snapshot(snapshot),
+                        lambda: other.restore(payloads)):
+            restore()
+            self.assertQueue(other, ['foo', 'bar', 'foo', [1]])
+            self.assertEqual(self.test_conn.zrange(other.expiry_key, 0, -1, withscores=True),
+                             [('"foo"', expires_at), ('[1]', expires_at + 10)])
+            self.assertIsNone(other.ttl('bar'))
+
+    def test_expiry(self):
+        rr = self.get_scheduler(['foo', 'bar', 'foo', 'baz'])
+        self.assertTrue(rr.expire('bar', 0))
+        self.assertTrue(rr.expireat('baz', 0))
+        self.assertTrue(rr.expire('foo', 100))
+        self.assertFalse(rr.expire('missing', 100))
+        self.assertIsNone(rr.ttl('missing'))
+        self.assertAlmostEqual(rr.ttl('foo'), 100, delta=1)
+        self.assertEqual(list(islice(iter(rr.next, None), 4)), ['foo', 'foo', 'foo', 'foo'])
+        self.assertQueue(rr, ['foo', 'foo'])
+        other = self.get_scheduler(['foo'], name='other')
+        other.expire('foo', 0)
+        self.assertRaises(StopIteration, other.next)
+
+        # adding an item clears its expiry
+        rr.add('bar')
+        self.assertIsNone(rr.ttl('bar'))
+        self.assertEqual([rr.next(), rr.next(), rr.next()], ['foo', 'foo', 'bar'])
+        rr.expire('foo', 0)
+        self.assertEqual([rr.next(), rr.next()], ['bar', 'bar'])
+        self.assertQueue(rr, ['bar'])
+
+    def test_expiry_delete(self):
+        rr = self.get_scheduler(['foo', 'bar', 'foo', 'baz'])
+        for item in 'foo', 'bar', 'baz':
+            rr.expire(item, 100)
+        # the expiry is cleared once the last occurrence is removed
+        rr.discard('foo', 1)
+        self.assertAlmostEqual(rr.ttl('foo'), 100, delta=1)
+        rr.discard('foo')
+        self.assertIsNone(rr.ttl('foo'))
+        self.assertEqual(rr.pop(), 'bar')
+        self.assertIsNone(rr.ttl('bar'))
+        self.assertAlmostEqual(rr.ttl('baz'), 100, delta=1)
+        rr.expire('baz', 0)
+        rr.remove('baz')
+        rr.add('baz')
+        self.assertEqual(rr.next(), 'baz')
+
+    def test_expiry_affinity(self):
+        keys = ['key{}'.format(i) for i in xrange(10)]
+        rr = self.get_scheduler(keys)
+        key = rr.next(affinity='job')
+        rr.expire(key, 0)
+        other_key = rr.next(affinity='job')
+        self.assertNotEqual(other_key, key)
+        # the expired key is dropped from the ring only; it's purged lazily
+        self.assertIn(key, rr)
+        self.assertIsNone(self.test_conn.zscore(rr.ring_key, '1:"{}"'.format(key)))
+        self.assertIsNotNone(self.test_conn.zscore(rr.ring_key, '1:"{}"'.format(other_key)))
+        self.assertEqual(rr.next(affinity='job'), other_key)
+        self.assertEqual(rr.sweep(), 1)
+        self.assertNotIn(key, rr)
+        self.assertEqual(rr.next(affinity='job'), other_key)
+
+        # a rebuilt ring leaves out the expired keys
+        for item in keys:
+            rr.expire(item, 0)
+        self.test_conn.delete(rr.ring_key)
+        self.assertRaises(StopIteration, rr.next, affinity='job')
+        self.assertEqual(len(rr), 9)
+
+    def test_sweep(self):
+        rr = self.get_scheduler(['foo', 'bar', 'foo', 'baz'])
+        for item in 'foo', 'baz':
+            rr.expire(item, 0)
+        self.assertEqual(rr.sweep(batch_size=1), 1)
+        self.assertEqual(rr.sweep(), 1)
+        self.assertEqual(rr.sweep(), 0)
+        self.assertQueue(rr, ['bar'])
+
+        rr.add('xyz')
+        rr.expire('xyz', 0.05)
+        sweeper = rr.start_sweeper(interval=0.01)
+        try:
+            for _ in xrange(100):
+                if len(rr) == 1:
+                    break
+                time.sleep(0.01)
+        finally:
+            sweeper.stop()
+        self.assertQueue(rr, ['bar'])
+        self.assertFalse(sweeper.is_alive())
+
+    def test_fork(self):
+        rr = self.get_scheduler(['foo', 'bar'], read_connection=self.test_conn)
+        self.assertEqual(len(rr), 2)
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                rr.add('baz')
+                status = 0 if len(rr) == 3 and rr.next() == 'foo' else 1
+            except Exception:
+                status = 2
+            os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        # the connections of the parent still work
+        self.assertEqual(len(rr), 3)
+        self.assertEqual(rr.next(), 'bar')
+
+    def test_fork_threads(self):
+        rr = self.get_scheduler(['foo', 'bar'])
+        self.assertEqual(len(rr), 2)
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            # the first use after the fork races to reset the connection pool
+            errors = []
+            start = threading.Event()
+
+            def dispatch():
+                start.wait()
+                try:
+                    for _ in xrange(20):
+                        rr.next()
+                except Exception as ex:
+                    errors.append(ex)
+
+            threads = [threading.Thread(target=dispatch) for _ in xrange(8)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+            os._exit(1 if errors else 0)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(len(rr), 2)
+
+    def test_pickle(self):
+        rr = self.get_scheduler(['foo', 'bar'], stats=True)
+        other = pickle.loads(pickle.dumps(rr, pickle.HIGHEST_PROTOCOL))
+        self.assertIsNot(other.redis, rr.redis)
+        self.assertEqual(other.key, rr.key)
+        self.assertEqual(other.next(), 'foo')
+        self.assertEqual(rr.next(), 'bar')
+        self.assertEqual(other.stats()['foo']['count'], 1)
+
+    def test_sync(self):
+        rr = self.get_scheduler(['foo', 'bar', 'foo', 'baz'])
+        self.assertEqual(rr.next(), 'foo')
+        rr.expire('baz', 10)
+        self.assertEqual(rr.sync(['bar', 'xyz', 'foo', 'xyz'], chunk_size=3), (2, 2))
+        self.assertQueue(rr, ['bar', 'foo', 'xyz', 'xyz'])
+        self.assertIsNone(rr.ttl('baz'))
+        self.assertEqual(rr.sync(['xyz', 'bar', 'foo', 'xyz']), (0, 0))
+        self.assertQueue(rr, ['bar', 'foo', 'xyz', 'xyz'])
+        self.assertEqual(rr.sync([]), (0, 4))
+        self.assertQueue(rr, [])
+
+    def test_batch(self):
+        rr = self.get_scheduler(['foo', 'bar'])
+        conn = mock.Mock(wraps=self.test_conn)
+        rr.redis = conn
+        with rr.batch() as batch:
+            for i in xrange(100):
+                rr.add('key{}'.format(i))
+            removed = rr.remove('bar')
+            missing = rr.remove('missing')
+            popped = rr.pop()
+            expired = rr.expire('key1', 10)
+        self.assertEqual(conn.pipeline.call_count, 1)
+        self.assertEqual(len(rr), 100)
+        self.assertEqual(removed.value, 1)
+        self.assertRaises(KeyError, lambda: missing.value)
+        self.assertEqual(popped.value, 'foo')
+        self.assertTrue(expired.value)
+        self.assertAlmostEqual(rr.ttl('key1'), 10, delta=1)
+        self.assertEqual(batch.results[:100], [None] * 100)
@@ -0,0 +1,87 @@
+import mock
+import redis
+import redrobin
+from redrobin.scripts import ScriptRegistry
+
+from . import BaseTestCase
+
+
+class ScriptRegistryTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(ScriptRegistryTestCase, self).setUp()
+        self.registry = ScriptRegistry()
+        self.incr = self.registry.register(
+            'return redis.call("INCRBY", KEYS[1], ARGV[1])')
+        self.get = self.registry.register('return redis.call("GET", KEYS[1])')
+
+    def test_sha(self):
+        self.assertEqual(self.test_conn.script_load(self.incr.script), self.incr.sha)
+
+    def test_load_once(self):
+        conn = mock.Mock(wraps=self.test_conn)
+        self.assertEqual(self.incr(['x'], [2], conn), 2)
+        self.assertEqual(self.incr(['x'], [3], conn), 5)
+        self.assertEqual(self.get(['x'], client=conn), '5')
+        self.assertEqual(conn.pipeline.call_count, 1)
+        self.assertEqual(self.test_conn.script_exists(self.incr.sha, self.get.sha),
+                         [True, True])
+
+        # scripts registered later are loaded by their first call
+        decr = self.registry.register('return redis.call("DECR", KEYS[1])')
+        self.assertEqual(decr(['x'], client=conn), 4)
+        self.assertEqual(conn.pipeline.call_count, 2)
+
+    def test_reload(self):
+        self.registry.load(self.test_conn)
+        self.test_conn.script_flush()
+        self.assertEqual(self.incr(['x'], [2], self.test_conn), 2)
+        self.assertEqual(self.test_conn.script_exists(self.incr.sha, self.get.sha),
+                         [True, True])
+
+    def test_pipeline(self):
+        self.registry.load(self.test_conn)
+        self.test_conn.script_flush()
+        with self.test_conn.pipeline(transaction=False) as pipe:
+            pipe.set('x', 1)
+            self.incr(['x'], [2], pipe)
+            self.get(['x'], client=pipe)
+            self.assertEqual(self.registry.execute(pipe), [True, 3, '3'])
+
+        # the commands run in order, even after a script that was not loaded
+        self.test_conn.script_flush()
+        with self.test_conn.pipeline(transaction=False) as pipe:
+            pipe.set('x', 1)
+            self.incr(['x'], [2], pipe)
+            pipe.get('x')
+            pipe.incrby('x', 10)
+            self.assertEqual(self.registry.execute(pipe), [True, 3, '3', 13])
+
+        with self.test_conn.pipeline(transaction=False) as pipe:
+            self.incr(['y'], [1], pipe)
+            pipe.lpush('x', 1)
+            self.assertRaises(redis.ResponseError, self.registry.execute, pipe)
+
+    def test_transaction(self):
+        self.registry.load(self.test_conn)
+        self.test_conn.script_flush()
+        with self.test_conn.pipeline() as pipe:
+            pipe.set('x', 1)
+            self.incr(['x'], [2], pipe)
+            self.assertEqual(pipe.execute(), [True, 3])
+
+    def test_scheduler(self):
+        self.test_conn.script_flush()
+        rr = redrobin.ThrottlingScheduler({'foo': 10}, name='test',
+                                          connection=self.test_conn)
+        self.assertEqual(rr.next(), 'foo')
+        self.test_conn.script_flush()
+        rr['bar'] = 1e-3
+        self.assertEqual(rr.next(), 'bar')
+        self.assertNotIn('zaddnx', dir(self.test_conn))
+
+        self.test_conn.script_flush()
+        rr.load_scripts()
+        self.assertEqual(self.test_conn.script_exists(
+            *[script.sha for script in redrobin.scripts.registry._scripts]),
+            [True] * len(redrobin.scripts.registry))
@@ -0,0 +1,98 @@
+import time
+import unittest
+
+import redrobin
+
+from . import BaseTestCase, MockTime, TIME_TICK
+
+try:
+    import numpy as np
+    from redrobin import simulator
+except ImportError:
+    np = None
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class SimulatorTestCase(BaseTestCase):
+
+    def run_workers(self, scheduler, keys, job_time, num_dispatches):
+        dispatched, waits = [], []
+        for _ in xrange(num_dispatches):
+            start = time.time()
+            dispatched.append(keys.index(scheduler.next()))
+            # one tick for the call to time() above
+            waits.append(time.time() - start - 2 * TIME_TICK)
+            time.sleep(job_time)
+        return dispatched, waits
+
+    @MockTime.patch()
+    def test_throttling_matches_scheduler(self):
+        keys = ['a', 'b', 'c', 'd']
+        throttles = [0.3, 0.5, 0.5, 1.2]
+        scheduler = redrobin.ThrottlingScheduler(dict(zip(keys, throttles)),
+                                                 name='test', connection=self.test_conn)
+        dispatched, waits = self.run_workers(scheduler, keys, 0.1, 50)
+
+        result = simulator.simulate_throttling([throttles], 1, job_time=0.1,
+                                               num_dispatches=50,
+                                               call_overhead=3 * TIME_TICK)
+        self.assertEqual(result.keys[0].tolist(), dispatched)
+        self.assertLess(np.abs(result.waits[0] - waits).max(), 1e-6)
+
+    @MockTime.patch()
+    def test_throttling_roundrobin_matches_scheduler(self):
+        keys = ['a', 'b', 'c']
+        scheduler = redrobin.ThrottlingRoundRobinScheduler(
+            0.5, keys, name='test', connection=self.test_conn)
+        # the dispatch order of the items
+        keys = [scheduler.next() for _ in keys]
+        time.sleep(1)
+        dispatched, waits = self.run_workers(scheduler, keys, 0.1, 20)
+        self.assertEqual(dispatched, [i % 3 for i in xrange(20)])
+
+        result = simulator.simulate_throttling_roundrobin(
+            0.5, 3, 1, job_time=0.1, num_dispatches=20, call_overhead=3 * TIME_TICK)
+        self.assertEqual(result.keys[0].tolist(), dispatched)
+        self.assertLess(np.abs(result.waits[0] - waits).max(), 1e-6)
+
+    def test_throttling_results(self):
+        # one key with throttle 1 shared by two workers: one dispatch per second
+        result = simulator.simulate_throttling([[1.0]], 2, num_dispatches=5)
+        self.assertEqual(result.ready_at.tolist(), [[0, 1, 2, 3, 4]])
+        self.assertEqual(result.waits.tolist(), [[0, 1, 2, 2, 2]])
+        self.assertEqual(result.makespan.tolist(), [4])
+        self.assertEqual(result.throughput.tolist(), [1.25])
+        self.assertEqual(result.utilization.tolist(), [[1.25]])
+        self.assertEqual(result.wait_percentiles([0, 50, 100]).tolist(), [[0, 2, 2]])
+
+        # padded keys are never dispatched
+        result = simulator.simulate_throttling([[1, 2, 4], [2, np.nan, np.nan]], [1, 3],
+                                               job_time=[0.5, 0], num_dispatches=4)
+        self.assertEqual(result.keys.tolist(), [[0, 1, 2, 0], [0, 0, 0, 0]])
+        self.assertEqual(result.ready_at.tolist(), [[0, 0.5, 1, 1.5], [0, 2, 4, 6]])
+        self.assertEqual(result.utilization[1, 1:].tolist(), [0, 0])
+
+    def test_random_job_time(self):
+        job_time = lambda random, shape: random.exponential(0.2, shape)
+        result1 = simulator.simulate_throttling([[1, 1]], 1, job_time=job_time, seed=42)
+        result2 = simulator.simulate_throttling([[1, 1]], 1, job_time=job_time, seed=42)
+        self.assertEqual(result1.ready_at.tolist(), result2.ready_at.tolist())
+
+    def test_sweep(self):
+        for round_robin in False, True:
+            configs, result = simulator.sweep([0.5, 1], [1, 10], [1, 2, 4],
+                                              round_robin=round_robin,
+                                              job_time=0.25, num_dispatches=200)
+            self.assertEqual(len(configs), 12)
+            self.assertEqual(result.waits.shape, (12, 200))
+            self.assertEqual(result.utilization.shape, (12, 10))
+            throughput = dict(zip(configs, result.throughput))
+            for throttle, num_keys, num_workers in configs:
+                # bounded by the keys and by the workers
+                self.assertLessEqual(throughput[throttle, num_keys, num_workers],
+                                     min(num_keys / throttle, num_workers / 0.25) * 1.05)
+                if num_workers > 1:
+                    self.assertGreaterEqual(throughput[throttle, num_keys, num_workers],
+                                            throughput[throttle, num_keys, num_workers / 2])
+            self.assertAlmostEqual(throughput[0.5, 10, 4], 16, delta=0.5)
+            self.assertAlmostEqual(throughput[1, 1, 4], 1, delta=0.01)
@@ -0,0 +1,320 @@
+"""Stress tests of many worker processes against a locally spawned redis-server,
+with injected worker kills, delays, connection drops and server restarts.
+
+The dispatches are recorded in the events stream of the schedulers, atomically
+with the reservations, and the throttle spacing, fairness and membership
+invariants are verified on that log. The tests are skipped if no redis-server
+executable is found. REDROBIN_STRESS_SECONDS sets the duration of each run and
+REDROBIN_STRESS_SEED the seed of the injected faults.
+"""
+from collections import Counter, defaultdict
+from distutils.spawn import find_executable
+import errno
+import itertools as it
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+
+import redis
+import redrobin
+
+
+REDIS_SERVER = find_executable('redis-server')
+DURATION = float(os.environ.get('REDROBIN_STRESS_SECONDS', 2))
+SEED = int(os.environ.get('REDROBIN_STRESS_SEED', 42))
+NUM_WORKERS = 6
+THROTTLE = 0.05
+KEYS = ['key{}'.format(i) for i in xrange(8)]
+# the mutators add and remove only the volatile keys
+STABLE_KEYS, VOLATILE_KEYS = KEYS[:4], KEYS[4:]
+
+
+def make_scheduler(kind, port):
+    connection = redis.StrictRedis(port=port, socket_timeout=5)
+    kwargs = dict(connection=connection, name='stress', events_maxlen=10 ** 6)
+    if kind == 'roundrobin':
+        return redrobin.RoundRobinScheduler(**kwargs)
+    if kind == 'throttling_roundrobin':
+        return redrobin.ThrottlingRoundRobinScheduler(THROTTLE, **kwargs)
+    return redrobin.ThrottlingScheduler(**kwargs)
+
+
+def worker(kind, port, max_delay, seed, until):
+    random.seed(seed)
+    scheduler = make_scheduler(kind, port)
+    scheduler.worker_id = multiprocessing.current_process().name
+    while time.time() < until:
+        try:
+            scheduler.next()
+        except StopIteration:
+            time.sleep(0.01)
+        except redis.RedisError:
+            # dropped connection or restarting server
+            time.sleep(0.05)
+        if max_delay:
+            time.sleep(random.random() * max_delay)
+
+
+def mutator(kind, port, seed, until):
+    random.seed(seed)
+    scheduler = make_scheduler(kind, port)
+    while time.time() < until:
+        key = random.choice(VOLATILE_KEYS)
+        operation = random.randrange(4)
+        try:
+            if kind == 'throttling_roundrobin':
+                # discard() is a WATCH/MULTI transaction contending with next()
+                if operation < 2:
+                    scheduler.add(key)
+                else:
+                    scheduler.discard(key)
+            elif operation == 0:
+                scheduler[key] = THROTTLE
+            elif operation == 1:
+                scheduler.discard(key)
+            elif operation == 2:
+                scheduler.admit({key: THROTTLE}, stagger=0.1)
+            else:
+                desired = STABLE_KEYS + random.sample(VOLATILE_KEYS, 2)
+                scheduler.sync({key: THROTTLE for key in desired})
+        except redis.RedisError:
+            time.sleep(0.05)
+        time.sleep(random.random() * 0.01)
+
+
+class RedisServer(object):
+    """A redis-server process with an append only file in a temporary directory."""
+
+    def __init__(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.dir = tempfile.mkdtemp(prefix='redrobin-stress')
+        self.process = None
+        self.connection = redis.StrictRedis(port=self.port)
+
+    def start(self):
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(
+                [REDIS_SERVER, '--port', str(self.port), '--bind', '127.0.0.1',
+                 '--dir', self.dir, '--save', '', '--appendonly', 'yes',
+                 '--appendfsync', 'always'],
+                stdout=devnull, stderr=devnull)
+        for _ in xrange(500):
+            try:
+                if self.connection.ping():
+                    return
+            except redis.RedisError:
+                time.sleep(0.01)
+        raise RuntimeError("redis-server did not start")
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def close(self):
+        self.kill()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+@unittest.skipIf(REDIS_SERVER is None, 'redis-server not found')
+class StressTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = RedisServer()
+        cls.server.start()
+        version = cls.server.connection.info()['redis_version']
+        if int(version.split('.')[0]) < 5:
+            cls.server.close()
+            raise unittest.SkipTest('redis-server >= 5 is required for streams')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+
+    def setUp(self):
+        self.server.connection.flushall()
+        self.random = random.Random(SEED)
+
+    def run_workers(self, kind, max_delay=0, kill_interval=None, drop_interval=None,
+                    restart_at=None, mutators=0):
+        """Run the workers (and mutators) for DURATION seconds, replacing killed
+        workers and dropping the client connections or restarting the server at
+        the given intervals/time.
+        """
+        start = time.time()
+        until = start + DURATION
+        seeds = it.count(SEED * 1000)
+
+        def spawn(target, *args):
+            process = multiprocessing.Process(target=target,
+                                              args=args + (next(seeds), until))
+            process.daemon = True
+            process.start()
+            return process
+
+        processes = [spawn(worker, kind, self.server.port, max_delay)
+                     for _ in xrange(NUM_WORKERS)]
+        processes += [spawn(mutator, kind, self.server.port) for _ in xrange(mutators)]
+        next_kill = start + kill_interval if kill_interval else None
+        next_drop = start + drop_interval if drop_interval else None
+        restarted = False
+        while time.time() < until:
+            now = time.time()
+            if next_kill is not None and now >= next_kill:
+                # kill a random worker or mutator and replace it
+                index = self.random.randrange(len(processes))
+                try:
+                    os.kill(processes[index].pid, signal.SIGKILL)
+                except OSError as ex:
+                    # already exited
+                    if ex.errno != errno.ESRCH:
+                        raise
+                processes[index].join()
+                if index < NUM_WORKERS:
+                    processes[index] = spawn(worker, kind, self.server.port, max_delay)
+                else:
+                    processes[index] = spawn(mutator, kind, self.server.port)
+                next_kill += kill_interval
+            if next_drop is not None and now >= next_drop:
+                self.server.connection.execute_command('CLIENT', 'KILL', 'TYPE', 'normal',
+                                                       'SKIPME', 'yes')
+                next_drop += drop_interval
+            if restart_at is not None and not restarted and now >= start + restart_at:
+                self.server.kill()
+                time.sleep(0.2)
+                self.server.start()
+                restarted = True
+            if mutators and kind == 'throttling':
+                self.assertConsistent(make_scheduler(kind, self.server.port))
+            time.sleep(0.01)
+
+        for process in processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+        return self.dispatch_log(make_scheduler(kind, self.server.port))
+
+    def dispatch_log(self, scheduler):
+        reader = scheduler.events()
+        events = []
+        while True:
+            chunk = reader.poll(count=10000)
+            if not chunk:
+                return events
+            events.extend(chunk)
+
+    def assertSpacing(self, events, throttle, members=KEYS):
+        # consecutive dispatches of each member are at least throttle apart
+        ready_at = defaultdict(list)
+        for event in events:
+            if event.member in members:
+                ready_at[event.member].append(event.ready_at)
+        for member, timestamps in ready_at.iteritems():
+            self.assertEqual(timestamps, sorted(timestamps))
+            for previous, current in zip(timestamps, timestamps[1:]):
+                self.assertGreaterEqual(current - previous, throttle - 1e-6,
+                                        (member, previous, current))
+
+    def assertFair(self, events, members, bound):
+        counts = Counter(event.member for event in events)
+        self.assertItemsEqual(counts, members)
+        self.assertLessEqual(max(counts.values()) - min(counts.values()), bound, counts)
+
+    def assertConsistent(self, scheduler):
+        with scheduler.redis.pipeline() as pipe:
+            pipe.hkeys(scheduler.key)
+            pipe.zrange(scheduler.queue_key, 0, -1)
+            pipe.hkeys(scheduler.priorities_key)
+            pipe.zrange(scheduler.expiry_key, 0, -1)
+            pipe.hkeys(scheduler.admitted_key)
+            throttled, queue, priorities, expiry, admitted = pipe.execute()
+        self.assertItemsEqual(queue, throttled)
+        self.assertItemsEqual(admitted, throttled)
+        self.assertLessEqual(set(priorities), set(throttled))
+        self.assertLessEqual(set(expiry), set(throttled))
+        self.assertLessEqual(set(throttled), set(KEYS))
+
+    def test_roundrobin(self):
+        scheduler = make_scheduler('roundrobin', self.server.port)
+        scheduler.add(*KEYS)
+        events = self.run_workers('roundrobin', kill_interval=0.3, drop_interval=0.25)
+        self.assertGreater(len(events), len(KEYS))
+        # every dispatch rotates the queue, even if the worker died right after
+        self.assertFair(events, KEYS, 1)
+        # no item is lost or duplicated
+        self.assertItemsEqual(scheduler, KEYS)
+
+    def test_throttling(self):
+        scheduler = make_scheduler('throttling', self.server.port)
+        scheduler.update({key: THROTTLE for key in KEYS})
+        events = self.run_workers('throttling', max_delay=0.01, kill_interval=0.3,
+                                  drop_interval=0.25)
+        self.assertSpacing(events, THROTTLE)
+        self.assertFair(events, KEYS, 2)
+        self.assertEqual(dict(scheduler), {key: THROTTLE for key in KEYS})
+        self.assertConsistent(scheduler)
+
+    def test_throttling_roundrobin(self):
+        scheduler = make_scheduler('throttling_roundrobin', self.server.port)
+        scheduler.add(*KEYS)
+        events = self.run_workers('throttling_roundrobin', max_delay=0.01,
+                                  kill_interval=0.3, drop_interval=0.25)
+        self.assertSpacing(events, THROTTLE)
+        self.assertFair(events, KEYS, 2)
+        self.assertItemsEqual(scheduler, KEYS)
+
+    def test_restart(self):
+        scheduler = make_scheduler('throttling', self.server.port)
+        scheduler.update({key: THROTTLE for key in KEYS})
+        events = self.run_workers('throttling', restart_at=DURATION / 2)
+        # the acknowledged writes survive the restart and the scripts are
+        # reloaded transparently
+        dispatched_at = [event.ready_at for event in events]
+        self.assertGreater(max(dispatched_at), time.time() - DURATION / 2)
+        self.assertSpacing(events, THROTTLE)
+        self.assertFair(events, KEYS, 2)
+        self.assertEqual(dict(scheduler), {key: THROTTLE for key in KEYS})
+        self.assertConsistent(scheduler)
+
+    def test_membership_throttling(self):
+        scheduler = make_scheduler('throttling', self.server.port)
+        scheduler.update({key: THROTTLE for key in KEYS})
+        events = self.run_workers('throttling', kill_interval=0.2, drop_interval=0.3,
+                                  mutators=2)
+        # only added keys are dispatched and the keys that were never removed
+        # are spaced by their throttle (re-added keys start over)
+        self.assertLessEqual(set(event.member for event in events), set(KEYS))
+        self.assertSpacing(events, THROTTLE, STABLE_KEYS)
+        self.assertLessEqual(set(STABLE_KEYS), set(scheduler))
+        self.assertConsistent(scheduler)
+
+        # a final sync converges regardless of the interrupted mutations
+        scheduler.sync({key: THROTTLE for key in KEYS[:3]})
+        self.assertEqual(dict(scheduler), {key: THROTTLE for key in KEYS[:3]})
+        self.assertConsistent(scheduler)
+
+    def test_membership_throttling_roundrobin(self):
+        scheduler = make_scheduler('throttling_roundrobin', self.server.port)
+        scheduler.add(*KEYS)
+        events = self.run_workers('throttling_roundrobin', kill_interval=0.2,
+                                  drop_interval=0.3, mutators=2)
+        self.assertLessEqual(set(event.member for event in events), set(KEYS))
+        self.assertSpacing(events, THROTTLE, STABLE_KEYS)
+        # the items that were never removed are neither lost nor duplicated
+        items = list(scheduler)
+        self.assertEqual(sorted(item for item in items if item in STABLE_KEYS),
+                         STABLE_KEYS)
+        self.assertLessEqual(set(items), set(KEYS))
+
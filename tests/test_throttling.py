@@ -1,5 +1,8 @@
 from itertools import cycle, islice
+import os
+import pickle
 import time
+import mock
 import redrobin
 
 from . import BaseTestCase, MockTime
@@ -7,9 +10,10 @@ from . import BaseTestCase, MockTime
 
 class ThrottlingSchedulerTestCase(BaseTestCase):
 
-    def get_scheduler(self, throttled_keys=None, name='test'):
+    def get_scheduler(self, throttled_keys=None, name='test', **kwargs):
         return redrobin.ThrottlingScheduler(throttled_keys=throttled_keys,
-                                              name=name, connection=self.test_conn)
+                                              name=name, connection=self.test_conn,
+                                              **kwargs)
 
     def assertQueueThrottles(self, round_robin, expected_queue, expected_throttled_keys):
         queue = self.test_conn.zrange(round_robin.queue_key, 0, -1)
@@ -168,6 +172,98 @@ class ThrottlingSchedulerTestCase(BaseTestCase):
         rr = self.get_scheduler({'x': 3, 'y': 4, 'z': 2}, name='diff_throttles')
         self.assertEqual(dict(rr.iteritems()), {'x': 3, 'y': 4, 'z': 2})
 
+    def test_getitem(self):
+        rr = self.get_scheduler({'x': 3, 'y': 4})
+        self.assertEqual(rr['x'], 3)
+        self.assertEqual(rr.get('y'), 4)
+        self.assertEqual(rr.get('z', 5), 5)
+        self.assertEqual(rr.getmany('x', 'z', 'y'), [3, None, 4])
+        with self.assertRaises(KeyError):
+            rr['z']
+
+    def test_read_connection(self):
+        read_conn = mock.Mock(wraps=self.test_conn)
+        rr = self.get_scheduler({'x': 3, 'y': 4}, read_connection=read_conn)
+        self.assertEqual(len(rr), 2)
+        self.assertItemsEqual(rr, ['x', 'y'])
+        self.assertIn('x', rr)
+        self.assertEqual(rr['x'], 3)
+        self.assertEqual(rr.get('y'), 4)
+        self.assertEqual(dict(rr.items()), {'x': 3, 'y': 4})
+        self.assertItemsEqual(rr.values(), [3, 4])
+        self.assertIsNone(rr.throttled_until())
+        for method in 'hlen', 'hkeys', 'hexists', 'hget', 'hgetall', 'zrange':
+            self.assertTrue(getattr(read_conn, method).called, method)
+
+        # writes and next() go to the primary
+        rr['z'] = 2
+        self.assertEqual(rr.next(), 'x')
+        self.assertFalse(read_conn.pipeline.called)
+
+    def assertEventually(self, func, timeout=1):
+        deadline = time.time() + timeout
+        while not func() and time.time() < deadline:
+            time.sleep(1e-3)
+        self.assertTrue(func())
+
+    def test_cache(self):
+        read_conn = mock.Mock(wraps=self.test_conn)
+        cached = self.get_scheduler({'x': 3, 'y': 4}, read_connection=read_conn,
+                                    cache_size=10)
+        conn = cached.redis = mock.Mock(wraps=self.test_conn)
+        for _ in xrange(3):
+            self.assertEqual(cached['x'], 3)
+            self.assertEqual(cached.get('y'), 4)
+            self.assertEqual(dict(cached.items()), {'x': 3, 'y': 4})
+        self.assertEqual(conn.hget.call_count, 2)
+        self.assertEqual(conn.hgetall.call_count, 1)
+        # the cache is never filled from a possibly lagging read connection
+        self.assertEqual(read_conn.hget.call_count, 0)
+        self.assertEqual(read_conn.hgetall.call_count, 0)
+
+        # modifications from other schedulers invalidate the cache
+        rr = self.get_scheduler()
+        rr['x'] = 5
+        self.assertEventually(lambda: cached['x'] == 5)
+        self.assertEqual(dict(cached.items()), {'x': 5, 'y': 4})
+        rr.update(y=1, z=2)
+        self.assertEventually(lambda: cached.get('z') == 2)
+        self.assertEqual(cached.getmany('x', 'y', 'z'), [5, 1, 2])
+        self.assertEqual(cached.pop('x'), 5)
+        self.assertIsNone(cached.get('x'))
+        rr.discard('y')
+        self.assertEventually(lambda: 'y' not in dict(cached.items()))
+        rr.clear()
+        self.assertEventually(lambda: cached.get('z') is None)
+
+    def test_cache_bounded(self):
+        keys = ['k{}'.format(i) for i in xrange(10)]
+        rr = self.get_scheduler(dict.fromkeys(keys, 1), cache_size=3)
+        for key in keys:
+            self.assertEqual(rr[key], 1)
+        self.assertEqual(len(rr._cache._entries), 3)
+        # the whole hash doesn't fit in the cache
+        self.assertEqual(dict(rr.items()), dict.fromkeys(keys, 1))
+        self.assertIsNone(rr._cache._all)
+        for key in sorted(keys):
+            self.assertEqual(rr.next(wait=False), key)
+
+    def test_cache_max_age(self):
+        rr = self.get_scheduler({'x': 3}, cache_size=10, cache_max_age=0)
+        conn = rr.redis = mock.Mock(wraps=self.test_conn)
+        for _ in xrange(3):
+            self.assertEqual(rr['x'], 3)
+        self.assertEqual(conn.hget.call_count, 3)
+
+    def test_cache_closed(self):
+        rr = self.get_scheduler({'x': 3}, cache_size=10)
+        rr._cache.close()
+        self.assertEventually(lambda: not rr._cache.enabled)
+        conn = rr.redis = mock.Mock(wraps=self.test_conn)
+        for _ in xrange(3):
+            self.assertEqual(rr['x'], 3)
+        self.assertEqual(conn.hget.call_count, 3)
+
     def test_next_empty(self):
         rr = self.get_scheduler()
         self.assertRaises(StopIteration, rr.next)
@@ -247,3 +343,703 @@ class ThrottlingSchedulerTestCase(BaseTestCase):
         for _ in keys:
             self.assertIsNone(rr.throttled_until())
             rr.next()
+
+    @MockTime.patch()
+    def test_next_affinity(self):
+        throttle = 1
+        keys = ['key{}'.format(i) for i in xrange(10)]
+        rr = self.get_scheduler(dict.fromkeys(keys, throttle))
+        affinities = ['job{}'.format(i) for i in xrange(100)]
+
+        def get_mapping():
+            mapping = {}
+            for affinity in affinities:
+                mapping[affinity] = rr.next(affinity=affinity)
+                time.sleep(throttle)
+            return mapping
+
+        # the same affinity keeps getting the same key
+        mapping = get_mapping()
+        self.assertEqual(get_mapping(), mapping)
+        self.assertGreater(len(set(mapping.itervalues())), 5)
+
+        # if the affinity key is throttled, fall back to the earliest available
+        affinity_key = rr.next(affinity='job0')
+        self.assertNotEqual(rr.next(affinity='job0'), affinity_key)
+        self.assertNotEqual(rr.next(wait=False, affinity='job0'), affinity_key)
+        time.sleep(throttle)
+        self.assertEqual(rr.reserve(affinity='job0')[0], affinity_key)
+
+        # removing a key remaps only its affinities
+        time.sleep(throttle)
+        removed = mapping['job0']
+        del rr[removed]
+        new_mapping = get_mapping()
+        for affinity, key in mapping.iteritems():
+            if key != removed:
+                self.assertEqual(new_mapping[affinity], key)
+            else:
+                self.assertNotEqual(new_mapping[affinity], key)
+
+        # adding a key remaps only the affinities that now map to it
+        rr['new_key'] = throttle
+        newer_mapping = get_mapping()
+        self.assertIn('new_key', newer_mapping.values())
+        for affinity, key in newer_mapping.iteritems():
+            if key != 'new_key':
+                self.assertEqual(new_mapping[affinity], key)
+
+    @MockTime.patch()
+    def test_ring_incremental(self):
+        rr = self.get_scheduler({'foo': 1, 'bar': 1})
+        rr.next(affinity='job')
+
+        def assertRingRebuilt():
+            # the incrementally maintained ring equals a ring rebuilt in full
+            ring = self.test_conn.zrange(rr.ring_key, 0, -1, withscores=True)
+            self.assertEqual(len(ring), len(rr) * rr.ring_replicas)
+            self.test_conn.delete(rr.ring_key)
+            rr.reserve(affinity='job')
+            self.assertEqual(self.test_conn.zrange(rr.ring_key, 0, -1, withscores=True),
+                             ring)
+
+        # throttle changes don't touch the ring
+        ring = self.test_conn.zrange(rr.ring_key, 0, -1, withscores=True)
+        rr['foo'] = 2
+        rr.update(bar=3)
+        rr.setdefault('foo', 4)
+        rr.sync({'foo': 5, 'bar': 5})
+        rr.admit({'foo': 6})
+        self.assertEqual(self.test_conn.zrange(rr.ring_key, 0, -1, withscores=True), ring)
+
+        rr['baz'] = 1
+        rr.update(xyz=1, abc=1)
+        assertRingRebuilt()
+        del rr['xyz']
+        rr.discard('abc')
+        assertRingRebuilt()
+        rr.admit({'new': 1, 'foo': 1})
+        assertRingRebuilt()
+        rr.sync({'foo': 1, 'other': 1})
+        assertRingRebuilt()
+        rr.expire('other', 1)
+        time.sleep(2)
+        self.assertEqual(rr.sweep(), 1)
+        self.assertEqual(rr.keys(), ['foo'])
+        assertRingRebuilt()
+
+    def test_next_affinity_empty(self):
+        rr = self.get_scheduler()
+        self.assertRaises(StopIteration, rr.next, affinity='job')
+
+    def test_next_distinct_empty(self):
+        rr = self.get_scheduler({'foo': 1})
+        self.assertRaises(StopIteration, rr.next_distinct, 2)
+        self.assertRaises(StopIteration, rr.next_distinct, 2, wait=False)
+        for k in 0, -1:
+            self.assertRaises(ValueError, rr.next_distinct, k)
+
+    @MockTime.patch()
+    def test_next_distinct(self):
+        throttle = 1
+        rr = self.get_scheduler({'foo': throttle, 'bar': throttle, 'baz': 2 * throttle},
+                                stats=True)
+        start = time.time()
+        with self.assertAlmostInstant():
+            self.assertEqual(rr.next_distinct(2), ['bar', 'baz'])
+        with self.assertAlmostInstant():
+            self.assertEqual(rr.next_distinct(1), ['foo'])
+
+        # the throttled keys are not reserved without waiting
+        for _ in xrange(10):
+            with self.assertAlmostInstant():
+                self.assertIsNone(rr.next_distinct(2, wait=False))
+        self.assertEqual(rr.stats_summary()['misses'], 20)
+
+        # wait for the latest of the two earliest available
+        with self.assertTimeRange(start + throttle, start + throttle + 0.1):
+            self.assertEqual(rr.next_distinct(2), ['bar', 'foo'])
+        with self.assertTimeRange(start + 2 * throttle, start + 2 * throttle + 0.1):
+            self.assertEqual(rr.next_distinct(3), ['baz', 'bar', 'foo'])
+        self.assertEqual(rr.stats_summary()['count'], 8)
+
+    def test_reserve_empty(self):
+        rr = self.get_scheduler()
+        self.assertRaises(StopIteration, rr.reserve)
+        self.assertRaises(StopIteration, rr.reserve, max_wait=1)
+
+    @MockTime.patch()
+    def test_reserve(self):
+        throttle = 1
+        rr = self.get_scheduler(dict.fromkeys(['foo', 'bar', 'baz'], throttle))
+
+        # unthrottled
+        for key in 'bar', 'baz', 'foo':
+            with self.assertAlmostInstant():
+                reserved_key, ready_at = rr.reserve()
+            self.assertEqual(reserved_key, key)
+            self.assertLessEqual(ready_at, time.time())
+
+        # throttled: reserved without waiting
+        with self.assertAlmostInstant():
+            key, ready_at = rr.reserve()
+        self.assertEqual(key, 'bar')
+        self.assertGreater(ready_at, time.time())
+
+        # throttled for longer than max_wait: nothing reserved
+        for _ in xrange(10):
+            with self.assertAlmostInstant():
+                self.assertIsNone(rr.reserve(max_wait=0))
+        self.assertEqual(rr.reserve(max_wait=throttle)[0], 'baz')
+        self.assertEqual(rr.next(), 'foo')
+        self.assertEqual(rr.next(), 'bar')
+        self.assertAlmostEqual(time.time(), ready_at + throttle, delta=0.1)
+
+    @MockTime.patch()
+    def test_stats(self):
+        throttle = 1
+        rr = self.get_scheduler(dict.fromkeys(['foo', 'bar'], throttle), stats=True)
+        self.assertEqual(rr.stats(), {})
+        start = time.time()
+        for key in 'bar', 'foo', 'bar', 'foo':
+            self.assertEqual(rr.next(), key)
+        self.assertIsNone(rr.next(wait=False))
+        self.assertIsNone(rr.reserve(max_wait=0.5))
+        end = time.time()
+
+        stats = rr.stats()
+        self.assertItemsEqual(stats.keys(), ['foo', 'bar'])
+        self.assertEqual(stats['bar']['count'], 2)
+        self.assertEqual(stats['foo']['count'], 2)
+        self.assertEqual(stats['bar']['misses'], 2)
+        self.assertEqual(stats['foo']['misses'], 0)
+        self.assertAlmostEqual(stats['bar']['wait'], throttle, delta=0.1)
+        self.assertAlmostEqual(stats['foo']['wait'], 0, delta=0.1)
+        self.assertAlmostEqual(stats['bar']['last'], start + throttle, delta=0.1)
+        for key in 'foo', 'bar':
+            self.assertAlmostEqual(stats[key]['utilization'],
+                                   2 * throttle / (end - start), delta=0.1)
+
+        summary = rr.stats_summary()
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['misses'], 2)
+        self.assertAlmostEqual(summary['wait'], throttle, delta=0.1)
+        self.assertAlmostEqual(summary['since'], start, delta=0.1)
+
+        # schedulers without stats don't record anything
+        self.get_scheduler(name='test').next()
+        self.assertEqual(rr.stats_summary()['count'], 4)
+
+        rr.reset_stats()
+        self.assertEqual(rr.stats(), {})
+        self.assertEqual(rr.stats_summary(),
+                         dict(since=None, count=0, wait=0, misses=0))
+
+    @MockTime.patch()
+    def test_peek_schedule_capacity(self):
+        rr = self.get_scheduler({'foo': 1, 'bar': 2, 'baz': 4})
+        start = time.time()
+        self.assertEqual(rr.peek(0), [])
+        self.assertEqual([key for key, _ in rr.peek(2)], ['bar', 'baz'])
+        self.assertEqual([key for key, _ in rr.peek(5)], ['bar', 'baz', 'foo'])
+        # 1 + 2 + 3 dispatches of baz, bar, foo in the next 2 seconds
+        self.assertEqual(rr.capacity(2.5), 6)
+
+        for _ in xrange(3):
+            rr.next()
+        # nothing is reserved
+        for _ in xrange(2):
+            schedule = rr.peek(3)
+            self.assertEqual([key for key, _ in schedule], ['foo', 'bar', 'baz'])
+            for (_, throttled_until), throttle in zip(schedule, [1, 2, 4]):
+                self.assertAlmostEqual(throttled_until, start + throttle, delta=0.1)
+
+        self.assertEqual(list(rr.schedule(0)), [])
+        self.assertEqual([key for key, _ in rr.schedule(1.5, chunk_size=1)], ['foo'])
+        self.assertEqual([key for key, _ in rr.schedule(3, chunk_size=1)],
+                         ['foo', 'bar'])
+        self.assertEqual([key for key, _ in rr.schedule(5, chunk_size=2)],
+                         ['foo', 'bar', 'baz'])
+        self.assertEqual(rr.capacity(0.5), 0)
+        # foo at 1, 2, 3, bar at 2
+        self.assertEqual(rr.capacity(3.5, chunk_size=1), 4)
+
+    @MockTime.patch()
+    def test_schedule_concurrent_next(self):
+        keys = ['k{}'.format(i) for i in xrange(10)]
+        rr = self.get_scheduler(dict.fromkeys(keys, 1))
+        for key in keys[:4]:
+            rr[key] = 1
+        # keys are reserved and moved to the end of the queue while paging
+        scheduled = []
+        for key, _ in rr.schedule(10, chunk_size=3):
+            scheduled.append(key)
+            rr.next(wait=False)
+        self.assertEqual(sorted(scheduled), keys)
+        self.assertEqual(self.test_conn.keys(rr.queue_key + ':schedule:*'), [])
+
+    @MockTime.patch()
+    def test_schedule_ties(self):
+        keys = ['k{}'.format(i) for i in xrange(10)]
+        rr = self.get_scheduler(dict.fromkeys(keys, 1))
+        # more keys with the same score than chunk_size
+        self.test_conn.zadd(rr.queue_key, **dict.fromkeys(keys, 0))
+        self.assertEqual([key for key, _ in rr.schedule(10, chunk_size=3)], keys)
+        scheduled = []
+        for key, _ in rr.schedule(10, chunk_size=3):
+            scheduled.append(key)
+            rr.next(wait=False)
+        self.assertEqual(sorted(scheduled), keys)
+
+    @MockTime.patch()
+    def test_snapshot(self):
+        throttled_keys = {'foo': 2, 'bar': 0.5, 'baz': 1, 'xyz': 3}
+        rr = self.get_scheduler(throttled_keys)
+        start = time.time()
+        self.assertEqual(rr.next(), 'bar')
+        self.assertEqual(rr.next(), 'baz')
+        snapshot = list(rr.export_snapshot(chunk_size=3))
+        self.assertEqual(snapshot[0], {'type': 'ThrottlingScheduler', 'version': 2})
+        self.assertEqual([len(chunk) for chunk in snapshot[1:]], [3, 1])
+        self.assertEqual(sorted((key, throttle) for chunk in snapshot[1:]
+                                for key, throttle in (record[:2] for record in chunk)),
+                         sorted(throttled_keys.iteritems()))
+
+        time.sleep(0.2)
+        other = self.get_scheduler({'abc': 1}, name='other', cache_size=10)
+        self.assertEqual(other['abc'], 1)
+        other.import_snapshot(snapshot)
+        self.assertQueueThrottles(other, ['foo', 'xyz', 'bar', 'baz'], throttled_keys)
+        # the deadlines are preserved
+        self.assertEqual(other.peek(4), rr.peek(4))
+        self.assertAlmostEqual(dict(other.peek(4))['bar'], start + 0.5, delta=0.01)
+        self.assertNotIn('abc', other)
+        self.assertEqual(other.get('abc'), None)
+
+        other.import_snapshot(list(self.get_scheduler(name='empty').export_snapshot()))
+        self.assertQueueThrottles(other, [], {})
+        self.assertFalse([key for key in self.test_conn.keys() if ':export:' in key
+                          or ':import:' in key])
+
+    @MockTime.patch()
+    def test_dump_restore(self):
+        rr = self.get_scheduler({'foo': 2, 'bar': 0.5})
+        rr.next()
+        payloads = rr.dump()
+        peeked = rr.peek(2)
+        rr['bar'] = 5
+        rr['baz'] = 3
+        rr.next()
+        rr.restore(payloads)
+        self.assertQueueThrottles(rr, ['foo', 'bar'], {'foo': 2, 'bar': 0.5})
+        self.assertEqual(rr.peek(2), peeked)
+
+    @MockTime.patch()
+    def test_snapshot_expiry(self):
+        rr = self.get_scheduler({'foo': 1, 'bar': 1, 'baz': 1})
+        rr.expire('foo', 10)
+        rr.expire('baz', 20)
+        rr.set_priority('baz', 2)
+        snapshot = list(rr.export_snapshot())
+        self.assertItemsEqual(snapshot[1], [
+            ['foo', 1, mock.ANY, None, mock.ANY, mock.ANY],
+            ['bar', 1, mock.ANY, None, None, mock.ANY],
+            ['baz', 1, mock.ANY, 2, mock.ANY, mock.ANY]])
+        payloads = rr.dump()
+
+        other = self.get_scheduler({'bar': 1}, name='other')
+        other.expire('bar', 5)
+        for restore in (lambda: other.import_snapshot(snapshot),
+                        lambda: other.restore(payloads)):
+            restore()
+            self.assertEqual(dict(other), {'foo': 1, 'bar': 1, 'baz': 1})
+            self.assertAlmostEqual(other.ttl('foo'), 10, delta=0.1)
+            self.assertAlmostEqual(other.ttl('baz'), 20, delta=0.1)
+            self.assertIsNone(other.ttl('bar'))
+            self.assertEqual(other.priorities(), {'baz': 2})
+
+    @MockTime.patch()
+    def test_expiry_delete(self):
+        rr = self.get_scheduler({'a': 1, 'b': 1, 'c': 1, 'd': 1})
+        for key in 'abcd':
+            rr.expire(key, 100)
+        # deleted keys lose their expiry, so re-added keys are not purged
+        del rr['a']
+        self.assertEqual(rr.pop('b'), 1)
+        rr.discard('c')
+        for key in 'abc':
+            self.assertIsNone(rr.ttl(key))
+        self.assertAlmostEqual(rr.ttl('d'), 100, delta=0.1)
+        rr.expire('d', 0)
+        rr.popitem()
+        self.assertEqual(self.test_conn.zcard(rr.expiry_key), 0)
+
+        rr.setdefault('a', 1)
+        self.assertEqual(rr.next(wait=False), 'a')
+        rr['e'] = 1
+        rr.expire('e', 10)
+        rr.setdefault('e', 1)
+        self.assertIsNone(rr.ttl('e'))
+
+    @MockTime.patch()
+    def test_expiry(self):
+        rr = self.get_scheduler({'foo': 1, 'bar': 1, 'baz': 1, 'xyz': 2}, cache_size=10)
+        self.assertIsNone(rr.ttl('foo'))
+        self.assertTrue(rr.expire('foo', 0.5))
+        self.assertAlmostEqual(rr.ttl('foo'), 0.5, delta=0.01)
+        # like EXPIRE, missing keys are not expired
+        self.assertFalse(rr.expire('missing', 0.5))
+        self.assertFalse(rr.expireat('missing', 0))
+        self.assertIsNone(rr.ttl('missing'))
+        self.assertEqual(self.test_conn.zcard(rr.expiry_key), 1)
+        self.assertTrue(rr.persist('foo'))
+        self.assertFalse(rr.persist('foo'))
+        self.assertIsNone(rr.ttl('foo'))
+
+        rr.expire('bar', 0)
+        self.assertEqual(rr.get('bar'), 1)
+        # expired keys are purged instead of dispatched
+        self.assertEqual(rr.next(), 'baz')
+        self.assertQueueThrottles(rr, ['foo', 'xyz', 'baz'], {'foo': 1, 'baz': 1, 'xyz': 2})
+        self.assertEqual(rr.stats_summary()['count'], 0)
+        self.assertIsNone(rr.get('bar'))
+
+        start = time.time()
+        rr.expireat('foo', start + 0.5)
+        rr.expireat('xyz', start + 0.5)
+        self.assertEqual(rr.next_distinct(2, wait=False), ['foo', 'xyz'])
+        time.sleep(0.5)
+        with self.assertTimeRange(start + 0.99, start + 1.01):
+            self.assertEqual(rr.next(), 'baz')
+        # expired keys are counted until they are purged
+        self.assertEqual(len(rr), 3)
+        self.assertEqual(rr.sweep(), 2)
+        self.assertEqual(rr.keys(), ['baz'])
+
+        # setting a key clears its expiry
+        rr['baz'] = 2
+        rr.expire('baz', 10)
+        rr['baz'] = 3
+        self.assertIsNone(rr.ttl('baz'))
+
+    @MockTime.patch()
+    def test_sweep(self):
+        rr = self.get_scheduler({'key{}'.format(i): 1 for i in xrange(5)})
+        for i in xrange(4):
+            rr.expire('key{}'.format(i), 0.1 * i)
+        self.assertEqual(rr.sweep(), 1)
+        time.sleep(0.5)
+        self.assertEqual([rr.sweep(batch_size=2) for _ in xrange(3)], [2, 1, 0])
+        self.assertQueueThrottles(rr, ['key4'], {'key4': 1})
+        self.assertEqual(self.test_conn.zcard(rr.expiry_key), 0)
+
+    @MockTime.patch()
+    def test_priorities(self):
+        rr = self.get_scheduler({'std1': 1, 'std2': 1, 'premium1': 2, 'premium2': 3,
+                                 'gold': 4})
+        self.assertRaises(KeyError, rr.set_priority, 'missing', 1)
+        self.assertRaises(ValueError, rr.set_priority, 'gold', 1.5)
+        self.assertRaises(ValueError, rr.set_priority, 'gold', -1)
+        rr.set_priority('premium1', 1)
+        rr.set_priority('premium2', 1)
+        rr.set_priority('gold', 2)
+        self.assertEqual(rr.get_priority('gold'), 2)
+        self.assertEqual(rr.get_priority('std1'), 0)
+        self.assertEqual(rr.priorities(), {'premium1': 1, 'premium2': 1, 'gold': 2})
+
+        start = time.time()
+        # available keys by priority, then overflow to the standard keys
+        self.assertEqual([rr.next() for _ in xrange(5)],
+                         ['gold', 'premium1', 'premium2', 'std1', 'std2'])
+        # no key available: the earliest available key
+        with self.assertTimeRange(start + 1, start + 1.01):
+            self.assertEqual(rr.next(), 'std1')
+        time.sleep(1)
+        self.assertEqual([rr.next() for _ in xrange(3)], ['premium1', 'std2', 'std1'])
+
+        # lowering the priority
+        time.sleep(4)
+        rr.set_priority('gold', 0)
+        self.assertEqual(rr.priorities(), {'premium1': 1, 'premium2': 1})
+        self.assertEqual([rr.next() for _ in xrange(3)], ['premium2', 'premium1', 'std2'])
+
+        # removed keys lose their priority
+        del rr['premium1']
+        rr.discard('premium2')
+        rr['premium2'] = 1
+        self.assertEqual(rr.priorities(), {})
+        time.sleep(4)
+        # the earliest available key since there are no priorities
+        self.assertEqual(rr.next(), 'std1')
+        self.assertEqual(self.test_conn.zcard(rr.priority_levels_key), 0)
+
+    @MockTime.patch()
+    def test_priorities_snapshot(self):
+        rr = self.get_scheduler({'foo': 1, 'bar': 1, 'baz': 1})
+        rr.set_priority('foo', 3)
+        rr.set_priority('baz', 1)
+        snapshot = list(rr.export_snapshot())
+        self.assertItemsEqual([record for record in snapshot[1]], [
+            ['bar', 1, mock.ANY, None, None, mock.ANY],
+            ['baz', 1, mock.ANY, 1, None, mock.ANY],
+            ['foo', 1, mock.ANY, 3, None, mock.ANY]])
+        payloads = rr.dump()
+
+        rr.clear()
+        self.assertEqual(rr.priorities(), {})
+        self.assertFalse(self.test_conn.keys('*:priority*'))
+        for restore in (lambda: rr.import_snapshot(snapshot),
+                        lambda: rr.restore(payloads)):
+            rr.clear()
+            restore()
+            self.assertEqual(rr.priorities(), {'foo': 3, 'baz': 1})
+            self.assertEqual([rr.next(wait=False) for _ in xrange(3)],
+                             ['foo', 'baz', 'bar'])
+
+    def test_fork(self):
+        rr = self.get_scheduler({'foo': 2, 'bar': 2}, cache_size=10)
+        self.assertEqual(rr['foo'], 2)
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                rr['baz'] = 2
+                status = 0 if rr['baz'] == 2 and len(rr) == 3 else 1
+            except Exception:
+                status = 2
+            os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        # the connections of the parent still work
+        self.assertEqual(self.test_conn.ping(), True)
+        self.assertEqual(len(rr), 3)
+        rr['foo'] = 1
+        self.assertEventually(lambda: rr['foo'] == 1)
+
+    def test_pickle(self):
+        rr = self.get_scheduler({'foo': 3, 'bar': 4}, read_connection=self.test_conn,
+                                cache_size=10, stats=True)
+        other = pickle.loads(pickle.dumps(rr))
+        self.assertIsNot(other.redis, rr.redis)
+        self.assertEqual(other.redis.connection_pool.connection_kwargs,
+                         rr.redis.connection_pool.connection_kwargs)
+        # unpickled schedulers share their connection pools
+        self.assertIs(pickle.loads(pickle.dumps(rr)).redis.connection_pool,
+                      other.redis.connection_pool)
+        self.assertQueueThrottles(other, ['bar', 'foo'], {'foo': 3, 'bar': 4})
+        self.assertEqual(other['foo'], 3)
+        self.assertTrue(other.record_stats)
+        rr['foo'] = 1
+        self.assertEventually(lambda: other['foo'] == 1)
+
+    @MockTime.patch()
+    def test_server_clock(self):
+        # the local (mock) clock is decades behind the server
+        seconds, microseconds = self.test_conn.time()
+        server_now = seconds + microseconds / 1e6
+        rr = self.get_scheduler({'foo': 10, 'bar': 20}, server_clock=True)
+        self.assertAlmostEqual(rr.time(), server_now, delta=1)
+        self.assertAlmostEqual(rr._clock.offset, server_now, delta=1)
+        self.assertEqual(rr._script_time(), '')
+
+        key, ready_at = rr.reserve()
+        self.assertEqual(key, 'bar')
+        self.assertAlmostEqual(ready_at, server_now, delta=1)
+        key, foo_ready_at = rr.reserve()
+        self.assertEqual(key, 'foo')
+        self.assertEqual(dict(rr.peek(2)), {'foo': foo_ready_at + 10,
+                                             'bar': ready_at + 20})
+        self.assertIsNone(rr.reserve(max_wait=1))
+        self.assertAlmostEqual(rr.throttled_until(), foo_ready_at + 10, delta=1e-3)
+        rr.expire('bar', 5)
+        self.assertAlmostEqual(rr.ttl('bar'), 5, delta=0.1)
+
+        # the offset is not kept for other hosts
+        other = pickle.loads(pickle.dumps(rr))
+        self.assertIsNone(other._clock.offset)
+        self.assertAlmostEqual(other.time(), server_now, delta=1)
+
+    @MockTime.patch()
+    def test_admit(self):
+        rr = self.get_scheduler({'foo': 1, 'bar': 1})
+        now = time.time()
+        rr.admit([('xyz', 2), ('abc', 3)], available_at=now + 10)
+        self.assertEqual(rr.getmany('xyz', 'abc'), [2, 3])
+        self.assertEqual(rr.peek(4)[2:], [('abc', now + 10), ('xyz', now + 10)])
+
+        # staggered in iteration order
+        rr.admit([('k0', 1), ('k1', 1), ('k2', 1), ('k3', 1)], available_at=now + 20,
+                 stagger=2)
+        self.assertEqual(rr.peek(8)[4:], [('k0', now + 20), ('k1', now + 20.5),
+                                          ('k2', now + 21), ('k3', now + 21.5)])
+
+        # existing deadlines are postponed but never brought forward
+        rr.expire('xyz', 100)
+        rr.set_priority('foo', 2)
+        rr.admit({'foo': 5, 'xyz': 1}, available_at=now + 15)
+        self.assertEqual(rr['foo'], 5)
+        self.assertEqual(rr['xyz'], 1)
+        self.assertIsNone(rr.ttl('xyz'))
+        self.assertEqual(dict(rr.peek(8))['foo'], now + 15)
+        self.assertEqual(dict(rr.peek(8))['xyz'], now + 15)
+        rr.admit({'k3': 1})
+        self.assertEqual(dict(rr.peek(8))['k3'], now + 21.5)
+
+        self.assertEqual(rr.next(), 'bar')
+        del rr['bar']
+        with self.assertTimeRange(10, 10.1):
+            self.assertEqual(rr.next(), 'abc')
+        with self.assertTimeRange(13, 13.1):
+            self.assertEqual(rr.next(), 'abc')
+        with self.assertTimeRange(15, 15.1):
+            self.assertEqual(rr.next(), 'foo')
+        self.assertRaises(ValueError, rr.admit, {'foo': 0})
+        self.assertRaises(ValueError, rr.admit, {'foo': 1}, stagger=-1)
+        rr.admit({})
+
+    def test_admit_invalidates(self):
+        cached = self.get_scheduler({'foo': 1}, cache_size=10)
+        self.assertEqual(cached['foo'], 1)
+        self.get_scheduler().admit({'foo': 3, 'bar': 2})
+        self.assertEventually(lambda: cached['foo'] == 3)
+        self.assertEqual(cached['bar'], 2)
+
+    @MockTime.patch()
+    def test_warmup(self):
+        rr = self.get_scheduler({'foo': 1}, warmup_factor=3, warmup_period=10)
+        deadlines = []
+        for _ in xrange(7):
+            rr.next()
+            deadlines.append(rr.peek()[0][1])
+        # the interval starts at 3 throttles and decays to 1 over 10 seconds
+        for expected, deadline in zip([3, 5.4, 7.32, 8.856, 10.085, 11.085, 12.085],
+                                      deadlines):
+            self.assertAlmostEqual(deadline, expected, delta=0.05)
+
+        # updated keys keep warming up from their admission, re-added keys
+        # start over
+        rr['foo'] = 2
+        rr.admit({'bar': 1}, available_at=time.time() + 5)
+        rr.sync({'foo': 2, 'bar': 1, 'baz': 1})
+        self.assertEqual(rr.next(), 'baz')
+        self.assertAlmostEqual(dict(rr.peek(3))['baz'] - time.time(), 3, delta=0.05)
+        self.assertEqual(rr.next(), 'foo')
+        self.assertAlmostEqual(dict(rr.peek(3))['foo'] - time.time(), 2, delta=0.05)
+        del rr['foo']
+        rr['foo'] = 2
+        self.assertEqual(rr.next(), 'foo')
+        self.assertAlmostEqual(dict(rr.peek(3))['foo'] - time.time(), 6, delta=0.05)
+        # admitted keys warm up from their availability time
+        rr.discard('baz')
+        with self.assertTimeRange(16, 16.2):
+            self.assertEqual(rr.next(), 'bar')
+        self.assertAlmostEqual(dict(rr.peek(3))['bar'] - time.time(), 3, delta=0.05)
+
+        # no warm-up by default
+        other = self.get_scheduler({'foo': 1}, name='other')
+        self.assertEqual(other.next(), 'foo')
+        self.assertAlmostEqual(other.peek()[0][1] - time.time(), 1, delta=0.05)
+
+        self.assertRaises(ValueError, self.get_scheduler, warmup_factor=0.5)
+        self.assertRaises(ValueError, self.get_scheduler, warmup_period=-1)
+
+    @MockTime.patch()
+    def test_warmup_snapshot(self):
+        rr = self.get_scheduler({'foo': 1}, warmup_factor=3, warmup_period=10)
+        time.sleep(5)
+        snapshot = list(rr.export_snapshot())
+        payloads = rr.dump()
+        other = self.get_scheduler(name='other', warmup_factor=3, warmup_period=10)
+        # the imported keys keep warming up from their admission
+        for restore in (lambda: other.import_snapshot(snapshot),
+                        lambda: other.restore(payloads)):
+            other.clear()
+            restore()
+            self.assertEqual(other.next(), 'foo')
+            self.assertAlmostEqual(other.peek()[0][1] - time.time(), 2, delta=0.05)
+
+        # keys without an admission time are not warmed up, even after their
+        # throttle changes
+        other.import_snapshot([snapshot[0], [['foo', 1, time.time()]]])
+        other['foo'] = 2
+        other.update({'foo': 2})
+        other.setdefault('foo', 2)
+        self.assertFalse(self.test_conn.hexists(other.admitted_key, 'foo'))
+        self.assertEqual(other.next(), 'foo')
+        self.assertAlmostEqual(other.peek()[0][1] - time.time(), 2, delta=0.05)
+
+    @MockTime.patch()
+    def test_sync(self):
+        rr = self.get_scheduler({'foo': 1, 'bar': 2, 'baz': 3})
+        rr.set_priority('baz', 1)
+        rr.expire('bar', 10)
+        self.assertEqual(rr.next(), 'baz')
+        peeked = dict(rr.peek(3))
+
+        self.assertEqual(rr.sync({'foo': 1, 'bar': 2.5, 'xyz': 4}, chunk_size=2),
+                         (1, 1, 1))
+        self.assertQueueThrottles(rr, ['bar', 'foo', 'xyz'],
+                                  {'foo': 1, 'bar': 2.5, 'xyz': 4})
+        # the deadlines and expiry of the existing keys are untouched
+        self.assertEqual(rr.peek(2), [('bar', peeked['bar']), ('foo', peeked['foo'])])
+        self.assertAlmostEqual(rr.ttl('bar'), 10, delta=0.1)
+        self.assertEqual(rr.priorities(), {})
+
+        self.assertEqual(rr.sync([('foo', 1.0), ('bar', 2.5), ('xyz', 4)]), (0, 0, 0))
+        self.assertRaises(ValueError, rr.sync, {'foo': 0})
+        self.assertEqual(rr.sync({}), (0, 3, 0))
+        self.assertQueueThrottles(rr, [], {})
+        self.assertFalse([key for key in self.test_conn.keys() if ':sync:' in key])
+
+    def test_sync_invalidates(self):
+        cached = self.get_scheduler({'foo': 1, 'bar': 2}, cache_size=10)
+        self.assertEqual(dict(cached.items()), {'foo': 1, 'bar': 2})
+        self.get_scheduler().sync({'foo': 3, 'baz': 2})
+        self.assertEventually(lambda: dict(cached.items()) == {'foo': 3, 'baz': 2})
+
+    @MockTime.patch()
+    def test_batch(self):
+        rr = self.get_scheduler({'foo': 1, 'bar': 2}, cache_size=10)
+        self.assertEqual(rr['foo'], 1)
+        with rr.batch() as batch:
+            rr['xyz'] = 3
+            popped = rr.pop('bar')
+            missing = rr.pop('missing')
+            default = rr.pop('missing', 0)
+            discarded = rr.discard('foo', 'missing')
+            rr.update(abc=4, foo=5)
+            rr.set_priority('abc', 1)
+            no_priority = rr.set_priority('missing', 1)
+            rr.admit({'new': 2}, available_at=time.time() + 10)
+            # nothing is written until the batch is flushed
+            self.assertQueueThrottles(rr, ['bar', 'foo'], {'foo': 1, 'bar': 2})
+            self.assertRaises(RuntimeError, lambda: popped.value)
+
+        self.assertQueueThrottles(rr, ['xyz', 'abc', 'foo', 'new'],
+                                  {'xyz': 3, 'abc': 4, 'foo': 5, 'new': 2})
+        self.assertEqual(rr['foo'], 5)
+        self.assertEqual(rr.priorities(), {'abc': 1})
+        self.assertEqual(popped.value, 2)
+        self.assertRaises(KeyError, lambda: missing.value)
+        self.assertEqual(default.value, 0)
+        self.assertEqual(discarded.value, 1)
+        self.assertRaises(KeyError, lambda: no_priority.value)
+        self.assertEqual(len(batch.results), 9)
+        self.assertIsInstance(batch.results[2], KeyError)
+
+    def test_batch_chunks(self):
+        rr = self.get_scheduler()
+        with rr.batch(chunk_size=10) as batch:
+            for i in xrange(10):
+                rr['key{}'.format(i)] = 1
+                # each __setitem__ queues 6 commands
+                self.assertEqual(len(rr), i // 2 * 2)
+                with rr.batch() as nested:
+                    self.assertIs(nested, batch)
+        self.assertEqual(len(rr), 10)
+        self.assertEqual(batch.results, [None] * 10)
+
+        with self.assertRaises(ValueError):
+            with rr.batch():
+                del rr['key0']
+                raise ValueError
+        self.assertIn('key0', rr)
+        self.assertIsNone(rr._batch)
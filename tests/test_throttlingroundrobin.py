@@ -1,5 +1,8 @@
+import StringIO
 from itertools import cycle, islice
+import pickle
 import time
+import mock
 import redrobin
 
 from . import BaseTestCase, MockTime
@@ -7,9 +10,10 @@ from . import BaseTestCase, MockTime
 
 class ThrottlingRoundRobinSchedulerTestCase(BaseTestCase):
 
-    def get_scheduler(self, throttle, keys=None, name='test'):
+    def get_scheduler(self, throttle, keys=None, name='test', **kwargs):
         return redrobin.ThrottlingRoundRobinScheduler(throttle, keys=keys, name=name,
-                                                      connection=self.test_conn)
+                                                      connection=self.test_conn,
+                                                      **kwargs)
 
     def assertQueue(self, round_robin, expected_queues):
         queue = [round_robin._unpickle(v)[0]
@@ -124,6 +128,44 @@ class ThrottlingRoundRobinSchedulerTestCase(BaseTestCase):
             with self.assertRaises(ValueError):
                 rr.throttle = throttle
 
+    @MockTime.patch()
+    def test_shared_throttle(self):
+        keys = ['foo', 'bar']
+        rr1 = self.get_scheduler(1, keys)
+        # the throttle of the existing scheduler is kept
+        rr2 = self.get_scheduler(5)
+        self.assertEqual(rr2.throttle, 1)
+        self.assertEqual(list(rr2), keys)
+
+        # retuning the throttle applies to all schedulers with the same name
+        rr2.throttle = 2
+        self.assertEqual(rr1.throttle, 2)
+        start = time.time()
+        self.assertEqual(rr1.next(), 'foo')
+        self.assertEqual(rr1.next(), 'bar')
+        with self.assertTimeRange(start + 2, start + 2.1):
+            self.assertEqual(rr2.next(), 'foo')
+
+        # reinitializing the items resets the throttle
+        rr3 = self.get_scheduler(3, keys)
+        self.assertEqual(rr1.throttle, 3)
+
+        # fall back to the local throttle if the shared one is missing
+        self.test_conn.delete(rr3.throttle_key)
+        self.assertEqual(rr3.throttle, 3)
+        start = time.time()
+        self.assertEqual(rr3.next(), 'foo')
+        self.assertEqual(rr3.next(), 'bar')
+        with self.assertTimeRange(start + 3, start + 3.1):
+            self.assertEqual(rr3.next(), 'foo')
+
+    def test_next_non_string_items(self):
+        keys = [None, 1.5, ['a, b', {'c': 'd]'}], 'foo']
+        rr = self.get_scheduler(1e-3, keys)
+        for key in islice(cycle(keys), 20):
+            self.assertEqual(rr.next(), key)
+        self.assertEqual(list(rr), keys)
+
     def test_next_empty(self):
         rr = self.get_scheduler(1)
         self.assertRaises(StopIteration, rr.next)
@@ -207,3 +249,271 @@ class ThrottlingRoundRobinSchedulerTestCase(BaseTestCase):
         for _ in keys:
             self.assertIsNone(rr.throttled_until())
             rr.next()
+
+    def test_reserve_empty(self):
+        rr = self.get_scheduler(1)
+        self.assertRaises(StopIteration, rr.reserve)
+        self.assertRaises(StopIteration, rr.reserve, max_wait=1)
+
+    @MockTime.patch()
+    def test_reserve(self):
+        throttle = 1
+        keys = ['foo', 'bar', 'foo', 'baz']
+        rr = self.get_scheduler(throttle, keys)
+
+        # unthrottled
+        for key in keys:
+            with self.assertAlmostInstant():
+                item, ready_at = rr.reserve()
+            self.assertEqual(item, key)
+            self.assertLessEqual(ready_at, time.time())
+
+        # throttled: reserved without waiting
+        with self.assertAlmostInstant():
+            item, ready_at = rr.reserve()
+        self.assertEqual(item, 'foo')
+        self.assertGreater(ready_at, time.time())
+
+        # throttled for longer than max_wait: nothing reserved
+        for _ in xrange(10):
+            with self.assertAlmostInstant():
+                self.assertIsNone(rr.reserve(max_wait=0))
+        self.assertEqual(rr.reserve(max_wait=throttle)[0], 'bar')
+        self.assertEqual(rr.next(), 'foo')
+        self.assertEqual(rr.next(), 'baz')
+        self.assertEqual(rr.next(), 'foo')
+        self.assertAlmostEqual(time.time(), ready_at + throttle, delta=0.1)
+
+    def test_read_connection(self):
+        keys = ['foo', 'bar', 'foo', 'baz']
+        read_conn = mock.Mock(wraps=self.test_conn)
+        rr = self.get_scheduler(1, keys, read_connection=read_conn)
+        self.assertEqual(len(rr), 4)
+        self.assertEqual(list(rr), keys)
+        self.assertIn('bar', rr)
+        self.assertIsNone(rr.throttled_until())
+        self.assertTrue(read_conn.llen.called)
+        self.assertTrue(read_conn.lrange.called)
+
+        # writes and next() go to the primary
+        rr.add('xyz')
+        self.assertEqual(rr.next(), 'foo')
+        self.assertFalse(read_conn.lpush.called)
+        self.assertFalse(read_conn.pipeline.called)
+
+    @MockTime.patch()
+    def test_stats(self):
+        throttle = 1
+        keys = ['foo', 'bar', 'foo']
+        rr = self.get_scheduler(throttle, keys, stats=True)
+        start = time.time()
+        for key in keys * 2:
+            self.assertEqual(rr.next(), key)
+        self.assertIsNone(rr.next(wait=False))
+        end = time.time()
+
+        stats = rr.stats()
+        self.assertItemsEqual(stats.keys(), ['foo', 'bar'])
+        self.assertEqual(stats['foo']['count'], 4)
+        self.assertEqual(stats['bar']['count'], 2)
+        self.assertEqual(stats['foo']['misses'], 1)
+        self.assertEqual(stats['bar']['misses'], 0)
+        self.assertAlmostEqual(stats['foo']['wait'], throttle, delta=0.1)
+        self.assertAlmostEqual(stats['foo']['utilization'],
+                               4 * throttle / (end - start), delta=0.1)
+        self.assertEqual(rr.stats_summary()['count'], 6)
+
+    @MockTime.patch()
+    def test_peek_schedule_capacity(self):
+        throttle = 1
+        keys = ['foo', 'bar', 'foo', 'baz']
+        rr = self.get_scheduler(throttle, keys)
+        start = time.time()
+        self.assertEqual(rr.peek(0), [])
+        self.assertEqual([item for item, _ in rr.peek(2)], ['foo', 'bar'])
+        self.assertEqual([item for item, _ in rr.peek(5)], keys)
+        self.assertEqual(rr.capacity(2.5), 12)
+
+        rr.next()
+        rr.next()
+        # nothing is reserved
+        for _ in xrange(2):
+            self.assertEqual([item for item, _ in rr.peek(4)], ['foo', 'baz', 'foo', 'bar'])
+        schedule = rr.peek(4)
+        for _, available_at in schedule[:2]:
+            self.assertLess(available_at, time.time())
+        for _, available_at in schedule[2:]:
+            self.assertAlmostEqual(available_at, start + throttle, delta=0.1)
+
+        self.assertEqual([item for item, _ in rr.schedule(0, chunk_size=1)],
+                         ['foo', 'baz'])
+        self.assertEqual([item for item, _ in rr.schedule(2, chunk_size=3)],
+                         ['foo', 'baz', 'foo', 'bar'])
+        # 3 + 3 + 2 + 2 dispatches
+        self.assertEqual(rr.capacity(2.5, chunk_size=1), 10)
+
+    @MockTime.patch()
+    def test_schedule_concurrent_next(self):
+        items = ['i{}'.format(i) for i in xrange(10)]
+        rr = self.get_scheduler(1, items)
+        # the queue is rotated while paging
+        scheduled = []
+        for item, _ in rr.schedule(20, chunk_size=3):
+            scheduled.append(item)
+            rr.next(wait=False)
+        self.assertEqual(scheduled, items)
+        self.assertEqual(self.test_conn.keys(rr.key + ':schedule:*'), [])
+
+        # the items not read yet are rotated too
+        rr = self.get_scheduler(1, items, name='other')
+        scheduled = []
+        for item, _ in rr.schedule(20, chunk_size=3):
+            scheduled.append(item)
+            if item in ('i1', 'i5'):
+                for _ in xrange(3):
+                    rr.next(wait=False)
+        self.assertEqual(sorted(scheduled), items)
+        self.assertEqual(len(scheduled), len(items))
+
+    @MockTime.patch()
+    def test_snapshot(self):
+        rr = self.get_scheduler(2, ['foo', 'bar', 'baz'])
+        start = time.time()
+        self.assertEqual(rr.next(), 'foo')
+        fp = StringIO.StringIO()
+        rr.save_snapshot(fp, chunk_size=2)
+        self.assertEqual(fp.getvalue().count('\n'), 3)
+
+        time.sleep(1)
+        other = self.get_scheduler(1, ['xyz'], name='other')
+        fp.seek(0)
+        other.load_snapshot(fp)
+        self.assertQueue(other, ['bar', 'baz', 'foo'])
+        self.assertEqual(other.throttle, 2)
+        # the deadlines are preserved
+        self.assertEqual(other.peek(3), rr.peek(3))
+        self.assertEqual([other.next(), other.next()], ['bar', 'baz'])
+        with self.assertTimeRange(start + 2, start + 2.01):
+            self.assertEqual(other.next(), 'foo')
+
+    @MockTime.patch()
+    def test_dump_restore(self):
+        rr = self.get_scheduler(2, ['foo', 'bar'])
+        rr.next()
+        payloads = rr.dump()
+        peeked = rr.peek(2)
+        rr.throttle = 5
+        rr.next()
+        rr.restore(payloads)
+        self.assertEqual(rr.peek(2), peeked)
+        self.assertEqual(rr.throttle, 2)
+
+    @MockTime.patch()
+    def test_snapshot_expiry(self):
+        rr = self.get_scheduler(2, ['foo', 'bar'])
+        rr.expire('bar', 10)
+        snapshot = list(rr.export_snapshot())
+        self.assertEqual(snapshot[1], [['foo', mock.ANY], ['bar', mock.ANY, mock.ANY]])
+
+        other = self.get_scheduler(1, ['foo'], name='other')
+        other.expire('foo', 5)
+        other.import_snapshot(snapshot)
+        self.assertQueue(other, ['foo', 'bar'])
+        self.assertEqual(other.peek(2), rr.peek(2))
+        self.assertAlmostEqual(other.ttl('bar'), 10, delta=0.1)
+        self.assertIsNone(other.ttl('foo'))
+
+    @MockTime.patch()
+    def test_expiry_delete(self):
+        rr = self.get_scheduler(1, ['foo', 'bar', 'foo'])
+        rr.expire('foo', 100)
+        rr.expire('bar', 0)
+        self.assertEqual(rr.discard('foo', 1), 1)
+        self.assertAlmostEqual(rr.ttl('foo'), 100, delta=0.1)
+        self.assertEqual(rr.discard('foo'), 1)
+        self.assertIsNone(rr.ttl('foo'))
+        self.assertEqual(rr.discard('foo'), 0)
+        self.assertEqual(rr.pop(), 'bar')
+        self.assertIsNone(rr.ttl('bar'))
+        rr.add('bar')
+        self.assertEqual(rr.next(), 'bar')
+
+    @MockTime.patch()
+    def test_expiry(self):
+        rr = self.get_scheduler(1, ['foo', 'bar', 'foo', {'x': [1]}])
+        self.assertTrue(rr.expire('bar', 0))
+        self.assertTrue(rr.expire({'x': [1]}, 0.5))
+        self.assertAlmostEqual(rr.ttl({'x': [1]}), 0.5, delta=0.01)
+        self.assertFalse(rr.expire({'x': 1}, 0.5))
+        self.assertIsNone(rr.ttl({'x': 1}))
+        start = time.time()
+        self.assertEqual([rr.next(), rr.next(), rr.next()], ['foo', 'foo', {'x': [1]}])
+        time.sleep(0.5)
+        with self.assertTimeRange(start + 1, start + 1.01):
+            self.assertEqual([rr.next(), rr.next()], ['foo', 'foo'])
+        # the expired item is skipped
+        with self.assertTimeRange(start + 2, start + 2.01):
+            self.assertEqual(rr.next(), 'foo')
+        self.assertQueue(rr, ['foo', 'foo'])
+        # the expiries of the lazily purged items
+        self.assertEqual(rr.sweep(), 2)
+        self.assertEqual(self.test_conn.zcard(rr.expiry_key), 0)
+
+    def test_pickle(self):
+        rr = self.get_scheduler(0.5, ['foo', 'bar'])
+        other = pickle.loads(pickle.dumps(rr))
+        self.assertIsNot(other.redis, rr.redis)
+        self.assertEqual(other.throttle, 0.5)
+        self.assertEqual(list(other), ['foo', 'bar'])
+
+    @MockTime.patch()
+    def test_server_clock(self):
+        seconds, microseconds = self.test_conn.time()
+        server_now = seconds + microseconds / 1e6
+        rr = self.get_scheduler(10, ['foo', 'bar'], server_clock=True)
+        item, ready_at = rr.reserve()
+        self.assertEqual(item, 'foo')
+        self.assertAlmostEqual(ready_at, server_now, delta=1)
+        self.assertEqual(rr.next(), 'bar')
+        item, foo_ready_at = rr.reserve()
+        self.assertEqual(item, 'foo')
+        self.assertEqual(foo_ready_at, ready_at + 10)
+        self.assertAlmostEqual(rr.throttled_until(), rr.peek()[0][1], delta=1e-3)
+
+    @MockTime.patch()
+    def test_add_available_at(self):
+        rr = self.get_scheduler(1, ['foo'])
+        now = time.time()
+        rr.add('bar', 'baz', available_at=now + 10)
+        rr.add('k0', 'k1', 'k2', 'k3', available_at=now + 20, stagger=2)
+        self.assertEqual([throttled_until for _, throttled_until in map(
+            rr._unpickle, reversed(self.test_conn.lrange(rr.key, 0, -1)))][1:],
+            [now + 10, now + 10, now + 20, now + 20.5, now + 21, now + 21.5])
+        self.assertEqual(rr.next(), 'foo')
+        with self.assertTimeRange(10, 10.1):
+            self.assertEqual(rr.next(), 'bar')
+        rr.add('xyz', stagger=1)
+        self.assertRaises(ValueError, rr.add, 'xyz', stagger=-1)
+        self.assertRaises(TypeError, rr.add, 'xyz', delay=1)
+
+    @MockTime.patch()
+    def test_sync(self):
+        rr = self.get_scheduler(1, ['foo', 'bar', 'baz'])
+        self.assertEqual(rr.next(), 'foo')
+        self.assertEqual(rr.sync(['foo', 'baz', 'xyz']), (1, 1))
+        self.assertEqual(list(rr), ['baz', 'foo', 'xyz'])
+        # foo is still throttled
+        self.assertEqual([item for item, _ in rr.peek(3)], ['baz', 'foo', 'xyz'])
+        self.assertEqual(rr.next(), 'baz')
+        with self.assertTimeRange(1, 1.1):
+            self.assertEqual(rr.next(), 'foo')
+
+    def test_batch(self):
+        rr = self.get_scheduler(1, ['foo', 'bar'])
+        with rr.batch():
+            rr.add('xyz', available_at=0)
+            popped = rr.pop()
+            # discard is executed immediately
+            self.assertEqual(rr.discard('bar'), 1)
+        self.assertEqual(popped.value, 'foo')
+        self.assertEqual(list(rr), ['xyz'])